@@ -0,0 +1,163 @@
+# end-to-end benchmark of the functions against the local mock server in
+# benchmarks/mock_hubspot.py; each case runs get_data() or flexio_handler()
+# (with a stand-in for the flex object) in its own process, so peak rss is
+# per case, and reports rows/sec, time to first row (or first output byte),
+# peak rss and the requests made
+#
+# the functions' rate limits (set in hubspot_core.py) are lifted unless
+# --rate-limit is given so the numbers show the functions rather than the
+# pacing; mirrors, checkpoints and file caches are kept in a temporary
+# directory
+#
+# usage: python benchmarks/bench_functions.py [--function deals] [--entry get_data]
+#            [--params '{"properties": "*"}'] [--rate-limit] [mock server options]
+#
+# see python benchmarks/mock_hubspot.py --help for the mock server options
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+import importlib.util
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mock_hubspot
+import hubspot_core
+
+FUNCTIONS = {
+    'deals': 'hubspot-deals.py',
+    'contacts': 'hubspot-contacts.py',
+    'companies': 'hubspot-companies.py',
+    'activity': 'hubspot-activity.py',
+}
+
+ENTRIES = ['get_data', 'flexio_handler']
+
+def load_function(filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', filename)
+    spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakeOutput(object):
+
+    def __init__(self):
+        self.content_type = None
+        self.first_write = None
+        self.size = 0
+
+    def write(self, data):
+        if self.first_write is None:
+            self.first_write = time.perf_counter()
+        self.size += len(data)
+
+class FakeFlex(object):
+
+    def __init__(self, params):
+        self.vars = params
+        self.output = FakeOutput()
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def run_case(function, entry, base_url, params, rate_limit):
+
+    # the rate limits, checkpoints and caches are in the shared module
+    module = load_function(FUNCTIONS[function])
+    core = hubspot_core
+    module.API_BASE_URL = base_url
+    if not rate_limit:
+        core.RATE_LIMITS = {k: (1000000, 1.0) for k in core.RATE_LIMITS.keys()}
+    directory = tempfile.mkdtemp(prefix='flexio-hubspot-bench-')
+    for owner, name in [(module, 'MIRROR_PATH'), (core, 'CHECKPOINT_PATH'), (core, 'CACHE_PATH')]:
+        if hasattr(owner, name):
+            setattr(owner, name, os.path.join(directory, os.path.basename(getattr(owner, name))))
+
+    # count rows at get_data() for both entry points; flexio_handler() also
+    # reports the time to the first output byte
+    counts = {'rows': 0, 'first': None}
+    get_data = module.get_data
+    def get_counted_data(*args, **kwargs):
+        for row in get_data(*args, **kwargs):
+            if counts['first'] is None:
+                counts['first'] = time.perf_counter()
+            counts['rows'] += 1
+            yield row
+    module.get_data = get_counted_data
+
+    params = dict(params, hubspot_connection={'access_token': 'bench'})
+    baseline = get_peak_rss()
+    first_byte = None
+    size = 0
+    started = time.perf_counter()
+    if entry == 'get_data':
+        for row in module.get_data(params):
+            pass
+    else:
+        flex = FakeFlex(params)
+        module.flexio_handler(flex)
+        first_byte = flex.output.first_write
+        size = flex.output.size
+    elapsed = time.perf_counter() - started
+    shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'rows': counts['rows'],
+        'bytes': size,
+        'seconds': elapsed,
+        'first_row': counts['first'] - started if counts['first'] is not None else None,
+        'first_byte': first_byte - started if first_byte is not None else None,
+        'baseline_rss': baseline,
+        'peak_rss': get_peak_rss(),
+    }
+
+def measure(server, base_url, function, entry, params, rate_limit):
+    server.reset()
+    command = [sys.executable, os.path.abspath(__file__), '--case', function, entry, base_url, json.dumps(params)]
+    if rate_limit:
+        command.append('--rate-limit')
+    completed = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    result = json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+    stats = server.get_stats()
+
+    first_row = '%8.1f ms' % (result['first_row'] * 1000) if result['first_row'] is not None else '%8s ms' % '-'
+    first_byte = '%8.1f ms' % (result['first_byte'] * 1000) if result['first_byte'] is not None else '%8s ms' % '-'
+    print('%-9s %-15s %8d rows %10.0f rows/sec  first row %s  first byte %s  %10d bytes  peak rss %7.1f MB (+%.1f)  requests %5d  429s %3d' % (
+        function, entry, result['rows'], result['rows'] / result['seconds'], first_row, first_byte, result['bytes'],
+        result['peak_rss'] / 1048576.0, (result['peak_rss'] - result['baseline_rss']) / 1048576.0,
+        stats['requests'], stats['rate_limited']))
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--case':
+        function, entry, base_url, params = sys.argv[2:6]
+        result = run_case(function, entry, base_url, json.loads(params), '--rate-limit' in sys.argv)
+        print(json.dumps(result))
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark the functions against a local mock HubSpot server')
+    parser.add_argument('--function', choices=list(FUNCTIONS.keys()), action='append', help='function to run (default: all)')
+    parser.add_argument('--entry', choices=ENTRIES, action='append', help='entry point to run (default: both)')
+    parser.add_argument('--params', default='{"properties": "*"}', help='json object of function parameters')
+    parser.add_argument('--rate-limit', action='store_true', help="keep the functions' rate limits")
+    mock_hubspot.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = mock_hubspot.start(mock_hubspot.get_config(args))
+    base_url = 'http://127.0.0.1:' + str(server.server_port)
+    params = json.loads(args.params)
+    for function in args.function or list(FUNCTIONS.keys()):
+        for entry in args.entry or ENTRIES:
+            measure(server, base_url, function, entry, params, args.rate_limit)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
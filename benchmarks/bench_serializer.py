@@ -0,0 +1,111 @@
+# micro-benchmark for the row serializer; compares the old per-page string
+# concatenation with NdjsonWriter (using json and, if installed, orjson) and
+# with the csv, arrow and parquet writers (the last two if pyarrow is
+# installed)
+#
+# usage: python benchmarks/bench_serializer.py [rows-per-page] [pages]
+
+import os
+import sys
+import json
+import time
+import importlib.util
+
+# the writers and the row helpers the functions use are in hubspot_core.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hubspot_core
+
+def load_function(filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', filename)
+    spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_rows(module, count):
+    owners = {1: {'firstName': 'Jane', 'lastName': 'Doe'}}
+    stages = {'closedwon': {'label': 'Closed Won'}}
+    columns = list(module.COLUMNS.keys())
+    extract = hubspot_core.get_extractor(module.COLUMNS, module.EXTRACTOR_ARGS, columns)
+    rows = []
+    for i in range(count):
+        item = {
+            'portalId': 62515,
+            'dealId': i,
+            'properties': {
+                'dealname': {'value': 'Deal ' + str(i)},
+                'hubspot_owner_id': {'value': '1'},
+                'dealstage': {'value': 'closedwon'},
+                'amount': {'value': str(i * 10)},
+                'description': {'value': 'A description of the deal ' * 4},
+                'createdate': {'value': str(1546300800000 + i * 60000)},
+                'closedate': {'value': str(1556300800000 + i * 60000)},
+            },
+        }
+        rows.append(extract(item, owners, stages))
+    return columns, rows
+
+def run_concatenation(module, pages, columns, rows):
+    output = []
+    for page in range(pages):
+        buffer = ''
+        for row in rows:
+            item = dict(zip(columns, row))
+            buffer = buffer + json.dumps(item, default=hubspot_core.to_string) + "\n"
+        output.append(buffer)
+    return sum(len(b) for b in output)
+
+def run_writer(module, pages, columns, rows):
+    output = []
+    writer = hubspot_core.NdjsonWriter(output.append, columns)
+    for page in range(pages):
+        for row in rows:
+            writer.write(row)
+    writer.close()
+    return sum(len(b) for b in output)
+
+def run_format(format):
+    def run(module, pages, columns, rows):
+        output = []
+        if format == 'csv':
+            writer = hubspot_core.CsvWriter(output.append, columns)
+        else:
+            types = module.get_schema(module.__file__, module.COLUMNS)
+            writer = hubspot_core.ArrowWriter(output.append, columns, format, types)
+        for page in range(pages):
+            for row in rows:
+                writer.write(row)
+        writer.close()
+        return sum(len(b) for b in output)
+    return run
+
+def measure(name, fn, module, pages, columns, rows):
+    started = time.perf_counter()
+    size = fn(module, pages, columns, rows)
+    elapsed = time.perf_counter() - started
+    count = pages * len(rows)
+    print('%-24s %10d rows %12.0f rows/sec %10d bytes' % (name, count, count / elapsed, size))
+
+def main():
+    rows_per_page = int(sys.argv[1]) if len(sys.argv) > 1 else 2500
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    module = load_function('hubspot-deals.py')
+    columns, rows = get_rows(module, rows_per_page)
+
+    # the writers look orjson up through get_optional(), so it's switched off
+    # by marking it as not installed in hubspot_core's optional imports
+    measure('concatenation', run_concatenation, module, pages, columns, rows)
+    orjson = hubspot_core.get_optional('orjson')
+    hubspot_core._optional['orjson'] = None
+    measure('writer (json)', run_writer, module, pages, columns, rows)
+    hubspot_core._optional['orjson'] = orjson
+    if orjson is not None:
+        measure('writer (orjson)', run_writer, module, pages, columns, rows)
+    measure('writer (csv)', run_format('csv'), module, pages, columns, rows)
+    if importlib.util.find_spec('pyarrow') is not None:
+        measure('writer (arrow)', run_format('arrow'), module, pages, columns, rows)
+        measure('writer (parquet)', run_format('parquet'), module, pages, columns, rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# cold start benchmark of the functions; each run loads a function in a new
+# process and reports the median of the time to load it, the time from then
+# to its first row (a call with the default params against the local mock
+# server in benchmarks/mock_hubspot.py) and the wall time of the process
+# that only loads it
+#
+# the functions are run as they are in the working tree and as they were at
+# the baseline, by default the commit before hubspot_core.py was added,
+# which had all of the shared code (and its imports) in each file
+#
+# the modules are loaded from their bytecode cache, as they would be by a
+# deployment that ships it, unless --no-bytecode is given, in which case
+# they're compiled from source in each process
+#
+# usage: python benchmarks/bench_startup.py [--function deals] [--runs 10]
+#            [--baseline <git ref>] [--no-bytecode] [mock server options]
+#
+# see python benchmarks/mock_hubspot.py --help for the mock server options
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_hubspot
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+FUNCTIONS = {
+    'deals': 'hubspot-deals.py',
+    'contacts': 'hubspot-contacts.py',
+    'companies': 'hubspot-companies.py',
+    'activity': 'hubspot-activity.py',
+}
+
+# run in each process; the times are measured from just before the function
+# is loaded, after the interpreter has started
+CASE = '''
+import sys, json, time
+started = time.perf_counter()
+directory, filename, base_url = sys.argv[1:4]
+import importlib.util
+spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], directory + '/' + filename)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+loaded = time.perf_counter()
+first_row = None
+if base_url != '-':
+    module.API_BASE_URL = base_url
+    for row in module.get_data({'hubspot_connection': {'access_token': 'bench'}}):
+        first_row = time.perf_counter() - loaded
+        break
+print(json.dumps({'load': loaded - started, 'first_row': first_row}))
+'''
+
+def get_baseline(ref):
+
+    # the parent of the commit that added hubspot_core.py, or HEAD if it
+    # hasn't been committed yet
+    if ref is not None:
+        return ref
+    completed = subprocess.run(['git', 'log', '--diff-filter=A', '--format=%H', '--', 'hubspot_core.py'],
+        cwd=ROOT, stdout=subprocess.PIPE, check=True)
+    commits = completed.stdout.decode('utf-8').split()
+    return commits[-1] + '~1' if len(commits) > 0 else 'HEAD'
+
+def checkout(ref, filename, directory):
+
+    # write the function as it was at the ref to the directory; false if it
+    # didn't exist then
+    completed = subprocess.run(['git', 'show', ref + ':' + filename], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if completed.returncode != 0:
+        return False
+    with open(os.path.join(directory, filename), 'wb') as f:
+        f.write(completed.stdout)
+    return True
+
+def run(directory, filename, base_url, bytecode):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable] + ([] if bytecode else ['-B']) + ['-c', CASE, directory, filename, base_url]
+    if not bytecode:
+        # clear the cache left by an earlier run
+        shutil.rmtree(os.path.join(directory, '__pycache__'), ignore_errors=True)
+    started = time.perf_counter()
+    completed = subprocess.run(command, stdout=subprocess.PIPE, env=env, check=True)
+    result = json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - started
+    return result
+
+def measure(server, base_url, function, label, directory, runs, bytecode):
+
+    # the first run of each case is dropped, since it also writes the
+    # bytecode cache
+    filename = FUNCTIONS[function]
+    run(directory, filename, '-', bytecode)
+    loads, processes, first_rows = [], [], []
+    for i in range(runs):
+        result = run(directory, filename, '-', bytecode)
+        loads.append(result['load'])
+        processes.append(result['process'])
+        server.reset()
+        first_rows.append(run(directory, filename, base_url, bytecode)['first_row'])
+    print('%-9s %-9s load %8.1f ms  first row %8.1f ms  process %8.1f ms' % (
+        function, label, statistics.median(loads) * 1000, statistics.median(first_rows) * 1000,
+        statistics.median(processes) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the functions against their baseline')
+    parser.add_argument('--function', choices=list(FUNCTIONS.keys()), action='append', help='function to run (default: all)')
+    parser.add_argument('--runs', type=int, default=10, help='runs of each case')
+    parser.add_argument('--baseline', help='git ref of the baseline (default: the commit before hubspot_core.py was added)')
+    parser.add_argument('--no-bytecode', action='store_true', help='compile the modules from source in each process')
+    mock_hubspot.add_arguments(parser)
+    args = parser.parse_args()
+
+    baseline = get_baseline(args.baseline)
+    directory = tempfile.mkdtemp(prefix='flexio-hubspot-startup-')
+    server = mock_hubspot.start(mock_hubspot.get_config(args))
+    base_url = 'http://127.0.0.1:' + str(server.server_port)
+    print('baseline ' + baseline)
+    for function in args.function or list(FUNCTIONS.keys()):
+        bytecode = not args.no_bytecode
+        if checkout(baseline, FUNCTIONS[function], directory):
+            measure(server, base_url, function, 'baseline', directory, args.runs, bytecode)
+        measure(server, base_url, function, 'current', ROOT, args.runs, bytecode)
+    server.shutdown()
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+# a local stand-in for the parts of the hubspot api read by the functions;
+# serves synthetic records (or records recorded from a portal) with a
+# configurable number of records, payload sizes, latency and injected 429s,
+# and counts the requests made to each endpoint
+#
+# usage: python benchmarks/mock_hubspot.py [--port 8080] [--deals 10000]
+#            [--contacts 10000] [--companies 1000] [--engagements 10000] [--latency 0.05]
+#            [--fail-every 0] [--retry-after 1] [--body-size 2000]
+#            [--versions 1] [--payloads dir]
+#
+# recorded payloads are read from deals.json, contacts.json, companies.json,
+# engagements.json, owners.json and pipelines.json in the payloads directory
+# (each a json list of records in the shape returned by the v1 and v2 apis);
+# any that aren't there are generated
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULTS = {
+    'deals': 10000,
+    'contacts': 10000,
+    'companies': 1000,
+    'engagements': 10000,
+    'owners': 20,
+    'latency': 0.0,
+    'fail_every': 0,
+    'retry_after': 1,
+    'body_size': 2000,
+    'versions': 1,
+    'payloads': None,
+}
+
+EPOCH_MS = 1546300800000 # 2019-01-01
+STAGES = ['appointmentscheduled', 'qualifiedtobuy', 'presentationscheduled', 'closedwon', 'closedlost']
+
+def get_property(value, versions):
+    return {
+        'value': value,
+        'timestamp': EPOCH_MS,
+        'source': 'CRM_UI',
+        'sourceId': None,
+        'versions': [{'name': 'property', 'value': value, 'timestamp': EPOCH_MS - v * 1000, 'source': 'CRM_UI', 'sourceVid': []} for v in range(versions)],
+    }
+
+def get_deal(i, config):
+    properties = {
+        'dealname': 'Deal ' + str(i),
+        'hubspot_owner_id': str(1 + i % config['owners']),
+        'dealstage': STAGES[i % len(STAGES)],
+        'dealtype': 'newbusiness',
+        'amount': str(i * 10),
+        'amount_in_home_currency': str(i * 10),
+        'closedate': str(EPOCH_MS + i * 3600000),
+        'description': 'A description of the deal ' * 4,
+        'pipeline': 'default',
+        'num_notes': str(i % 7),
+        'num_associated_contacts': str(i % 3),
+        'num_contacted_notes': str(i % 5),
+        'notes_last_contacted': str(EPOCH_MS + i * 60000),
+        'notes_last_updated': str(EPOCH_MS + i * 60000),
+        'createdate': str(EPOCH_MS + i * 1000),
+        'hs_lastmodifieddate': str(EPOCH_MS + i * 2000),
+    }
+    return {
+        'portalId': 62515,
+        'dealId': i + 1,
+        'isDeleted': False,
+        'associations': {'associatedVids': [i + 1], 'associatedCompanyIds': [i % 50 + 1], 'associatedDealIds': []},
+        'properties': {k: get_property(v, config['versions']) for k, v in properties.items()},
+        'imports': [],
+        'stateChanges': [],
+    }
+
+def get_contact(i, config):
+    properties = {
+        'firstname': 'First' + str(i),
+        'lastname': 'Last' + str(i),
+        'email': 'contact' + str(i) + '@example.com',
+        'phone': '555-0100',
+        'jobtitle': 'Title',
+        'city': 'Chicago',
+        'state': 'IL',
+        'country': 'USA',
+        'createdate': str(EPOCH_MS + i * 1000),
+        'lastmodifieddate': str(EPOCH_MS + i * 2000),
+    }
+    return {
+        'vid': i + 1,
+        'portal-id': 62515,
+        'canonical-vid': i + 1,
+        'is-contact': True,
+        'properties': {k: get_property(v, config['versions']) for k, v in properties.items()},
+        'form-submissions': [],
+        'identity-profiles': [{'vid': i + 1, 'identities': [{'type': 'EMAIL', 'value': 'contact' + str(i) + '@example.com', 'timestamp': EPOCH_MS}]}],
+        'merge-audits': [],
+    }
+
+def get_company(i, config):
+    properties = {
+        'name': 'Company ' + str(i),
+        'domain': 'company' + str(i) + '.example.com',
+        'website': 'company' + str(i) + '.example.com',
+        'industry': 'COMPUTER_SOFTWARE',
+        'type': 'PROSPECT',
+        'city': 'Chicago',
+        'state': 'IL',
+        'country': 'USA',
+        'numberofemployees': str(10 + i % 500),
+        'annualrevenue': str(i * 1000),
+        'hubspot_owner_id': str(1 + i % config['owners']),
+        'lifecyclestage': 'customer',
+        'num_associated_contacts': str(i % 9),
+        'num_associated_deals': str(i % 4),
+        'createdate': str(EPOCH_MS + i * 1000),
+        'hs_lastmodifieddate': str(EPOCH_MS + i * 2000),
+    }
+    return {
+        'portalId': 62515,
+        'companyId': i + 1,
+        'isDeleted': False,
+        'properties': {k: get_property(v, config['versions']) for k, v in properties.items()},
+        'additionalDomains': [],
+        'stateChanges': [],
+        'mergeAudits': [],
+    }
+
+def get_engagement(i, config):
+    return {
+        'engagement': {
+            'id': i + 1,
+            'portalId': 62515,
+            'active': True,
+            'createdAt': EPOCH_MS + i * 1000,
+            'lastUpdated': EPOCH_MS + i * 2000,
+            'createdBy': 1 + i % config['owners'],
+            'ownerId': 1 + i % config['owners'],
+            'type': ['EMAIL', 'CALL', 'NOTE', 'MEETING', 'TASK'][i % 5],
+            'timestamp': EPOCH_MS + i * 60000,
+        },
+        'associations': {
+            'contactIds': [i + 1],
+            'companyIds': [i % 50 + 1] if i % 2 else [],
+            'dealIds': [i % 100 + 1, i % 100 + 2] if i % 3 else [],
+            'ownerIds': [],
+            'workflowIds': [],
+            'ticketIds': [],
+        },
+        'attachments': [],
+        'metadata': {
+            'subject': 'Subject ' + str(i),
+            'status': 'SENT',
+            'body': 'x' * config['body_size'],
+            'html': '<p>' + 'x' * config['body_size'] + '</p>',
+        },
+    }
+
+def get_owner(i, config):
+    return {'portalId': 62515, 'ownerId': i + 1, 'type': 'PERSON', 'firstName': 'Owner' + str(i), 'lastName': 'Last' + str(i), 'email': 'owner' + str(i) + '@example.com', 'isActive': True}
+
+def get_pipelines(config):
+    stages = [{'stageId': s, 'label': s.title(), 'displayOrder': i, 'active': True} for i, s in enumerate(STAGES)]
+    return {'results': [{'pipelineId': 'default', 'label': 'Sales Pipeline', 'stages': stages}]}
+
+class Records(object):
+
+    # the records for an endpoint, either recorded or generated on demand
+    # so large record counts don't need to be held in memory; records can
+    # be replaced or deleted with set(), such as to change them between
+    # incremental calls
+
+    def __init__(self, config, name, generate):
+        self.config = config
+        self.recorded = None
+        if config['payloads'] is not None and os.path.exists(os.path.join(config['payloads'], name + '.json')):
+            with open(os.path.join(config['payloads'], name + '.json')) as f:
+                self.recorded = json.load(f)
+        self.generate = generate
+        self.count = len(self.recorded) if self.recorded is not None else config[name]
+        self.changed = {}
+
+    def get(self, start, stop):
+        stop = min(stop, self.count)
+        if self.recorded is not None:
+            records = self.recorded[start:stop]
+        else:
+            records = [self.generate(i, self.config) for i in range(start, stop)]
+        if len(self.changed) == 0:
+            return records
+        # copies are returned so select_properties() leaves the changes whole
+        records = [copy.deepcopy(self.changed.get(i, r)) for i, r in zip(range(start, stop), records)]
+        return [r for r in records if r is not None]
+
+    def set(self, i, record):
+        # replace the record at index i, or delete it if record is None
+        self.changed[i] = record
+
+    def get_recent(self, since, modified):
+        # the records modified at or after since, most recently modified first
+        records = [r for r in self.get(0, self.count) if modified(r) >= since]
+        return sorted(records, key=modified, reverse=True)
+
+def select_properties(records, names):
+    # the v1 apis only return the properties that are asked for
+    if len(names) == 0:
+        return records
+    names = set(names)
+    for record in records:
+        record['properties'] = {k: v for k, v in record['properties'].items() if k in names}
+    return records
+
+class MockHubSpot(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.config = dict(DEFAULTS, **config)
+        self.lock = threading.Lock()
+        self.deals = Records(self.config, 'deals', get_deal)
+        self.contacts = Records(self.config, 'contacts', get_contact)
+        self.companies = Records(self.config, 'companies', get_company)
+        self.engagements = Records(self.config, 'engagements', get_engagement)
+        self.owners = Records(self.config, 'owners', get_owner)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.counts = {}
+            self.rate_limited = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'rate_limited': self.rate_limited, 'endpoints': dict(self.counts)}
+
+    def handle_error(self, request, client_address):
+        # clients hanging up, such as a function stopping at its time limit,
+        # aren't errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, path):
+        # returns true if the request should get a 429
+        with self.lock:
+            self.requests += 1
+            self.counts[path] = self.counts.get(path, 0) + 1
+            fail_every = self.config['fail_every']
+            if fail_every > 0 and self.requests % fail_every == 0:
+                self.rate_limited += 1
+                return True
+            return False
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, content, status=200):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', str(self.server.config['retry_after']))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start(self):
+        # counts the request and returns its path, or None if it was given
+        # a 429
+        server = self.server
+        path = urllib.parse.urlparse(self.path).path
+        if server.count(path):
+            self.send_json({'status': 'error', 'message': 'You have reached your secondly limit.', 'category': 'RATE_LIMITS'}, 429)
+            return None
+        if server.config['latency'] > 0:
+            time.sleep(server.config['latency'])
+        return path
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.start()
+        if path is None:
+            return
+
+        if path == '/crm/v3/objects/companies/batch/read':
+            # ids without a company are left out, as hubspot does
+            results = []
+            for i in [int(i['id']) - 1 for i in body.get('inputs', []) if str(i.get('id')).isdigit()]:
+                if i < 0 or i >= server.companies.count:
+                    continue
+                company = server.companies.get(i, i + 1)[0]
+                properties = {k: v['value'] for k, v in company['properties'].items() if k in body.get('properties', [])}
+                results.append({'id': str(company['companyId']), 'properties': properties, 'archived': False})
+            return self.send_json({'status': 'COMPLETE', 'results': results})
+
+        return self.send_json({'status': 'error', 'message': 'Not found: ' + path}, 404)
+
+    def do_GET(self):
+        server = self.server
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        path = self.start()
+        if path is None:
+            return
+
+        if path == '/owners/v2/owners':
+            return self.send_json(server.owners.get(0, server.owners.count))
+        if path == '/crm-pipelines/v1/pipelines/deals':
+            if server.config['payloads'] is not None and os.path.exists(os.path.join(server.config['payloads'], 'pipelines.json')):
+                with open(os.path.join(server.config['payloads'], 'pipelines.json')) as f:
+                    return self.send_json({'results': json.load(f)})
+            return self.send_json(get_pipelines(server.config))
+        if path == '/account-info/v3/details':
+            return self.send_json({'portalId': 62515, 'timeZone': 'US/Eastern', 'currency': 'USD'})
+        if path == '/deals/v1/deal/paged':
+            limit = min(int(query.get('limit', ['100'])[0]), 250)
+            offset = int(query.get('offset', ['0'])[0])
+            deals = select_properties(server.deals.get(offset, offset + limit), query.get('properties', []))
+            return self.send_json({'deals': deals, 'hasMore': offset + limit < server.deals.count, 'offset': offset + limit})
+        if path == '/deals/v1/deal/recent/modified' or path == '/engagements/v1/engagements/recent/modified':
+            count = min(int(query.get('count', ['20'])[0]), 100)
+            offset = int(query.get('offset', ['0'])[0])
+            since = int(query.get('since', ['0'])[0])
+            if path.startswith('/deals/'):
+                records = server.deals.get_recent(since, lambda d: int(d['properties']['hs_lastmodifieddate']['value']))
+            else:
+                records = server.engagements.get_recent(since, lambda e: e['engagement']['lastUpdated'])
+            return self.send_json({'results': records[offset:offset + count], 'hasMore': offset + count < len(records), 'offset': offset + count, 'total': len(records)})
+        if path == '/contacts/v1/lists/all/contacts/all':
+            count = min(int(query.get('count', ['20'])[0]), 100)
+            offset = int(query.get('vidOffset', ['0'])[0])
+            contacts = select_properties(server.contacts.get(offset, offset + count), query.get('property', []))
+            return self.send_json({'contacts': contacts, 'has-more': offset + count < server.contacts.count, 'vid-offset': offset + count})
+        if path == '/contacts/v1/lists/recently_updated/contacts/recent':
+            # all the contacts, most recently modified first; the vid offset
+            # is the position of the next page
+            count = min(int(query.get('count', ['20'])[0]), 100)
+            offset = int(query.get('vidOffset', ['0'])[0])
+            modified = lambda c: int(c['properties']['lastmodifieddate']['value'])
+            records = server.contacts.get_recent(0, modified)
+            time_offset = modified(records[offset + count - 1]) if offset + count <= len(records) else 0
+            contacts = select_properties(records[offset:offset + count], query.get('property', []))
+            return self.send_json({'contacts': contacts, 'has-more': offset + count < len(records), 'vid-offset': offset + count, 'time-offset': time_offset})
+        if path == '/contacts/v1/contact/emails/batch/' or path == '/contacts/v1/contact/vids/batch/':
+            # synthetic contact i has the vid i + 1 and the email contact<i>@example.com
+            if path.endswith('/emails/batch/'):
+                keys = [e.split('@')[0][len('contact'):] for e in query.get('email', []) if e.startswith('contact') and e.endswith('@example.com')]
+                indexes = [int(k) for k in keys if k.isdigit()]
+            else:
+                indexes = [int(v) - 1 for v in query.get('vid', []) if v.isdigit()]
+            contacts = {}
+            for i in set([i for i in indexes if i >= 0 and i < server.contacts.count]):
+                contacts[str(i + 1)] = select_properties(server.contacts.get(i, i + 1), query.get('property', []))[0]
+            return self.send_json(contacts)
+        if path == '/companies/v2/companies/paged':
+            limit = min(int(query.get('limit', ['100'])[0]), 250)
+            offset = int(query.get('offset', ['0'])[0])
+            companies = select_properties(server.companies.get(offset, offset + limit), query.get('properties', []))
+            return self.send_json({'companies': companies, 'has-more': offset + limit < server.companies.count, 'offset': offset + limit})
+        if path == '/engagements/v1/engagements/paged':
+            limit = min(int(query.get('limit', ['100'])[0]), 250)
+            offset = int(query.get('offset', ['0'])[0])
+            engagements = server.engagements.get(offset, offset + limit)
+            return self.send_json({'results': engagements, 'hasMore': offset + limit < server.engagements.count, 'offset': offset + limit})
+
+        return self.send_json({'status': 'error', 'message': 'Not found: ' + path}, 404)
+
+def start(config=None, port=0):
+
+    # start the server in a background thread and return it; the base url
+    # is 'http://127.0.0.1:' + str(server.server_port), and the records are
+    # in server.deals, server.contacts, server.companies and
+    # server.engagements
+    server = MockHubSpot(('127.0.0.1', port), config or {})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def add_arguments(parser):
+    parser.add_argument('--deals', type=int, default=DEFAULTS['deals'])
+    parser.add_argument('--contacts', type=int, default=DEFAULTS['contacts'])
+    parser.add_argument('--companies', type=int, default=DEFAULTS['companies'])
+    parser.add_argument('--engagements', type=int, default=DEFAULTS['engagements'])
+    parser.add_argument('--owners', type=int, default=DEFAULTS['owners'])
+    parser.add_argument('--latency', type=float, default=DEFAULTS['latency'], help='seconds added to each response')
+    parser.add_argument('--fail-every', type=int, default=DEFAULTS['fail_every'], help='return a 429 for every nth request')
+    parser.add_argument('--retry-after', type=int, default=DEFAULTS['retry_after'], help='the Retry-After of each 429')
+    parser.add_argument('--body-size', type=int, default=DEFAULTS['body_size'], help='characters in each engagement body')
+    parser.add_argument('--versions', type=int, default=DEFAULTS['versions'], help='versions in each property history')
+    parser.add_argument('--payloads', default=DEFAULTS['payloads'], help='directory of recorded payloads')
+
+def get_config(args):
+    return {k: getattr(args, k) for k in DEFAULTS.keys()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the HubSpot api')
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockHubSpot(('127.0.0.1', args.port), get_config(args))
+    print('serving on http://127.0.0.1:' + str(server.server_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
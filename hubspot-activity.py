@@ -8,12 +8,60 @@
 # params:
 #   - name: properties
 #     type: array
-#     description: The properties to return (defaults to all properties). See "Returns" for a listing of the available properties.
+#     description: The properties to return (defaults to all properties except company_names, which is only returned when it's listed). See "Returns" for a listing of the available properties.
 #     required: false
 #   - name: filter
 #     type: string
 #     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
 #     required: false
+#   - name: refresh
+#     type: boolean
+#     description: True to reload cached reference data, such as the list of owners, instead of using the cached copy; defaults to false
+#     required: false
+#   - name: incremental
+#     type: boolean
+#     description: True to keep a local copy of the activity and only fetch the engagements modified since the last call; defaults to false
+#     required: false
+#   - name: rebuild
+#     type: boolean
+#     description: True to rebuild the local copy of the activity from scratch before returning it; defaults to false
+#     required: false
+#   - name: run_id
+#     type: string
+#     description: An id for the call; if a call with the same id fails part way through, calling again with the id returns the rest of the activity rather than starting over
+#     required: false
+#   - name: format
+#     type: string
+#     description: The format of the output; one of 'json' (a JSON object per line), 'csv', 'arrow' (an Arrow IPC stream) or 'parquet'; defaults to 'json'; the arrow and parquet formats require pyarrow
+#     required: false
+#   - name: time_limit
+#     type: number
+#     description: The number of seconds the call can take; once the time is nearly up, the rows fetched so far are returned and calling again with the same run_id returns the rest; needs a run_id, except with hubspot_connections; can't be used with group_by, aggregate or top; defaults to no limit
+#     required: false
+#   - name: trace
+#     type: string
+#     description: Writes the time spent requesting, decoding, transforming and writing the pages to stderr after the output; one of 'summary' (a line with the totals) or 'json' (the totals and each page); defaults to false
+#     required: false
+#   - name: hubspot_connections
+#     type: array
+#     description: The connections of several portals to return the activity of in one call, rather than the one connection; the portals are read in parallel, each with its own rate limit, every row includes the portal_id, and a line for each portal with its status, row count and time is written to stderr; run_id and trace aren't used with several portals
+#     required: false
+#   - name: group_by
+#     type: array
+#     description: The properties to group the activity by (e.g. 'type' and 'activity_date:week', where dates can be bucketed by 'day', 'week', 'month' or 'year'); returns a row for each group with the group values and the aggregates rather than a row for each item
+#     required: false
+#   - name: aggregate
+#     type: array
+#     description: The aggregates to return for each group, or for all the activity if there's no group_by; each one of 'count', 'count(property)', 'sum(property)', 'min(property)' or 'max(property)' (e.g. 'count' or 'max(activity_date)'); returned as columns named like 'count' and 'max_activity_date'; defaults to 'count'
+#     required: false
+#   - name: top
+#     type: integer
+#     description: The number of rows (or groups) to return, ranked by top_by
+#     required: false
+#   - name: top_by
+#     type: string
+#     description: The property (or, with group_by, the group property or aggregate) to rank the rows by for top (e.g. 'activity_date' for the latest activity); ranks largest first unless prefixed with '-'; with group_by, defaults to the first aggregate
+#     required: false
 # returns:
 #   - name: portal_id
 #     type: integer
@@ -36,6 +84,9 @@
 #   - name: company_ids
 #     type: string
 #     description: A delimited list of company ids associated with the engagement
+#   - name: company_names
+#     type: string
+#     description: A delimited list of the names of the companies associated with the engagement; only returned when it's listed in the properties, and empty if the companies can't be read
 #   - name: type
 #     type: string
 #     description: The type of the engagement
@@ -71,26 +122,152 @@
 #   - '"*"'
 # ---
 
-import json
-import urllib
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from datetime import *
+import os
+import sys
+import time
+import urllib.parse
+import importlib.util
+import hashlib
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# the shared code is in hubspot_core.py next to this file (it's deployed
+# with the functions; see flexio.yml), which isn't on the path when the
+# function is loaded from its file; without the file's path, there's no
+# directory to look in and the import below fails as it would otherwise
+if importlib.util.find_spec('hubspot_core') is None and globals().get('__file__') is not None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hubspot_core import (
+    PAGE_PREFETCH_DEPTH, DATA_PATH, CACHE_TTL, is_request_error, has_optional,
+    get_checkpoint, split_mirror_filters, Mirror, get_page, PageSizer,
+    prefetch, get_writer, get_schema, get_aggregation, get_deadline,
+    until_deadline, requests_retry_session, get_trace, get_connections,
+    get_portal_data, print_portal_report, print_deadline_report,
+    get_rate_limiter, get_cache_key, get_owners, get_cache, to_date,
+    convert_dates, to_integer, get_columns, get_lookups, get_filters,
+    get_item_paths, get_predicate, get_extractor, get_date_indexes,
+)
+
+# the base url of the hubspot api; can be pointed at a local server, such as
+# the one in benchmarks/mock_hubspot.py
+API_BASE_URL = 'https://api.hubapi.com'
+
+# the paged engagements api is asked for at most PAGE_MAX_SIZE records a page
+# (its limit); see PageSizer in hubspot_core.py for how the size of each page
+# is chosen
+PAGE_MAX_SIZE = 250
+
+# company names are joined through an index of company id to name that's
+# filled in as engagements are read, COMPANY_BATCH_SIZE unknown ids to a
+# request, and kept in the reference cache between invocations; the index
+# holds at most COMPANY_INDEX_MAX_ENTRIES names, dropping the least recently
+# used first
+COMPANY_BATCH_SIZE = 100
+COMPANY_INDEX_MAX_ENTRIES = 100000
+
+# columns that are only returned when they're listed in the properties
+# param; the company names need requests of their own and a token that can
+# read companies
+OPTIONAL_COLUMNS = ['company_names']
+
+# with the incremental param, the activity of each portal is mirrored in a
+# local sqlite database and only the engagements modified since the last
+# sync are fetched; a mirror synced within MIRROR_MAX_STALENESS seconds is
+# read without calling hubspot at all; hubspot only lists the engagements
+# modified in the last 30 days (and at most MIRROR_RECENT_LIMIT of them), so
+# a mirror last synced before then is rebuilt with a full sync, as is any
+# mirror older than MIRROR_MAX_AGE so deleted engagements are dropped;
+# filters on the columns in MIRROR_INDEXES use an index
+MIRROR_PATH = os.path.join(DATA_PATH, 'activity.sqlite') # see DATA_PATH in hubspot_core.py
+MIRROR_MAX_STALENESS = 300
+MIRROR_MAX_AGE = 7*86400
+MIRROR_RECENT_WINDOW = 29*86400
+MIRROR_RECENT_LIMIT = 10000
+MIRROR_OVERLAP = 300
+MIRROR_INDEXES = ['owner_id', 'activity_date']
+MIRROR_BOOLEANS = ['active'] # sqlite stores booleans as 1 and 0
 
 # main function entry point
 def flexio_handler(flex):
 
-    flex.output.content_type = 'application/x-ndjson'
-    for data in get_data(flex.vars):
-        flex.output.write(data)
+    # with the group_by, aggregate or top params, the rows are summarized
+    # before they're written; only the columns the summary needs are read
+    params = flex.vars
+    schema = get_schema(globals().get('__file__'), COLUMNS)
+    columns = get_columns(COLUMNS, dict(params).get('properties'), OPTIONAL_COLUMNS)
+    types = None
+    aggregation = get_aggregation(params, columns, COLUMNS, schema)
+    if aggregation is not None:
+        params = dict(params, properties=aggregation.input_columns)
+        columns, types = aggregation.columns, aggregation.types
 
-def get_data(params):
+    # with the hubspot_connections param, the rows of all the portals are
+    # returned together, so each row includes its portal id; the columns are
+    # passed on by name since the portals' default columns leave out the
+    # optional ones
+    connections = get_connections(params)
+    if len(connections) > 0 and aggregation is None:
+        if 'portal_id' not in columns:
+            columns = ['portal_id'] + columns
+        params = dict(params, properties=columns)
+
+    # a summary isn't complete until all the rows are read and the portals
+    # don't share a cursor, so neither is checkpointed
+    writer = get_writer(dict(params).get('format'), flex.output, columns, types or schema)
+    deadline = get_deadline(params)
+    checkpoint = None
+    if aggregation is None and len(connections) == 0:
+        checkpoint = get_checkpoint(params, 'hubspot-activity', writer.flush, deadline)
+    trace = get_trace(params, 'hubspot-activity') if len(connections) == 0 else None
+    report = []
+    if len(connections) > 0:
+        rows = get_portal_data(params, connections, COLUMNS, get_data, deadline, report)
+    else:
+        rows = get_data(params, checkpoint=checkpoint, trace=trace, deadline=deadline)
+    if aggregation is not None:
+        rows = aggregation.apply(rows)
+    if trace is None:
+        for row in rows:
+            writer.write(row)
+        writer.close()
+    else:
+        # with a trace, the time spent writing each row is counted against
+        # the page it came from
+        for row in rows:
+            started = time.perf_counter()
+            writer.write(row)
+            trace.write(time.perf_counter() - started)
+        started = time.perf_counter()
+        writer.close()
+        trace.write(time.perf_counter() - started)
+        trace.close()
+
+    print_portal_report('hubspot-activity', report)
+
+    print_deadline_report('hubspot-activity', deadline)
+
+def get_data(params, session=None, checkpoint=None, trace=None, deadline=None):
 
     # get the api key from the variable input
     auth_token = dict(params).get('hubspot_connection',{}).get('access_token')
 
+    # use one session for the owner, pipeline and paged requests; callers can
+    # pass in their own session to inspect it with get_connection_stats()
+    # callers can pass in a deadline to see whether the call stopped at the
+    # time limit; a session passed in keeps its own timeouts
+    if deadline is None:
+        deadline = get_deadline(params)
+    session = session or requests_retry_session(limiter=get_rate_limiter(auth_token), deadline=deadline)
+
+    # requests made with the session are recorded by the trace, if any
+    session.trace = trace
+    if trace is not None:
+        trace.session = session
+
+    # reference data is cached per token; the refresh param reloads it
+    refresh = str(dict(params).get('refresh', False)).lower() == 'true'
+
     # see here for more info:
     # https://developers.hubspot.com/docs/methods/engagements/get-all-engagements
     # https://developers.hubspot.com/docs/methods/engagements/engagements-overview
@@ -100,128 +277,444 @@ def get_data(params):
     # https://developers.hubspot.com/docs/methods/owners/owners_overview
     # https://developers.hubspot.com/docs/methods/owners/get_owners
 
-    # STEP 1: get the owner info
     headers = {
         'Authorization': 'Bearer ' + auth_token,
     }
-    url = 'https://api.hubapi.com/owners/v2/owners'
-    url_query_params = {'includeInactive': True}
-    url_query_str = urllib.parse.urlencode(url_query_params)
 
-    page_url = url + '?' + url_query_str
-    response = requests_retry_session().get(page_url, headers=headers)
+    # the engagements api can't filter, so filters are checked on each row
+    # before it's written; incremental calls read the activity from the
+    # mirror instead, where filters on indexed columns are applied by the
+    # query
+    rebuild = str(dict(params).get('rebuild', False)).lower() == 'true'
+    incremental = rebuild or str(dict(params).get('incremental', False)).lower() == 'true'
+    filters = get_filters(COLUMNS, dict(params).get('filter'))
+    mirror_filters, local_filters = OrderedDict(), filters
+    if incremental is True:
+        mirror_filters, local_filters = split_mirror_filters(filters, MIRROR_INDEXES)
+
+    # a checkpoint from an earlier call with the same run id picks up after
+    # the last page that call returned; calls reading the mirror read all of
+    # it each time, so they aren't checkpointed
+    page_cursor_id = None
+    if incremental is True:
+        checkpoint = None
+    if checkpoint is not None:
+        page_cursor_id = checkpoint.state['page_cursor_id']
+
+    # only build the columns being returned or filtered and only look up
+    # owners or companies if an owner or company name is needed; the
+    # filtered columns are built after the returned columns and trimmed off
+    # each row
+    columns = get_columns(COLUMNS, dict(params).get('properties'), OPTIONAL_COLUMNS)
+    filter_columns = [c for c in local_filters.keys() if c not in columns]
+    predicate = get_predicate(local_filters, columns + filter_columns)
+    lookups = get_lookups(COLUMNS, columns + filter_columns) if incremental is False else set()
+
+    # with numpy, date columns are converted a page at a time
+    vectorized = has_optional('numpy')
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, columns + filter_columns, vectorized)
+    date_indexes = get_date_indexes(COLUMNS, columns + filter_columns) if vectorized else []
+
+    # STEP 1: start the owner request; it doesn't depend on the engagement
+    # pages, so it runs alongside the first engagement page request and is
+    # only joined when the first page is transformed
+    executor = ThreadPoolExecutor(max_workers=1)
+    owners_future = None
+    if 'owners' in lookups:
+        owners_future = executor.submit(get_owners, session, API_BASE_URL, headers, get_cache_key(auth_token, 'owners'), refresh)
+    executor.shutdown(wait=False)
+
+    # STEP 2: get the engagement info; the names of the companies on each
+    # page are looked up as the page is fetched, so the lookups are made
+    # ahead of the page being transformed along with the page requests
+    company_index = None
+    if incremental is True:
+        pages = get_mirror_pages(session, headers, auth_token, columns + filter_columns, mirror_filters, rebuild, refresh)
+    else:
+        url = API_BASE_URL + '/engagements/v1/engagements/paged'
+        pages = get_pages(session, url, headers, page_cursor_id, get_item_paths(COLUMNS, columns + filter_columns, ITEM_PATHS))
+        if 'companies' in lookups:
+            company_index = get_company_index(session, headers, auth_token, refresh)
+            pages = company_index.resolve_pages(pages)
+
+    # fetch the pages in a background thread so the next page is on its way
+    # while the current page is being transformed and written; this matters
+    # most here since each engagement fans out into a row per deal
+    if trace is not None:
+        pages = trace.track(pages)
+    pages = prefetch(pages, PAGE_PREFETCH_DEPTH)
+    if deadline is not None:
+        pages = until_deadline(pages, deadline)
+    for data, page_cursor_id in pages:
+
+        if trace is not None:
+            trace.start_page()
+
+        if incremental is True:
+            # rows read from the mirror are already built
+            rows = data
+        else:
+            owners = owners_future.result() if owners_future is not None else {}
+            companies = company_index.get_names(data) if company_index is not None else {}
+            started = time.perf_counter() if trace is not None else None
+            rows = []
+            for item in data:
+                for deal_id in get_deal_ids(item):
+                    rows.append(extract(item, deal_id, owners, companies))
+            rows = convert_dates(rows, date_indexes)
+            if trace is not None:
+                trace.transformed(time.perf_counter() - started)
+
+        count = 0
+        for row in rows:
+            if predicate is not None and not predicate(row):
+                continue
+            if len(filter_columns) > 0:
+                row = row[:len(columns)]
+            count += 1
+            yield row
+
+        if trace is not None:
+            trace.emitted(count)
+        if checkpoint is not None:
+            checkpoint.save(page_cursor_id, count)
+
+    if company_index is not None:
+        company_index.save()
+
+def get_deal_ids(item):
+    deal_ids = item.get('associations',{}).get('dealIds')
+    if deal_ids is None or len(deal_ids) == 0:
+        deal_ids = [None] # if no deals, use empty deal so we return activity information
+    return deal_ids
+
+def get_company_ids(item):
+    return item.get('associations',{}).get('companyIds') or []
+
+def get_company_index(session, headers, auth_token, refresh=False):
+    return CompanyIndex(session, headers, get_cache_key(auth_token, 'companies'), refresh)
+
+class CompanyIndex(object):
+
+    # a bounded map of company id to company name, shared by the pages of an
+    # invocation; it's loaded from the reference cache when first used and
+    # written back by save() if any names were added; companies that can't
+    # be found are kept with an empty name so they aren't asked for again;
+    # if the companies can't be read at all (such as with a token without
+    # the scope to read them), the names are left empty and, since they may
+    # be readable later, aren't kept
+
+    def __init__(self, session, headers, cache_key, refresh=False):
+        self.session = session
+        self.headers = headers
+        self.cache_key = cache_key
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.names = None
+        self.changed = False
+        self.failed = False
+
+    def load(self):
+        # called with the lock held
+        if self.names is not None:
+            return
+        self.names = OrderedDict()
+        cached = get_cache().get(self.cache_key) if self.refresh is False else None
+        for company_id, name in cached or []:
+            self.names[company_id] = name
+
+    def resolve(self, company_ids):
+        # return the names of the ids, looking up the ones that aren't in
+        # the index
+        names = {}
+        with self.lock:
+            self.load()
+            for i in company_ids:
+                if i in self.names:
+                    self.names.move_to_end(i)
+                    names[i] = self.names[i]
+        missing = list(OrderedDict.fromkeys([i for i in company_ids if i not in names]))
+        for start in range(0, len(missing), COMPANY_BATCH_SIZE):
+            batch = missing[start:start + COMPANY_BATCH_SIZE]
+            found = self.fetch(batch)
+            if found is None:
+                names.update([(company_id, '') for company_id in batch])
+                continue
+            with self.lock:
+                for company_id in batch:
+                    names[company_id] = found.get(company_id, '')
+                    self.names[company_id] = names[company_id]
+                while len(self.names) > COMPANY_INDEX_MAX_ENTRIES:
+                    self.names.popitem(last=False)
+                self.changed = True
+        return names
+
+    def fetch(self, company_ids):
+        # the names of the companies, or None if they can't be read; after
+        # the first failure, the rest of the invocation doesn't try again
+        if self.failed is True:
+            return None
+        try:
+            return get_company_names(self.session, self.headers, company_ids)
+        except Exception as e:
+            if not is_request_error(e):
+                raise
+            self.failed = True
+            return None
+
+    def resolve_pages(self, pages):
+        # iterated in the prefetch thread so the lookups for a page are made
+        # before the page is transformed
+        for data, page_cursor_id in pages:
+            self.resolve([i for item in data for i in get_company_ids(item)])
+            yield data, page_cursor_id
+
+    def get_names(self, data):
+        # the names of the companies of each engagement in the page, keyed
+        # the way the company_ids column is built; ids dropped from a full
+        # index since the page was fetched are looked up again
+        company_ids = [get_company_ids(item) for item in data]
+        names = self.resolve([i for ids in company_ids for i in ids])
+        companies = {}
+        for ids in company_ids:
+            companies[to_id_list(ids)] = {'names': ', '.join([names[i] for i in ids if len(names[i]) > 0])}
+        return companies
+
+    def save(self):
+        with self.lock:
+            if self.changed is False:
+                return
+            get_cache().set(self.cache_key, [[k, v] for k, v in self.names.items()], CACHE_TTL)
+            self.changed = False
+
+def get_company_names(session, headers, company_ids):
+
+    # see here for more info:
+    # https://developers.hubspot.com/docs/api/crm/companies
+    # note: ids without a company are left out of the results
+    url = API_BASE_URL + '/crm/v3/objects/companies/batch/read'
+    body = {
+        'properties': ['name'],
+        'inputs': [{'id': str(i)} for i in company_ids],
+    }
+
+    trace = getattr(session, 'trace', None)
+    started = time.perf_counter() if trace is not None else None
+    response = session.post(url, headers=headers, json=body)
+    received = time.perf_counter() if trace is not None else None
     response.raise_for_status()
     content = response.json()
-    data = content
+    if trace is not None:
+        trace.request(response, started, received)
 
-    owners = {}
-    for item in data:
-        owners[item.get('ownerId')] = item
+    names = {}
+    for result in content.get('results',[]):
+        names[to_integer(result.get('id'))] = (result.get('properties') or {}).get('name') or ''
+    return names
 
-    # STEP 3: get the engagement info
-    headers = {
-        'Authorization': 'Bearer ' + auth_token,
-    }
-    url = 'https://api.hubapi.com/engagements/v1/engagements/paged'
+def get_pages(session, url, headers, page_cursor_id=None, paths=None):
 
-    page_size = 250
-    page_cursor_id = None
+    # yields each page along with the cursor for the page after it, or None
+    # after the last page, so a caller can pick up from where it left off;
+    # the size of each page is chosen by a PageSizer
+    sizer = PageSizer(PAGE_MAX_SIZE)
     while True:
 
-        url_query_params = {'limit': page_size}
+        url_query_params = {'limit': sizer.size}
         if page_cursor_id is not None:
             url_query_params['offset'] = page_cursor_id
         url_query_str = urllib.parse.urlencode(url_query_params)
 
         page_url = url + '?' + url_query_str
-        response = requests_retry_session().get(page_url, headers=headers)
-        response.raise_for_status()
-        content = response.json()
-        data = content.get('results',[])
+        try:
+            content, data = get_page(session, page_url, headers, 'results', paths, sizer)
+        except Exception as e:
+            if sizer.retry(e) is False:
+                raise
+            continue
 
         if len(data) == 0: # sanity check in case there's an issue with cursor
             break
 
-        buffer = ''
-        for header_item in data:
-            deal_items = header_item.get('associations',{}).get('dealIds')
-            if deal_items is None or len(deal_items) == 0:
-                deal_items = [None] # if no deals, use empty deal so we return activity information
-            for deal_id in deal_items:
-                detail_item = {'deal_id': deal_id}
-                item = get_item_info(header_item, detail_item, owners)
-                buffer = buffer + json.dumps(item, default=to_string) + "\n"
-        yield buffer
-
+        page_cursor_id = content.get('offset')
         has_more = content.get('hasMore', False)
         if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None:
+            break
+
+def get_recent_pages(session, url, headers, since, paths=None):
+
+    # see here for more info:
+    # https://developers.hubspot.com/docs/methods/engagements/get-recent-engagements
+    # note: engagements are returned most recently modified first and only
+    # the first MIRROR_RECENT_LIMIT can be paged through; like get_pages(),
+    # each page is yielded with the cursor for the page after it, so a
+    # cursor other than None after the last page means some engagements were
+    # left out
+
+    page_size = 100
+    page_cursor_id = None
+    while True:
+
+        url_query_params = {'count': page_size, 'since': since}
+        if page_cursor_id is not None:
+            url_query_params['offset'] = page_cursor_id
+        url_query_str = urllib.parse.urlencode(url_query_params)
+
+        page_url = url + '?' + url_query_str
+        content, data = get_page(session, page_url, headers, 'results', paths)
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
             break
 
         page_cursor_id = content.get('offset')
+        has_more = content.get('hasMore', False)
+        if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None or page_cursor_id + page_size > MIRROR_RECENT_LIMIT:
+            break
+
+def get_mirror_pages(session, headers, auth_token, columns, filters, rebuild=False, refresh=False):
+
+    # bring the mirror of the portal's activity up to date and then read the
+    # columns of the matching rows back from it a page of rows at a time
+    key = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+    mirror = Mirror(MIRROR_PATH, 'engagements', get_columns(COLUMNS, None, OPTIONAL_COLUMNS), MIRROR_INDEXES, MIRROR_BOOLEANS)
+    sync_mirror(session, headers, mirror, key, auth_token, rebuild, refresh)
+    if 'company_names' not in columns:
+        for rows in mirror.read(key, columns, filters):
+            yield rows, None
+        return
+
+    # the company names aren't mirrored, so they're looked up from the
+    # company ids of the rows as they're read
+    names_index = columns.index('company_names')
+    read_columns = columns[:names_index] + ['company_ids'] + columns[names_index+1:]
+    company_index = get_company_index(session, headers, auth_token, refresh)
+    for rows in mirror.read(key, read_columns, filters):
+        company_ids = [to_integer_list(row[names_index]) for row in rows]
+        names = company_index.resolve([i for ids in company_ids for i in ids])
+        rows = [
+            row[:names_index] + (', '.join([names[i] for i in ids if len(names[i]) > 0]),) + row[names_index+1:]
+            for row, ids in zip(rows, company_ids)
+        ]
+        yield rows, None
+    company_index.save()
+
+def sync_mirror(session, headers, mirror, key, auth_token, rebuild=False, refresh=False):
 
-def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(429, 500, 502, 503, 504),
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
+    # the sync state holds the high-water mark (the latest lastUpdated in the
+    # mirror), the time of the last sync and, while a full sync is underway,
+    # the cursor (offset) of the next page so an interrupted full sync picks
+    # up where it stopped
+    now = time.time()
+    state = mirror.get_state(key) if rebuild is False else None
+    if state is not None and state['complete'] is True and now - state['synced_at'] < MIRROR_MAX_STALENESS:
+        return
+
+    # rows are built with the mirror's columns, so the owners are needed;
+    # the names are those at the time an engagement is synced
+    owners = get_owners(session, API_BASE_URL, headers, get_cache_key(auth_token, 'owners'), refresh)
+    columns = get_columns(COLUMNS, None, OPTIONAL_COLUMNS)
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, columns)
+    paths = get_item_paths(COLUMNS, columns, ITEM_PATHS)
+    def get_rows(data):
+        rows = []
+        for item in data:
+            for deal_id in get_deal_ids(item):
+                rows.append((get_engagement_id(item), get_modified(item), extract(item, deal_id, owners, {})))
+        return rows
+
+    full_sync = (
+        state is None or
+        state['complete'] is False or
+        now - state['full_sync_started'] > MIRROR_MAX_AGE or
+        now - state['synced_at'] > MIRROR_RECENT_WINDOW
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-def to_date(ts):
-    if ts is None or ts == '':
-        return ''
-    return datetime.utcfromtimestamp(int(ts)/1000).strftime('%Y-%m-%dT%H:%M:%S')
-
-def to_integer(value):
-    try:
-        return int(value)
-    except:
-        return value
-
-def to_string(value):
-    if isinstance(value, (date, datetime)):
-        return value.isoformat()
-    if isinstance(value, (Decimal)):
-        return str(value)
-    return value
-
-def get_item_info(header_item, detail_item, owners):
-
-    info = OrderedDict()
-
-    info['portal_id'] = to_integer(header_item.get('engagement',{}).get('portalId'))
-
-    owner_id = to_integer(header_item.get('engagement',{}).get('ownerId'))
-    info['owner_id'] = owner_id
-    info['owner_first_name'] = owners.get(owner_id,{}).get('firstName')
-    info['owner_last_name'] = owners.get(owner_id,{}).get('lastName')
-
-    info['engagement_id'] = to_integer(header_item.get('engagement',{}).get('id'))
-    info['deal_id'] = to_integer(detail_item.get('deal_id',None))
-
-    company_ids = header_item.get('associations',{}).get('companyIds',[])
-    info['company_ids'] = ', '.join([str(i) for i in company_ids]) # convert to comma-delimited string
-
-    info['type'] = header_item.get('engagement',{}).get('type','').lower()
-    info['activity_type'] = header_item.get('engagement',{}).get('activityType','')
-    info['activity_date'] = to_date(header_item.get('engagement',{}).get('timestamp',None))
-    info['status'] = header_item.get('metadata',{}).get('status','')
-    info['title'] = header_item.get('metadata',{}).get('title','')
-    info['subject'] = header_item.get('metadata',{}).get('subject','')
-    info['active'] = header_item.get('engagement',{}).get('active','')
-    info['created_by'] = to_integer(header_item.get('engagement',{}).get('createdBy'))
-    info['created_at'] = to_date(header_item.get('engagement',{}).get('createdAt',None))
-    info['updated_at'] = to_date(header_item.get('engagement',{}).get('lastUpdated',None))
-
-    return info
+
+    if full_sync is False:
+        # recently modified engagements are listed newest first, so the
+        # high-water mark is only moved once all the changes are saved
+        url = API_BASE_URL + '/engagements/v1/engagements/recent/modified'
+        since = state['high_water_mark'] - MIRROR_OVERLAP*1000
+        high_water_mark = state['high_water_mark']
+        page_cursor_id = None
+        for data, page_cursor_id in get_recent_pages(session, url, headers, since, paths):
+            high_water_mark = max([high_water_mark] + [get_modified(item) for item in data])
+            mirror.save(key, get_rows(data), state, now)
+        if page_cursor_id is None:
+            state['high_water_mark'] = high_water_mark
+            state['synced_at'] = now
+            mirror.save(key, [], state, now)
+            return
+        # more engagements were modified than can be listed, so fall through
+        # to a full sync
+
+    if state is None or state['complete'] is True or now - state['full_sync_started'] > MIRROR_MAX_AGE:
+        state = {'complete': False, 'full_sync_started': now, 'synced_at': now, 'high_water_mark': 0, 'page_cursor_id': None}
+
+    # rows saved by this full sync are marked with the time it started; rows
+    # left from before then are deleted once it completes
+    url = API_BASE_URL + '/engagements/v1/engagements/paged'
+    for data, page_cursor_id in get_pages(session, url, headers, state['page_cursor_id'], paths):
+        state['high_water_mark'] = max([state['high_water_mark']] + [get_modified(item) for item in data])
+        state['page_cursor_id'] = page_cursor_id
+        mirror.save(key, get_rows(data), state, state['full_sync_started'])
+    mirror.finish(key, state)
+
+def get_engagement_id(item):
+    return item.get('engagement',{}).get('id')
+
+def get_modified(item):
+    value = to_integer(item.get('engagement',{}).get('lastUpdated'))
+    return value if isinstance(value, int) else 0
+
+def to_id_list(ids):
+    return ', '.join([str(i) for i in ids]) # convert to comma-delimited string
+
+def to_integer_list(value):
+    return [to_integer(i) for i in value.split(', ')] if value else [] # the reverse of to_id_list()
+
+def to_lower(value):
+    return value.lower()
+
+# paths within each engagement that are read outside of the columns, such
+# as the deals each engagement is fanned out to
+ITEM_PATHS = ['engagement.id', 'engagement.lastUpdated', 'associations.dealIds']
+
+# the output schema; each column is built by following its source path from
+# the extractor's arguments (the engagement, the deal the row is for and the
+# owner and company lookups) and converting the value, with the default used
+# when the last key in the path is missing; see parse_source() for the path
+# syntax
+EXTRACTOR_ARGS = ['item', 'deal_id', 'owners', 'companies']
+COLUMNS = OrderedDict([
+    ('portal_id',        ('item.engagement.portalId', to_integer, None)),
+    ('owner_id',         ('item.engagement.ownerId', to_integer, None)),
+    ('owner_first_name', ('owners[owner_id].firstName', None, None)),
+    ('owner_last_name',  ('owners[owner_id].lastName', None, None)),
+    ('engagement_id',    ('item.engagement.id', to_integer, None)),
+    ('deal_id',          ('deal_id', to_integer, None)),
+    ('company_ids',      ('item.associations.companyIds', to_id_list, [])),
+    ('company_names',    ('companies[company_ids].names', None, '')),
+    ('type',             ('item.engagement.type', to_lower, '')),
+    ('activity_type',    ('item.engagement.activityType', None, '')),
+    ('activity_date',    ('item.engagement.timestamp', to_date, None)),
+    ('status',           ('item.metadata.status', None, '')),
+    ('title',            ('item.metadata.title', None, '')),
+    ('subject',          ('item.metadata.subject', None, '')),
+    ('active',           ('item.engagement.active', None, '')),
+    ('created_by',       ('item.engagement.createdBy', to_integer, None)),
+    ('created_at',       ('item.engagement.createdAt', to_date, None)),
+    ('updated_at',       ('item.engagement.lastUpdated', to_date, None)),
+])
+
+# compile the extractor for all the columns when the function is loaded
+get_extractor(COLUMNS, EXTRACTOR_ARGS, list(COLUMNS.keys()))
@@ -0,0 +1,418 @@
+# ---
+# name: hubspot-companies
+# deployed: true
+# config: index
+# title: HubSpot Companies
+# description: Returns a list of companies from HubSpot
+# params:
+#   - name: properties
+#     type: array
+#     description: The properties to return (defaults to all properties). See "Returns" for a listing of the available properties.
+#     required: false
+#   - name: filter
+#     type: string
+#     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
+#     required: false
+#   - name: refresh
+#     type: boolean
+#     description: True to reload cached reference data, such as the list of owners, instead of using the cached copy; defaults to false
+#     required: false
+#   - name: run_id
+#     type: string
+#     description: An id for the call; if a call with the same id fails part way through, calling again with the id returns the rest of the companies rather than starting over
+#     required: false
+#   - name: format
+#     type: string
+#     description: The format of the output; one of 'json' (a JSON object per line), 'csv', 'arrow' (an Arrow IPC stream) or 'parquet'; defaults to 'json'; the arrow and parquet formats require pyarrow, and type the number properties, such as annual_revenue, as 64-bit floats
+#     required: false
+#   - name: time_limit
+#     type: number
+#     description: The number of seconds the call can take; once the time is nearly up, the rows fetched so far are returned and calling again with the same run_id returns the rest; needs a run_id; defaults to no limit
+#     required: false
+#   - name: trace
+#     type: string
+#     description: Writes the time spent requesting, decoding, transforming and writing the pages to stderr after the output; one of 'summary' (a line with the totals) or 'json' (the totals and each page); defaults to false
+#     required: false
+# returns:
+#   - name: portal_id
+#     type: integer
+#     description: The portal id for the company
+#   - name: company_id
+#     type: integer
+#     description: The company id for the company
+#   - name: name
+#     type: string
+#     description: The company name
+#   - name: domain
+#     type: string
+#     description: The domain name of the company
+#   - name: website
+#     type: string
+#     description: The website of the company
+#   - name: industry
+#     type: string
+#     description: The industry the company belongs to
+#   - name: type
+#     type: string
+#     description: The type of company
+#   - name: phone
+#     type: string
+#     description: The phone number of the company
+#   - name: address
+#     type: string
+#     description: The street address of the company
+#   - name: city
+#     type: string
+#     description: The city of the company
+#   - name: state
+#     type: string
+#     description: The state or region of the company
+#   - name: zip
+#     type: string
+#     description: The postal code of the company
+#   - name: country
+#     type: string
+#     description: The country of the company
+#   - name: description
+#     type: string
+#     description: The company description
+#   - name: number_of_employees
+#     type: integer
+#     description: The number of employees of the company
+#   - name: annual_revenue
+#     type: number
+#     description: The annual revenue of the company
+#   - name: owner_id
+#     type: integer
+#     description: The id of the owner of the company
+#   - name: owner_first_name
+#     type: string
+#     description: The first name of the owner of the company
+#   - name: owner_last_name
+#     type: string
+#     description: The last name of the owner of the company
+#   - name: lifecycle_stage
+#     type: string
+#     description: The lifecycle stage of the company
+#   - name: num_associated_contacts
+#     type: integer
+#     description: The number of associated contacts
+#   - name: num_associated_deals
+#     type: integer
+#     description: The number of associated deals
+#   - name: created_at
+#     type: string
+#     description: The date the company was added to the system
+#   - name: updated_at
+#     type: string
+#     description: The date the company was last modified
+# examples:
+#   - ' '
+# ---
+
+import os
+import sys
+import time
+import urllib.parse
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# the shared code is in hubspot_core.py next to this file (it's deployed
+# with the functions; see flexio.yml), which isn't on the path when the
+# function is loaded from its file; without the file's path, there's no
+# directory to look in and the import below fails as it would otherwise
+if importlib.util.find_spec('hubspot_core') is None and globals().get('__file__') is not None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hubspot_core import (
+    PAGE_PREFETCH_DEPTH, has_optional, get_checkpoint, get_page, PageSizer,
+    prefetch, is_over_search_limit, get_search_pages, get_writer, get_schema,
+    get_deadline, until_deadline, requests_retry_session, get_trace,
+    print_deadline_report, get_rate_limiter, get_cache_key, get_owners,
+    get_portal_id, to_date, convert_dates, from_iso_date, to_integer,
+    get_columns, get_request_properties, get_lookups, get_filters,
+    split_filters, get_item_paths, get_predicate, get_extractor,
+    get_date_indexes,
+)
+
+# the base url of the hubspot api; can be pointed at a local server, such as
+# the one in benchmarks/mock_hubspot.py
+API_BASE_URL = 'https://api.hubapi.com'
+
+# the paged companies api is asked for at most PAGE_MAX_SIZE records a page
+# (its limit); see PageSizer in hubspot_core.py for how the size of each page
+# is chosen
+PAGE_MAX_SIZE = 250
+
+# main function entry point
+def flexio_handler(flex):
+
+    columns = get_columns(COLUMNS, dict(flex.vars).get('properties'))
+    writer = get_writer(dict(flex.vars).get('format'), flex.output, columns, get_schema(globals().get('__file__'), COLUMNS))
+    deadline = get_deadline(flex.vars)
+    checkpoint = get_checkpoint(flex.vars, 'hubspot-companies', writer.flush, deadline)
+    trace = get_trace(flex.vars, 'hubspot-companies')
+    if trace is None:
+        for row in get_data(flex.vars, checkpoint=checkpoint, deadline=deadline):
+            writer.write(row)
+        writer.close()
+    else:
+        # with a trace, the time spent writing each row is counted against
+        # the page it came from
+        for row in get_data(flex.vars, checkpoint=checkpoint, trace=trace, deadline=deadline):
+            started = time.perf_counter()
+            writer.write(row)
+            trace.write(time.perf_counter() - started)
+        started = time.perf_counter()
+        writer.close()
+        trace.write(time.perf_counter() - started)
+        trace.close()
+
+    print_deadline_report('hubspot-companies', deadline)
+
+def get_data(params, session=None, checkpoint=None, trace=None, deadline=None):
+
+    # get the api key from the variable input
+    auth_token = dict(params).get('hubspot_connection',{}).get('access_token')
+
+    # use one session for the owner, portal and paged requests; callers can
+    # pass in their own session to inspect it with get_connection_stats()
+    # callers can pass in a deadline to see whether the call stopped at the
+    # time limit; a session passed in keeps its own timeouts
+    if deadline is None:
+        deadline = get_deadline(params)
+    session = session or requests_retry_session(limiter=get_rate_limiter(auth_token), deadline=deadline)
+
+    # requests made with the session are recorded by the trace, if any
+    session.trace = trace
+    if trace is not None:
+        trace.session = session
+
+    # reference data is cached per token; the refresh param reloads it
+    refresh = str(dict(params).get('refresh', False)).lower() == 'true'
+
+    # see here for more info:
+    # https://knowledge.hubspot.com/companies/hubspot-crm-default-company-properties
+    # https://developers.hubspot.com/docs/methods/companies/get-all-companies
+
+    # see here to get all available company properties:
+    # https://developers.hubspot.com/docs/methods/companies/get_company_properties
+
+    # see here to get owner information:
+    # https://developers.hubspot.com/docs/methods/owners/owners_overview
+    # https://developers.hubspot.com/docs/methods/owners/get_owners
+
+    headers = {
+        'Authorization': 'Bearer ' + auth_token,
+    }
+
+    # filters on company properties are sent to the search api so only the
+    # matching companies are returned; the rest are checked on each row
+    # before it's written
+    filters = get_filters(COLUMNS, dict(params).get('filter'))
+    search_filters, local_filters = split_filters(filters, SEARCH_PROPERTIES)
+
+    # a search can only page through SEARCH_RESULT_LIMIT companies, so when
+    # more match the search filters, all the companies are paged through and
+    # every filter is checked on each row instead
+    if len(search_filters) > 0:
+        url = API_BASE_URL + '/crm/v3/objects/companies/search'
+        if is_over_search_limit(session, url, headers, search_filters):
+            search_filters, local_filters = [], filters
+
+    # a checkpoint from an earlier call with the same run id picks up after
+    # the last page that call returned
+    page_cursor_id = None
+    if checkpoint is not None:
+        page_cursor_id = checkpoint.state['page_cursor_id']
+
+    # only request the company properties and lookups needed for the columns
+    # being returned and the columns being filtered locally; the filtered
+    # columns are built after the returned columns and trimmed off each row
+    columns = get_columns(COLUMNS, dict(params).get('properties'))
+    filter_columns = [c for c in local_filters.keys() if c not in columns]
+    predicate = get_predicate(local_filters, columns + filter_columns)
+
+    # with numpy, date columns are converted a page at a time
+    vectorized = has_optional('numpy')
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, columns + filter_columns, vectorized)
+    date_indexes = get_date_indexes(COLUMNS, columns + filter_columns) if vectorized else []
+    request_properties = get_request_properties(COLUMNS, columns + filter_columns)
+    lookups = get_lookups(COLUMNS, columns + filter_columns)
+    if len(search_filters) > 0 and 'portal_id' in columns + filter_columns:
+        lookups.add('portal') # search results don't include the portal id
+
+    # STEP 1: start the owner and portal requests; these don't depend on the
+    # company pages, so they run alongside the first company page request
+    # and are only joined when the first page is transformed
+    executor = ThreadPoolExecutor(max_workers=2)
+    owners_future, portal_future = None, None
+    if 'owners' in lookups:
+        owners_future = executor.submit(get_owners, session, API_BASE_URL, headers, get_cache_key(auth_token, 'owners'), refresh)
+    if 'portal' in lookups:
+        portal_future = executor.submit(get_portal_id, session, API_BASE_URL, headers, get_cache_key(auth_token, 'portal'), refresh)
+    executor.shutdown(wait=False)
+
+    # STEP 2: get the company info
+    if len(search_filters) > 0:
+        url = API_BASE_URL + '/crm/v3/objects/companies/search'
+        pages = get_search_pages(session, url, headers, request_properties, search_filters, get_search_item, page_cursor_id)
+    else:
+        url = API_BASE_URL + '/companies/v2/companies/paged'
+        pages = get_pages(session, url, headers, request_properties, page_cursor_id, get_item_paths(COLUMNS, columns + filter_columns, ITEM_PATHS))
+
+    # fetch the pages in a background thread so the next page is on its way
+    # while the current page is being transformed and written
+    if trace is not None:
+        pages = trace.track(pages)
+    pages = prefetch(pages, PAGE_PREFETCH_DEPTH)
+    if deadline is not None:
+        pages = until_deadline(pages, deadline)
+    for data, page_cursor_id in pages:
+
+        if trace is not None:
+            trace.start_page()
+
+        owners = owners_future.result() if owners_future is not None else {}
+        portal_id = portal_future.result() if portal_future is not None else None
+
+        if portal_id is not None:
+            for item in data:
+                item['portalId'] = portal_id
+
+        started = time.perf_counter() if trace is not None else None
+        rows = convert_dates([extract(item, owners) for item in data], date_indexes)
+        if trace is not None:
+            trace.transformed(time.perf_counter() - started)
+
+        count = 0
+        for row in rows:
+            if predicate is not None and not predicate(row):
+                continue
+            if len(filter_columns) > 0:
+                row = row[:len(columns)]
+            count += 1
+            yield row
+
+        if trace is not None:
+            trace.emitted(count)
+        if checkpoint is not None:
+            checkpoint.save(page_cursor_id, count)
+
+def get_pages(session, url, headers, request_properties, page_cursor_id=None, paths=None):
+
+    # yields each page along with the cursor for the page after it, or None
+    # after the last page, so a caller can pick up from where it left off;
+    # the size of each page is chosen by a PageSizer
+    sizer = PageSizer(PAGE_MAX_SIZE)
+    while True:
+
+        url_query_params = {'limit': sizer.size}
+        if page_cursor_id is not None:
+            url_query_params['offset'] = page_cursor_id
+        url_query_str = urllib.parse.urlencode(url_query_params)
+        url_request_properties = ''.join(["&properties=" + p for p in request_properties])
+
+        page_url = url + '?' + url_query_str + url_request_properties
+        try:
+            content, data = get_page(session, page_url, headers, 'companies', paths, sizer)
+        except Exception as e:
+            if sizer.retry(e) is False:
+                raise
+            continue
+
+        if len(data) == 0 :# sanity check in case there's an issue with cursor
+            break
+
+        page_cursor_id = content.get('offset')
+        has_more = content.get('has-more', False)
+        if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None:
+            break
+
+def get_search_item(result):
+
+    # convert a search result into the shape of a company from the v2 api so
+    # the same column functions apply; search returns dates as iso strings
+    # rather than epoch milliseconds and returns null for empty properties
+    properties = {}
+    for name, value in result.get('properties',{}).items():
+        if value is None:
+            continue
+        if name in DATE_PROPERTIES:
+            value = from_iso_date(value)
+        properties[name] = {'value': value}
+
+    return {'companyId': result.get('id'), 'properties': properties}
+
+# paths within each company that are read outside of the columns
+ITEM_PATHS = ['companyId']
+
+# the output schema; each column is built by following its source path from
+# the extractor's arguments and converting the value, with the default used
+# when the last key in the path is missing; see parse_source() for the path
+# syntax
+EXTRACTOR_ARGS = ['item', 'owners']
+COLUMNS = OrderedDict([
+    ('portal_id',                ('item.portalId', to_integer, None)),
+    ('company_id',               ('item.companyId', to_integer, None)),
+    ('name',                     ('item.properties.name.value', None, '')),
+    ('domain',                   ('item.properties.domain.value', None, '')),
+    ('website',                  ('item.properties.website.value', None, '')),
+    ('industry',                 ('item.properties.industry.value', None, '')),
+    ('type',                     ('item.properties.type.value', None, '')),
+    ('phone',                    ('item.properties.phone.value', None, '')),
+    ('address',                  ('item.properties.address.value', None, '')),
+    ('city',                     ('item.properties.city.value', None, '')),
+    ('state',                    ('item.properties.state.value', None, '')),
+    ('zip',                      ('item.properties.zip.value', None, '')),
+    ('country',                  ('item.properties.country.value', None, '')),
+    ('description',              ('item.properties.description.value', None, '')),
+    ('number_of_employees',      ('item.properties.numberofemployees.value', to_integer, '')),
+    ('annual_revenue',           ('item.properties.annualrevenue.value', to_integer, '')),
+    ('owner_id',                 ('item.properties.hubspot_owner_id.value', to_integer, None)),
+    ('owner_first_name',         ('owners[owner_id].firstName', None, None)),
+    ('owner_last_name',          ('owners[owner_id].lastName', None, None)),
+    ('lifecycle_stage',          ('item.properties.lifecyclestage.value', None, '')),
+    ('num_associated_contacts',  ('item.properties.num_associated_contacts.value', to_integer, '')),
+    ('num_associated_deals',     ('item.properties.num_associated_deals.value', to_integer, '')),
+    ('created_at',               ('item.properties.createdate.value', to_date, None)),
+    ('updated_at',               ('item.properties.hs_lastmodifieddate.value', to_date, None)),
+])
+
+# columns that map directly to a company property that can be filtered with
+# the search api; other columns, such as names from lookups and formatted
+# dates, are filtered locally
+SEARCH_PROPERTIES = {
+    'company_id': 'hs_object_id',
+    'name': 'name',
+    'domain': 'domain',
+    'website': 'website',
+    'industry': 'industry',
+    'type': 'type',
+    'phone': 'phone',
+    'address': 'address',
+    'city': 'city',
+    'state': 'state',
+    'zip': 'zip',
+    'country': 'country',
+    'description': 'description',
+    'number_of_employees': 'numberofemployees',
+    'annual_revenue': 'annualrevenue',
+    'owner_id': 'hubspot_owner_id',
+    'lifecycle_stage': 'lifecyclestage',
+    'num_associated_contacts': 'num_associated_contacts',
+    'num_associated_deals': 'num_associated_deals',
+}
+# company properties that hold dates; the search api returns these as iso
+# strings rather than epoch milliseconds
+DATE_PROPERTIES = set([
+    'createdate','hs_lastmodifieddate'
+])
+
+# compile the extractor for all the columns when the function is loaded
+get_extractor(COLUMNS, EXTRACTOR_ARGS, list(COLUMNS.keys()))
@@ -14,6 +14,50 @@
 #     type: string
 #     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
 #     required: false
+#   - name: refresh
+#     type: boolean
+#     description: True to reload cached data, such as the portal id and contacts already looked up by email or vid, instead of using the cached copy; defaults to false
+#     required: false
+#   - name: emails
+#     type: array
+#     description: The email addresses of the contacts to look up instead of returning all contacts; a row is returned for each address, in the order given, with only the email filled in if there's no contact with the address
+#     required: false
+#   - name: vids
+#     type: array
+#     description: The vids of the contacts to look up instead of returning all contacts; a row is returned for each vid, in the order given, with only the vid filled in if there's no contact with the vid
+#     required: false
+#   - name: incremental
+#     type: boolean
+#     description: True to keep a local copy of the contacts and only fetch the contacts modified since the last call; defaults to false
+#     required: false
+#   - name: rebuild
+#     type: boolean
+#     description: True to rebuild the local copy of the contacts from scratch before returning them; defaults to false
+#     required: false
+#   - name: partitions
+#     type: integer
+#     description: The number of ranges of created dates to split the contacts into and fetch in parallel; defaults to 1, which fetches the contacts one page at a time
+#     required: false
+#   - name: ordered
+#     type: boolean
+#     description: True to return the contacts of each range in order of created date when partitions is more than 1; otherwise the contacts of each range are returned as soon as they're fetched; defaults to false
+#     required: false
+#   - name: run_id
+#     type: string
+#     description: An id for the call; if a call with the same id fails part way through, calling again with the id returns the rest of the contacts rather than starting over
+#     required: false
+#   - name: format
+#     type: string
+#     description: The format of the output; one of 'json' (a JSON object per line), 'csv', 'arrow' (an Arrow IPC stream) or 'parquet'; defaults to 'json'; the arrow and parquet formats require pyarrow
+#     required: false
+#   - name: time_limit
+#     type: number
+#     description: The number of seconds the call can take; once the time is nearly up, the rows fetched so far are returned and calling again with the same run_id returns the rest; needs a run_id; defaults to no limit
+#     required: false
+#   - name: trace
+#     type: string
+#     description: Writes the time spent requesting, decoding, transforming and writing the pages to stderr after the output; one of 'summary' (a line with the totals) or 'json' (the totals and each page); defaults to false
+#     required: false
 # returns:
 #   - name: portal_id
 #     type: integer
@@ -69,26 +113,123 @@
 #   - '"first_name, last_name, phone, email"'
 # ---
 
-import json
-import urllib
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from datetime import *
+import os
+import sys
+import time
+import urllib.parse
+import importlib.util
+import hashlib
+import threading
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# the shared code is in hubspot_core.py next to this file (it's deployed
+# with the functions; see flexio.yml), which isn't on the path when the
+# function is loaded from its file; without the file's path, there's no
+# directory to look in and the import below fails as it would otherwise
+if importlib.util.find_spec('hubspot_core') is None and globals().get('__file__') is not None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hubspot_core import (
+    PAGE_PREFETCH_DEPTH, DATA_PATH, SEARCH_FILTER_LIMIT, has_optional,
+    decode_json, get_checkpoint, split_mirror_filters, Mirror, get_page,
+    PageSizer, prefetch, is_over_search_limit, get_search_pages,
+    get_partitions, get_partition_pages, get_writer, get_schema, get_deadline,
+    until_deadline, requests_retry_session, get_trace, print_deadline_report,
+    get_rate_limiter, get_cache_key, get_portal_id, MemoryCache, to_date,
+    convert_dates, from_iso_date, to_integer, get_columns,
+    get_request_properties, get_filters, split_filters, get_item_paths,
+    get_predicate, get_extractor, get_date_indexes, EMPTY,
+)
+
+# the base url of the hubspot api; can be pointed at a local server, such as
+# the one in benchmarks/mock_hubspot.py
+API_BASE_URL = 'https://api.hubapi.com'
+
+# the paged contacts api is asked for at most PAGE_MAX_SIZE records a page
+# (its limit); see PageSizer in hubspot_core.py for how the size of each page
+# is chosen
+PAGE_MAX_SIZE = 100
+
+# with the incremental param, the contacts of each portal are mirrored in a
+# local sqlite database and only the contacts modified since the last sync
+# are fetched; a mirror synced within MIRROR_MAX_STALENESS seconds is read
+# without calling hubspot at all; hubspot only lists the contacts modified
+# in the last 30 days (and at most MIRROR_RECENT_LIMIT of them), so a mirror
+# last synced before then is rebuilt with a full sync, as is any mirror
+# older than MIRROR_MAX_AGE so deleted contacts are dropped; filters on the
+# columns in MIRROR_INDEXES use an index
+MIRROR_PATH = os.path.join(DATA_PATH, 'contacts.sqlite') # see DATA_PATH in hubspot_core.py
+MIRROR_MAX_STALENESS = 300
+MIRROR_MAX_AGE = 7*86400
+MIRROR_RECENT_WINDOW = 29*86400
+MIRROR_RECENT_LIMIT = 10000
+MIRROR_OVERLAP = 300
+MIRROR_INDEXES = ['email']
+
+# with the emails or vids params, the contacts are fetched with the batch apis
+# LOOKUP_BATCH_SIZE at a time, at most LOOKUP_CONCURRENCY batches at a time;
+# the contacts found, and the keys not found, are cached in process for
+# LOOKUP_CACHE_TTL seconds
+LOOKUP_BATCH_SIZE = 100
+LOOKUP_CONCURRENCY = 4
+LOOKUP_CACHE_TTL = 600
+LOOKUP_CACHE_MAX_ENTRIES = 100000
 
 # main function entry point
 def flexio_handler(flex):
 
-    flex.output.content_type = 'application/x-ndjson'
-    for data in get_data(flex.vars):
-        flex.output.write(data)
+    columns = get_columns(COLUMNS, dict(flex.vars).get('properties'))
+    writer = get_writer(dict(flex.vars).get('format'), flex.output, columns, get_schema(globals().get('__file__'), COLUMNS))
 
-def get_data(params):
+    # with the emails or vids params, only those contacts are looked up
+    if len(get_keys(dict(flex.vars).get('emails'))) > 0 or len(get_keys(dict(flex.vars).get('vids'))) > 0:
+        for row in get_lookup_data(flex.vars):
+            writer.write(row)
+        writer.close()
+        return
+
+    deadline = get_deadline(flex.vars)
+    checkpoint = get_checkpoint(flex.vars, 'hubspot-contacts', writer.flush, deadline)
+    trace = get_trace(flex.vars, 'hubspot-contacts')
+    if trace is None:
+        for row in get_data(flex.vars, checkpoint=checkpoint, deadline=deadline):
+            writer.write(row)
+        writer.close()
+    else:
+        # with a trace, the time spent writing each row is counted against
+        # the page it came from
+        for row in get_data(flex.vars, checkpoint=checkpoint, trace=trace, deadline=deadline):
+            started = time.perf_counter()
+            writer.write(row)
+            trace.write(time.perf_counter() - started)
+        started = time.perf_counter()
+        writer.close()
+        trace.write(time.perf_counter() - started)
+        trace.close()
+
+    print_deadline_report('hubspot-contacts', deadline)
+
+def get_data(params, session=None, checkpoint=None, trace=None, deadline=None):
 
     # get the api key from the variable input
     auth_token = dict(params).get('hubspot_connection',{}).get('access_token')
 
+    # use one session for all the paged requests; callers can pass in their
+    # own session to inspect it with get_connection_stats()
+    # callers can pass in a deadline to see whether the call stopped at the
+    # time limit; a session passed in keeps its own timeouts
+    if deadline is None:
+        deadline = get_deadline(params)
+    session = session or requests_retry_session(limiter=get_rate_limiter(auth_token), deadline=deadline)
+
+    # requests made with the session are recorded by the trace, if any
+    session.trace = trace
+    if trace is not None:
+        trace.session = session
+
+    # reference data is cached per token; the refresh param reloads it
+    refresh = str(dict(params).get('refresh', False)).lower() == 'true'
+
     # see here for more info:
     # https://developers.hubspot.com/docs/methods/contacts/get_contacts
     # note: pagination mechanism different from other api calls; compare activity/deal pagination
@@ -96,100 +237,511 @@ def get_data(params):
     headers = {
         'Authorization': 'Bearer ' + auth_token,
     }
-    url = 'https://api.hubapi.com/contacts/v1/lists/all/contacts/all'
 
-    request_properties = [
-        'firstname','lastname','email','phone','mobilephone','jobtitle', 'address',
-        'city','state','zip','country','linkedinbio','createdate', 'lastmodifieddate'
-    ]
+    # filters on contact properties are sent to the search api so only the
+    # matching contacts are returned; the rest are checked on each row
+    # before it's written; incremental calls read the contacts from the
+    # mirror instead, where filters on indexed columns are applied by the
+    # query
+    rebuild = str(dict(params).get('rebuild', False)).lower() == 'true'
+    incremental = rebuild or str(dict(params).get('incremental', False)).lower() == 'true'
+    partitions = get_partitions(params)
+    ordered = str(dict(params).get('ordered', False)).lower() == 'true'
+    filters = get_filters(COLUMNS, dict(params).get('filter'))
+    search_filters, mirror_filters = [], OrderedDict()
+    if incremental is True:
+        mirror_filters, local_filters = split_mirror_filters(filters, MIRROR_INDEXES)
+    elif partitions > 1:
+        # two of the search filters are used for each partition's range
+        search_filters, local_filters = split_filters(filters, SEARCH_PROPERTIES, SEARCH_FILTER_LIMIT - 2)
+    else:
+        search_filters, local_filters = split_filters(filters, SEARCH_PROPERTIES)
 
-    page_size = 100
+    # a search can only page through SEARCH_RESULT_LIMIT contacts, so when more
+    # match the search filters, all the contacts are paged through and every
+    # filter is checked on each row instead
+    if len(search_filters) > 0 and partitions == 1:
+        url = API_BASE_URL + '/crm/v3/objects/contacts/search'
+        if is_over_search_limit(session, url, headers, search_filters):
+            search_filters, local_filters = [], filters
+
+    # a checkpoint from an earlier call with the same run id picks up after
+    # the last page that call returned; calls reading the mirror read all of
+    # it each time and partitions don't have a single cursor, so neither are
+    # checkpointed
     page_cursor_id = None
+    if incremental is True or partitions > 1:
+        checkpoint = None
+    if partitions > 1 and incremental is False and deadline is not None:
+        deadline.continuation = None
+    if checkpoint is not None:
+        page_cursor_id = checkpoint.state['page_cursor_id']
+
+    # only request the contact properties needed for the columns being
+    # returned and the columns being filtered locally; the filtered columns
+    # are built after the returned columns and trimmed off each row
+    columns = get_columns(COLUMNS, dict(params).get('properties'))
+    filter_columns = [c for c in local_filters.keys() if c not in columns]
+    predicate = get_predicate(local_filters, columns + filter_columns)
+
+    # with numpy, date columns are converted a page at a time
+    vectorized = has_optional('numpy')
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, columns + filter_columns, vectorized)
+    date_indexes = get_date_indexes(COLUMNS, columns + filter_columns) if vectorized else []
+    request_properties = get_request_properties(COLUMNS, columns + filter_columns)
+
+    if incremental is True:
+        pages = get_mirror_pages(session, headers, auth_token, columns + filter_columns, mirror_filters, rebuild)
+    elif partitions > 1:
+        url = API_BASE_URL + '/crm/v3/objects/contacts/search'
+        pages = get_partition_pages(session, url, headers, request_properties, search_filters, get_search_item, partitions, ordered)
+    elif len(search_filters) > 0:
+        url = API_BASE_URL + '/crm/v3/objects/contacts/search'
+        pages = get_search_pages(session, url, headers, request_properties, search_filters, get_search_item, page_cursor_id)
+    else:
+        url = API_BASE_URL + '/contacts/v1/lists/all/contacts/all'
+        pages = get_pages(session, url, headers, request_properties, page_cursor_id, get_item_paths(COLUMNS, columns + filter_columns, ITEM_PATHS))
+
+    # fetch the pages in a background thread so the next page is on its way
+    # while the current page is being transformed and written
+    if trace is not None:
+        pages = trace.track(pages)
+    pages = prefetch(pages, PAGE_PREFETCH_DEPTH)
+    if deadline is not None:
+        pages = until_deadline(pages, deadline)
+
+    # search results don't include the portal id, so look it up separately
+    # while the first page is being fetched
+    portal_id = None
+    if (len(search_filters) > 0 or partitions > 1) and 'portal_id' in columns + filter_columns:
+        portal_id = get_portal_id(session, API_BASE_URL, headers, get_cache_key(auth_token, 'portal'), refresh)
+
+    for data, page_cursor_id in pages:
+
+        if trace is not None:
+            trace.start_page()
+
+        if incremental is True:
+            # rows read from the mirror are already built
+            rows = data
+        else:
+            if portal_id is not None:
+                for item in data:
+                    item['portal-id'] = portal_id
+            started = time.perf_counter() if trace is not None else None
+            rows = convert_dates([extract(item) for item in data], date_indexes)
+            if trace is not None:
+                trace.transformed(time.perf_counter() - started)
+
+        count = 0
+        for row in rows:
+            if predicate is not None and not predicate(row):
+                continue
+            if len(filter_columns) > 0:
+                row = row[:len(columns)]
+            count += 1
+            yield row
+
+        if trace is not None:
+            trace.emitted(count)
+        if checkpoint is not None:
+            checkpoint.save(page_cursor_id, count)
+
+def get_lookup_data(params, emails=None, vids=None, session=None):
+
+    # look up contacts by email and by vid, taken from the emails and vids
+    # params unless passed in, and return a row for each email and then each
+    # vid, in the order given, with the same columns as get_data(); a key
+    # without a contact gets a row with only its own column filled in
+    auth_token = dict(params).get('hubspot_connection',{}).get('access_token')
+    session = session or requests_retry_session(limiter=get_rate_limiter(auth_token))
+    refresh = str(dict(params).get('refresh', False)).lower() == 'true'
+    headers = {
+        'Authorization': 'Bearer ' + auth_token,
+    }
+
+    # see here for more info:
+    # https://legacydocs.hubspot.com/docs/methods/contacts/get_batch_by_email
+    # https://legacydocs.hubspot.com/docs/methods/contacts/get_batch_by_vid
+
+    emails = [str(e).strip().lower() for e in (emails if emails is not None else get_keys(dict(params).get('emails')))]
+    vids = [to_integer(v) for v in (vids if vids is not None else get_keys(dict(params).get('vids')))]
+
+    columns = get_columns(COLUMNS, dict(params).get('properties'))
+    filters = get_filters(COLUMNS, dict(params).get('filter'))
+    filter_columns = [c for c in filters.keys() if c not in columns]
+    predicate = get_predicate(filters, columns + filter_columns)
+    vectorized = has_optional('numpy')
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, columns + filter_columns, vectorized)
+    date_indexes = get_date_indexes(COLUMNS, columns + filter_columns) if vectorized else []
+
+    # the email is always requested so the contacts can be matched to the
+    # addresses looked up
+    request_properties = get_request_properties(COLUMNS, columns + filter_columns)
+    if 'email' not in request_properties:
+        request_properties.append('email')
+    cache_key = hashlib.sha256((auth_token + ':' + ','.join(request_properties)).encode('utf-8')).hexdigest()
+    lookup = ContactLookup(session, headers, cache_key, request_properties, refresh)
+
+    for kind, keys in [('email', emails), ('vid', vids)]:
+        keys = [k for k in keys if k is not None and k != '']
+        if len(keys) == 0:
+            continue
+        # vids that aren't numbers can't have a contact
+        items = lookup.get(kind, [k for k in keys if kind == 'email' or isinstance(k, int)])
+
+        found = [k for k in keys if items.get(k, EMPTY) is not EMPTY]
+        rows = dict(zip(found, convert_dates([extract(items[k]) for k in found], date_indexes)))
+        for key in keys:
+            row = rows.get(key)
+            if row is None:
+                row = [None] * len(columns + filter_columns)
+                if kind in columns + filter_columns:
+                    row[(columns + filter_columns).index(kind)] = key
+            if predicate is not None and not predicate(row):
+                continue
+            if len(filter_columns) > 0:
+                row = row[:len(columns)]
+            yield row
+
+def get_keys(values):
+
+    # emails and vids can be passed like properties, as a list (possibly a
+    # nested list from a range of cells) or as a comma-delimited string
+    if values is None:
+        return []
+    if isinstance(values, str):
+        values = values.split(',')
+    if not isinstance(values, list):
+        values = [values]
+
+    keys = []
+    for value in values:
+        for key in (value if isinstance(value, list) else [value]):
+            if key is None or len(str(key).strip()) == 0:
+                continue
+            keys.append(key)
+    return keys
+
+class ContactLookup(object):
+
+    # looks up contacts for an invocation; each key is looked up once, first
+    # in the cache and then with the batch apis, and a key that's already
+    # being fetched, such as by a lookup on another thread, waits for that
+    # fetch rather than being fetched again; contacts that aren't found are
+    # returned, and cached, as EMPTY; with refresh, every key is fetched and
+    # the cached contacts are replaced
+
+    def __init__(self, session, headers, cache_key, request_properties, refresh=False):
+        self.session = session
+        self.headers = headers
+        self.cache_key = cache_key
+        self.request_properties = request_properties
+        self.refresh = refresh
+        self.cache = get_lookup_cache()
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def get(self, kind, keys):
+        futures, fetch = OrderedDict(), []
+        with self.lock:
+            for key in keys:
+                if key in futures:
+                    continue
+                item = self.cache.get(self.cache_key + ':' + kind + ':' + str(key)) if self.refresh is False else None
+                if item is not None:
+                    futures[key] = Future()
+                    futures[key].set_result(item)
+                elif (kind, key) in self.pending:
+                    futures[key] = self.pending[(kind, key)]
+                else:
+                    futures[key] = Future()
+                    self.pending[(kind, key)] = futures[key]
+                    fetch.append(key)
+
+        batches = [fetch[i:i+LOOKUP_BATCH_SIZE] for i in range(0, len(fetch), LOOKUP_BATCH_SIZE)]
+        if len(batches) > 0:
+            with ThreadPoolExecutor(max_workers=LOOKUP_CONCURRENCY) as executor:
+                for future in [executor.submit(self.fetch, kind, batch) for batch in batches]:
+                    future.result()
+        return {key: future.result() for key, future in futures.items()}
+
+    def fetch(self, kind, keys):
+        try:
+            items = get_batch(self.session, self.headers, kind, keys, self.request_properties)
+        except Exception as e:
+            with self.lock:
+                for key in keys:
+                    self.pending.pop((kind, key)).set_exception(e)
+            raise
+        with self.lock:
+            for key in keys:
+                item = items.get(key, EMPTY)
+                self.cache.set(self.cache_key + ':' + kind + ':' + str(key), item, LOOKUP_CACHE_TTL)
+                self.pending.pop((kind, key)).set_result(item)
+
+def get_batch(session, headers, kind, keys, request_properties):
+
+    # get the contacts for up to LOOKUP_BATCH_SIZE emails or vids and return
+    # them keyed by the email or vid they were found by; the batch apis
+    # leave out the keys without a contact
+    url = API_BASE_URL + '/contacts/v1/contact/' + kind + 's/batch/'
+    url_query_params = [(kind, k) for k in keys] + [('property', p) for p in request_properties]
+    page_url = url + '?' + urllib.parse.urlencode(url_query_params)
+
+    trace = getattr(session, 'trace', None)
+    started = time.perf_counter() if trace is not None else None
+    response = session.get(page_url, headers=headers)
+    received = time.perf_counter() if trace is not None else None
+    response.raise_for_status()
+    content = decode_json(response)
+    if trace is not None:
+        trace.request(response, started, received)
+
+    items = {}
+    for vid, item in content.items():
+        if kind == 'vid':
+            items[to_integer(vid)] = item
+            continue
+        for email in get_contact_emails(item):
+            items[email] = item
+    return items
+
+def get_contact_emails(item):
+
+    # the addresses a contact can be found by: its email property and the
+    # email identities of its profiles, which include any merged contacts
+    emails = set()
+    email = item.get('properties',{}).get('email',{}).get('value')
+    if email:
+        emails.add(email.lower())
+    for profile in item.get('identity-profiles',[]):
+        for identity in profile.get('identities',[]):
+            if identity.get('type') == 'EMAIL' and identity.get('value'):
+                emails.add(identity.get('value').lower())
+    return emails
+
+def get_pages(session, url, headers, request_properties, page_cursor_id=None, paths=None):
+
+    # yields each page along with the cursor for the page after it, or None
+    # after the last page, so a caller can pick up from where it left off;
+    # the size of each page is chosen by a PageSizer
+    sizer = PageSizer(PAGE_MAX_SIZE)
     while True:
 
-        url_query_params = {'count': page_size}
+        url_query_params = {'count': sizer.size}
         if page_cursor_id is not None:
             url_query_params['vidOffset'] = page_cursor_id
         url_query_str = urllib.parse.urlencode(url_query_params)
-        url_request_properties = "&property=" + "&property=".join(request_properties)
+        url_request_properties = ''.join(["&property=" + p for p in request_properties])
 
         page_url = url + '?' + url_query_str + url_request_properties
-        response = requests_retry_session().get(page_url, headers=headers)
-        response.raise_for_status()
-        content = response.json()
-        data = content.get('contacts',[])
+        try:
+            content, data = get_page(session, page_url, headers, 'contacts', paths, sizer)
+        except Exception as e:
+            if sizer.retry(e) is False:
+                raise
+            continue
 
         if len(data) == 0: # sanity check in case there's an issue with cursor
             break
 
-        buffer = ''
-        for item in data:
-            item = get_item_info(item)
-            buffer = buffer + json.dumps(item, default=to_string) + "\n"
-        yield buffer
+        page_cursor_id = content.get('vid-offset')
+        has_more = content.get('has-more', False)
+        if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None:
+            break
+
+def get_recent_pages(session, url, headers, request_properties, paths=None):
+
+    # see here for more info:
+    # https://developers.hubspot.com/docs/methods/contacts/get_recently_updated_contacts
+    # note: contacts are returned most recently modified first and only the
+    # first MIRROR_RECENT_LIMIT can be paged through; like get_pages(), each
+    # page is yielded with the cursor for the page after it, so a cursor
+    # other than None after the last page means some contacts were left out
 
+    page_size = 100
+    page_cursor_id = None
+    count = 0
+    while True:
+
+        url_query_params = {'count': page_size}
+        if page_cursor_id is not None:
+            url_query_params['timeOffset'] = page_cursor_id[0]
+            url_query_params['vidOffset'] = page_cursor_id[1]
+        url_query_str = urllib.parse.urlencode(url_query_params)
+        url_request_properties = ''.join(["&property=" + p for p in request_properties])
+
+        page_url = url + '?' + url_query_str + url_request_properties
+        content, data = get_page(session, page_url, headers, 'contacts', paths)
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
+            break
+
+        count += len(data)
+        page_cursor_id = (content.get('time-offset'), content.get('vid-offset'))
         has_more = content.get('has-more', False)
         if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None or count + page_size > MIRROR_RECENT_LIMIT:
             break
 
-        page_cursor_id = content.get('vid-offset')
+def get_mirror_pages(session, headers, auth_token, columns, filters, rebuild=False):
+
+    # bring the mirror of the portal's contacts up to date and then read the
+    # columns of the matching contacts back from it a page of rows at a time
+    key = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+    mirror = Mirror(MIRROR_PATH, 'contacts', list(COLUMNS.keys()), MIRROR_INDEXES)
+    sync_mirror(session, headers, mirror, key, rebuild)
+    for rows in mirror.read(key, columns, filters):
+        yield rows, None
+
+def sync_mirror(session, headers, mirror, key, rebuild=False):
+
+    # the sync state holds the high-water mark (the latest lastmodifieddate
+    # in the mirror), the time of the last sync and, while a full sync is
+    # underway, the cursor (vid offset) of the next page so an interrupted
+    # full sync picks up where it stopped
+    now = time.time()
+    state = mirror.get_state(key) if rebuild is False else None
+    if state is not None and state['complete'] is True and now - state['synced_at'] < MIRROR_MAX_STALENESS:
+        return
+
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, list(COLUMNS.keys()))
+    paths = get_item_paths(COLUMNS, list(COLUMNS.keys()), ITEM_PATHS)
+    request_properties = get_request_properties(COLUMNS, list(COLUMNS.keys()))
+    def get_rows(data):
+        return [(item.get('vid'), get_modified(item), extract(item)) for item in data]
 
-def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(429, 500, 502, 503, 504),
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
+    full_sync = (
+        state is None or
+        state['complete'] is False or
+        now - state['full_sync_started'] > MIRROR_MAX_AGE or
+        now - state['synced_at'] > MIRROR_RECENT_WINDOW
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-def to_date(ts):
-    if ts is None or ts == '':
-        return ''
-    return datetime.utcfromtimestamp(int(ts)/1000).strftime('%Y-%m-%dT%H:%M:%S')
-
-def to_integer(value):
-    try:
-        return int(value)
-    except:
-        return value
-
-def to_string(value):
-    if isinstance(value, (date, datetime)):
-        return value.isoformat()
-    if isinstance(value, (Decimal)):
-        return str(value)
-    return value
-
-def get_item_info(item):
-
-    info = OrderedDict()
-
-    info['portal_id'] = item.get('portal-id')
-    info['vid'] = item.get('vid')
-    info['first_name'] = item.get('properties').get('firstname',{}).get('value','')
-    info['last_name'] = item.get('properties').get('lastname',{}).get('value','')
-    info['email'] = item.get('properties').get('email',{}).get('value','')
-    info['phone'] = item.get('properties').get('phone',{}).get('value','')
-    info['phone_mobile'] = item.get('properties').get('mobilephone',{}).get('value','')
-    info['job_title'] = item.get('properties').get('jobtitle',{}).get('value','')
-    info['address'] = item.get('properties').get('address',{}).get('value','')
-    info['city'] = item.get('properties').get('city',{}).get('value','')
-    info['state'] = item.get('properties').get('state',{}).get('value','')
-    info['zip'] = item.get('properties').get('zip',{}).get('value','')
-    info['country'] = item.get('properties').get('country',{}).get('value','')
-    info['linkedin_bio'] = item.get('properties').get('linkedinbio',{}).get('value','')
-    info['created_at'] = to_date(item.get('properties').get('createdate',{}).get('value',''))
-    info['updated_at'] = to_date(item.get('properties').get('lastmodifieddate',{}).get('value',''))
-
-    return info
\ No newline at end of file
+
+    if full_sync is False:
+        # recently modified contacts are listed newest first, so the
+        # high-water mark is only moved once all the changes are saved; the
+        # changes are all listed once a contact from before the high-water
+        # mark is reached
+        url = API_BASE_URL + '/contacts/v1/lists/recently_updated/contacts/recent'
+        stop = state['high_water_mark'] - MIRROR_OVERLAP*1000
+        high_water_mark = state['high_water_mark']
+        page_cursor_id = None
+        for data, page_cursor_id in get_recent_pages(session, url, headers, request_properties, paths):
+            changed = [item for item in data if get_modified(item) >= stop]
+            high_water_mark = max([high_water_mark] + [get_modified(item) for item in changed])
+            mirror.save(key, get_rows(changed), state, now)
+            if len(changed) < len(data):
+                page_cursor_id = None
+                break
+        if page_cursor_id is None:
+            state['high_water_mark'] = high_water_mark
+            state['synced_at'] = now
+            mirror.save(key, [], state, now)
+            return
+        # more contacts were modified than can be listed, so fall through to
+        # a full sync
+
+    if state is None or state['complete'] is True or now - state['full_sync_started'] > MIRROR_MAX_AGE:
+        state = {'complete': False, 'full_sync_started': now, 'synced_at': now, 'high_water_mark': 0, 'page_cursor_id': None}
+
+    # rows saved by this full sync are marked with the time it started; rows
+    # left from before then are deleted once it completes
+    url = API_BASE_URL + '/contacts/v1/lists/all/contacts/all'
+    for data, page_cursor_id in get_pages(session, url, headers, request_properties, state['page_cursor_id'], paths):
+        state['high_water_mark'] = max([state['high_water_mark']] + [get_modified(item) for item in data])
+        state['page_cursor_id'] = page_cursor_id
+        mirror.save(key, get_rows(data), state, state['full_sync_started'])
+    mirror.finish(key, state)
+
+def get_modified(item):
+    value = to_integer(item.get('properties',{}).get('lastmodifieddate',{}).get('value'))
+    return value if isinstance(value, int) else 0
+
+def get_search_item(result):
+
+    # convert a search result into the shape of a contact from the v1 api so
+    # the same column functions apply; search returns dates as iso strings
+    # rather than epoch milliseconds and returns null for empty properties
+    properties = {}
+    for name, value in result.get('properties',{}).items():
+        if value is None:
+            continue
+        if name in DATE_PROPERTIES:
+            value = from_iso_date(value)
+        properties[name] = {'value': value}
+
+    return {'vid': to_integer(result.get('id')), 'properties': properties}
+
+def get_lookup_cache():
+
+    global _lookup_cache
+    with _lookup_cache_lock:
+        if _lookup_cache is None:
+            _lookup_cache = MemoryCache(LOOKUP_CACHE_MAX_ENTRIES)
+        return _lookup_cache
+
+_lookup_cache = None
+_lookup_cache_lock = threading.Lock()
+
+# paths within each contact that are read outside of the columns, such as
+# by the mirror
+ITEM_PATHS = ['vid', 'properties.lastmodifieddate.value']
+
+# the output schema; each column is built by following its source path from
+# the extractor's arguments and converting the value, with the default used
+# when the last key in the path is missing; see parse_source() for the path
+# syntax
+EXTRACTOR_ARGS = ['item']
+COLUMNS = OrderedDict([
+    ('portal_id',    ('item.portal-id', None, None)),
+    ('vid',          ('item.vid', None, None)),
+    ('first_name',   ('item.properties.firstname.value', None, '')),
+    ('last_name',    ('item.properties.lastname.value', None, '')),
+    ('email',        ('item.properties.email.value', None, '')),
+    ('phone',        ('item.properties.phone.value', None, '')),
+    ('phone_mobile', ('item.properties.mobilephone.value', None, '')),
+    ('job_title',    ('item.properties.jobtitle.value', None, '')),
+    ('address',      ('item.properties.address.value', None, '')),
+    ('city',         ('item.properties.city.value', None, '')),
+    ('state',        ('item.properties.state.value', None, '')),
+    ('zip',          ('item.properties.zip.value', None, '')),
+    ('country',      ('item.properties.country.value', None, '')),
+    ('linkedin_bio', ('item.properties.linkedinbio.value', None, '')),
+    ('created_at',   ('item.properties.createdate.value', to_date, '')),
+    ('updated_at',   ('item.properties.lastmodifieddate.value', to_date, '')),
+])
+
+# columns that map directly to a contact property that can be filtered with
+# the search api; other columns, such as formatted dates, are filtered
+# locally
+SEARCH_PROPERTIES = {
+    'vid': 'hs_object_id',
+    'first_name': 'firstname',
+    'last_name': 'lastname',
+    'email': 'email',
+    'phone': 'phone',
+    'phone_mobile': 'mobilephone',
+    'job_title': 'jobtitle',
+    'address': 'address',
+    'city': 'city',
+    'state': 'state',
+    'zip': 'zip',
+    'country': 'country',
+}
+# contact properties that hold dates; the search api returns these as iso
+# strings rather than epoch milliseconds
+DATE_PROPERTIES = set(['createdate','lastmodifieddate'])
+
+# compile the extractor for all the columns when the function is loaded
+get_extractor(COLUMNS, EXTRACTOR_ARGS, list(COLUMNS.keys()))
@@ -14,6 +14,62 @@
 #     type: string
 #     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
 #     required: false
+#   - name: refresh
+#     type: boolean
+#     description: True to reload cached reference data, such as the list of owners and deal stages, instead of using the cached copy; defaults to false
+#     required: false
+#   - name: incremental
+#     type: boolean
+#     description: True to keep a local copy of the deals and only fetch the deals modified since the last call; defaults to false
+#     required: false
+#   - name: rebuild
+#     type: boolean
+#     description: True to rebuild the local copy of the deals from scratch before returning them; defaults to false
+#     required: false
+#   - name: partitions
+#     type: integer
+#     description: The number of ranges of created dates to split the deals into and fetch in parallel; defaults to 1, which fetches the deals one page at a time
+#     required: false
+#   - name: ordered
+#     type: boolean
+#     description: True to return the deals of each range in order of created date when partitions is more than 1; otherwise the deals of each range are returned as soon as they're fetched; defaults to false
+#     required: false
+#   - name: run_id
+#     type: string
+#     description: An id for the call; if a call with the same id fails part way through, calling again with the id returns the rest of the deals rather than starting over
+#     required: false
+#   - name: format
+#     type: string
+#     description: The format of the output; one of 'json' (a JSON object per line), 'csv', 'arrow' (an Arrow IPC stream) or 'parquet'; defaults to 'json'; the arrow and parquet formats require pyarrow, and type the number properties, such as amount, as 64-bit floats
+#     required: false
+#   - name: time_limit
+#     type: number
+#     description: The number of seconds the call can take; once the time is nearly up, the rows fetched so far are returned and calling again with the same run_id returns the rest; needs a run_id, except with hubspot_connections; can't be used with group_by, aggregate or top; defaults to no limit
+#     required: false
+#   - name: trace
+#     type: string
+#     description: Writes the time spent requesting, decoding, transforming and writing the pages to stderr after the output; one of 'summary' (a line with the totals) or 'json' (the totals and each page); defaults to false
+#     required: false
+#   - name: hubspot_connections
+#     type: array
+#     description: The connections of several portals to return the deals of in one call, rather than the one connection; the portals are read in parallel, each with its own rate limit, every row includes the portal_id, and a line for each portal with its status, row count and time is written to stderr; run_id and trace aren't used with several portals
+#     required: false
+#   - name: group_by
+#     type: array
+#     description: The properties to group the deals by (e.g. 'deal_stage_label' and 'owner_id', or 'close_date:month', where dates can be bucketed by 'day', 'week', 'month' or 'year'); returns a row for each group with the group values and the aggregates rather than a row for each item
+#     required: false
+#   - name: aggregate
+#     type: array
+#     description: The aggregates to return for each group, or for all the deals if there's no group_by; each one of 'count', 'count(property)', 'sum(property)', 'min(property)' or 'max(property)' (e.g. 'count' or 'sum(amount)'); returned as columns named like 'count' and 'sum_amount'; defaults to 'count'
+#     required: false
+#   - name: top
+#     type: integer
+#     description: The number of rows (or groups) to return, ranked by top_by
+#     required: false
+#   - name: top_by
+#     type: string
+#     description: The property (or, with group_by, the group property or aggregate) to rank the rows by for top (e.g. 'amount' for the largest deals); ranks largest first unless prefixed with '-'; with group_by, defaults to the first aggregate
+#     required: false
 # returns:
 #   - name: portal_id
 #     type: integer
@@ -43,10 +99,10 @@
 #     type: string
 #     description: The deal type
 #   - name: amount
-#     type: integer
+#     type: number
 #     description: The deal mount
 #   - name: amount_in_home_currency
-#     type: integer
+#     type: number
 #     description: The deal amount in home currency
 #   - name: closed_lost_reason
 #     type: string
@@ -91,26 +147,136 @@
 #   - ' '
 # ---
 
-import json
-import urllib
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from datetime import *
+import os
+import sys
+import time
+import urllib.parse
+import importlib.util
+import hashlib
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# the shared code is in hubspot_core.py next to this file (it's deployed
+# with the functions; see flexio.yml), which isn't on the path when the
+# function is loaded from its file; without the file's path, there's no
+# directory to look in and the import below fails as it would otherwise
+if importlib.util.find_spec('hubspot_core') is None and globals().get('__file__') is not None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hubspot_core import (
+    PAGE_PREFETCH_DEPTH, DATA_PATH, SEARCH_FILTER_LIMIT, has_optional,
+    get_checkpoint, split_mirror_filters, Mirror, get_page, PageSizer,
+    prefetch, is_over_search_limit, get_search_pages, get_partitions,
+    get_partition_pages, get_writer, get_schema, get_aggregation, get_deadline,
+    until_deadline, requests_retry_session, get_trace, get_connections,
+    get_portal_data, print_portal_report, print_deadline_report,
+    get_rate_limiter, get_cache_key, get_cached, get_owners, get_portal_id,
+    to_date, convert_dates, from_iso_date, to_integer, get_columns,
+    get_request_properties, get_lookups, get_filters, split_filters,
+    get_item_paths, get_predicate, get_extractor, get_date_indexes,
+)
+
+# the base url of the hubspot api; can be pointed at a local server, such as
+# the one in benchmarks/mock_hubspot.py
+API_BASE_URL = 'https://api.hubapi.com'
+
+# the paged deals api is asked for at most PAGE_MAX_SIZE records a page
+# (its limit); see PageSizer in hubspot_core.py for how the size of each page
+# is chosen
+PAGE_MAX_SIZE = 250
+
+# with the incremental param, the deals of each portal are mirrored in a
+# local sqlite database and only the deals modified since the last sync are
+# fetched; a mirror synced within MIRROR_MAX_STALENESS seconds is read
+# without calling hubspot at all; hubspot only lists the deals modified in
+# the last 30 days (and at most MIRROR_RECENT_LIMIT of them), so a mirror
+# last synced before then is rebuilt with a full sync, as is any mirror
+# older than MIRROR_MAX_AGE so deleted deals are dropped; filters on the
+# columns in MIRROR_INDEXES use an index
+MIRROR_PATH = os.path.join(DATA_PATH, 'deals.sqlite') # see DATA_PATH in hubspot_core.py
+MIRROR_MAX_STALENESS = 300
+MIRROR_MAX_AGE = 7*86400
+MIRROR_RECENT_WINDOW = 29*86400
+MIRROR_RECENT_LIMIT = 10000
+MIRROR_OVERLAP = 300
+MIRROR_INDEXES = ['owner_id', 'deal_stage_id', 'pipeline']
 
 # main function entry point
 def flexio_handler(flex):
 
-    flex.output.content_type = 'application/x-ndjson'
-    for data in get_data(flex.vars):
-        flex.output.write(data)
-
-def get_data(params):
+    # with the group_by, aggregate or top params, the rows are summarized
+    # before they're written; only the columns the summary needs are read
+    params = flex.vars
+    schema = get_schema(globals().get('__file__'), COLUMNS)
+    columns = get_columns(COLUMNS, dict(params).get('properties'))
+    types = None
+    aggregation = get_aggregation(params, columns, COLUMNS, schema)
+    if aggregation is not None:
+        params = dict(params, properties=aggregation.input_columns)
+        columns, types = aggregation.columns, aggregation.types
+
+    # with the hubspot_connections param, the rows of all the portals are
+    # returned together, so each row includes its portal id
+    connections = get_connections(params)
+    if len(connections) > 0 and aggregation is None and 'portal_id' not in columns:
+        columns = ['portal_id'] + columns
+        params = dict(params, properties=columns)
+
+    # a summary isn't complete until all the rows are read and the portals
+    # don't share a cursor, so neither is checkpointed
+    writer = get_writer(dict(params).get('format'), flex.output, columns, types or schema)
+    deadline = get_deadline(params)
+    checkpoint = None
+    if aggregation is None and len(connections) == 0:
+        checkpoint = get_checkpoint(params, 'hubspot-deals', writer.flush, deadline)
+    trace = get_trace(params, 'hubspot-deals') if len(connections) == 0 else None
+    report = []
+    if len(connections) > 0:
+        rows = get_portal_data(params, connections, COLUMNS, get_data, deadline, report)
+    else:
+        rows = get_data(params, checkpoint=checkpoint, trace=trace, deadline=deadline)
+    if aggregation is not None:
+        rows = aggregation.apply(rows)
+    if trace is None:
+        for row in rows:
+            writer.write(row)
+        writer.close()
+    else:
+        # with a trace, the time spent writing each row is counted against
+        # the page it came from
+        for row in rows:
+            started = time.perf_counter()
+            writer.write(row)
+            trace.write(time.perf_counter() - started)
+        started = time.perf_counter()
+        writer.close()
+        trace.write(time.perf_counter() - started)
+        trace.close()
+
+    print_portal_report('hubspot-deals', report)
+
+    print_deadline_report('hubspot-deals', deadline)
+
+def get_data(params, session=None, checkpoint=None, trace=None, deadline=None):
 
     # get the api key from the variable input
     auth_token = dict(params).get('hubspot_connection',{}).get('access_token')
 
+    # use one session for the owner, pipeline and paged requests; callers can
+    # pass in their own session to inspect it with get_connection_stats()
+    # callers can pass in a deadline to see whether the call stopped at the
+    # time limit; a session passed in keeps its own timeouts
+    if deadline is None:
+        deadline = get_deadline(params)
+    session = session or requests_retry_session(limiter=get_rate_limiter(auth_token), deadline=deadline)
+
+    # requests made with the session are recorded by the trace, if any
+    session.trace = trace
+    if trace is not None:
+        trace.session = session
+
+    # reference data is cached per token; the refresh param reloads it
+    refresh = str(dict(params).get('refresh', False)).lower() == 'true'
+
     # see here for more info:
     # https://knowledge.hubspot.com/deals/hubspots-default-deal-properties
     # https://developers.hubspot.com/docs/methods/deals/get-all-deals
@@ -127,159 +293,374 @@ def get_data(params):
     # https://developers.hubspot.com/docs/methods/pipelines/pipelines_overview
     # https://developers.hubspot.com/docs/methods/pipelines/get_pipelines_for_object_type
 
-    # STEP 1: get the owner info
     headers = {
         'Authorization': 'Bearer ' + auth_token,
     }
-    url = 'https://api.hubapi.com/owners/v2/owners'
-    url_query_params = {'includeInactive': True}
-    url_query_str = urllib.parse.urlencode(url_query_params)
 
-    page_url = url + '?' + url_query_str
-    response = requests_retry_session().get(page_url, headers=headers)
-    response.raise_for_status()
-    content = response.json()
-    data = content
+    # filters on deal properties are sent to the search api so only the
+    # matching deals are returned; the rest are checked on each row before
+    # it's written; incremental calls read the deals from the mirror
+    # instead, where filters on indexed columns are applied by the query
+    rebuild = str(dict(params).get('rebuild', False)).lower() == 'true'
+    incremental = rebuild or str(dict(params).get('incremental', False)).lower() == 'true'
+    partitions = get_partitions(params)
+    ordered = str(dict(params).get('ordered', False)).lower() == 'true'
+    filters = get_filters(COLUMNS, dict(params).get('filter'))
+    search_filters, mirror_filters = [], OrderedDict()
+    if incremental is True:
+        mirror_filters, local_filters = split_mirror_filters(filters, MIRROR_INDEXES)
+    elif partitions > 1:
+        # two of the search filters are used for each partition's range
+        search_filters, local_filters = split_filters(filters, SEARCH_PROPERTIES, SEARCH_FILTER_LIMIT - 2)
+    else:
+        search_filters, local_filters = split_filters(filters, SEARCH_PROPERTIES)
+
+    # a search can only page through SEARCH_RESULT_LIMIT deals, so when more
+    # match the search filters, all the deals are paged through and every
+    # filter is checked on each row instead
+    if len(search_filters) > 0 and partitions == 1:
+        url = API_BASE_URL + '/crm/v3/objects/deals/search'
+        if is_over_search_limit(session, url, headers, search_filters):
+            search_filters, local_filters = [], filters
+
+    # a checkpoint from an earlier call with the same run id picks up after
+    # the last page that call returned; calls reading the mirror read all of
+    # it each time and partitions don't have a single cursor, so neither are
+    # checkpointed
+    page_cursor_id = None
+    if incremental is True or partitions > 1:
+        checkpoint = None
+    if partitions > 1 and incremental is False and deadline is not None:
+        deadline.continuation = None
+    if checkpoint is not None:
+        page_cursor_id = checkpoint.state['page_cursor_id']
+
+    # only request the deal properties and lookups needed for the columns
+    # being returned and the columns being filtered locally; the filtered
+    # columns are built after the returned columns and trimmed off each row
+    columns = get_columns(COLUMNS, dict(params).get('properties'))
+    filter_columns = [c for c in local_filters.keys() if c not in columns]
+    predicate = get_predicate(local_filters, columns + filter_columns)
+
+    # with numpy, date columns are converted a page at a time
+    vectorized = has_optional('numpy')
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, columns + filter_columns, vectorized)
+    date_indexes = get_date_indexes(COLUMNS, columns + filter_columns) if vectorized else []
+    request_properties = get_request_properties(COLUMNS, columns + filter_columns)
+    lookups = get_lookups(COLUMNS, columns + filter_columns) if incremental is False else set()
+    if (len(search_filters) > 0 or partitions > 1) and 'portal_id' in columns + filter_columns:
+        lookups.add('portal') # search results don't include the portal id
+
+    # STEP 1 and STEP 2: start the owner and stage requests; these don't
+    # depend on each other or on the deal pages, so they run alongside the
+    # first deal page request and are only joined when the first page is
+    # transformed
+    executor = ThreadPoolExecutor(max_workers=3)
+    owners_future, stages_future, portal_future = None, None, None
+    if 'owners' in lookups:
+        owners_future = executor.submit(get_owners, session, API_BASE_URL, headers, get_cache_key(auth_token, 'owners'), refresh)
+    if 'stages' in lookups:
+        stages_future = executor.submit(get_stages, session, headers, get_cache_key(auth_token, 'stages'), refresh)
+    if 'portal' in lookups:
+        portal_future = executor.submit(get_portal_id, session, API_BASE_URL, headers, get_cache_key(auth_token, 'portal'), refresh)
+    executor.shutdown(wait=False)
 
-    owners = {}
-    for item in data:
-        owners[item.get('ownerId')] = item
+    # STEP 3: get the deal info
+    if incremental is True:
+        pages = get_mirror_pages(session, headers, auth_token, columns + filter_columns, mirror_filters, rebuild, refresh)
+    elif partitions > 1:
+        url = API_BASE_URL + '/crm/v3/objects/deals/search'
+        pages = get_partition_pages(session, url, headers, request_properties, search_filters, get_search_item, partitions, ordered)
+    elif len(search_filters) > 0:
+        url = API_BASE_URL + '/crm/v3/objects/deals/search'
+        pages = get_search_pages(session, url, headers, request_properties, search_filters, get_search_item, page_cursor_id)
+    else:
+        url = API_BASE_URL + '/deals/v1/deal/paged'
+        pages = get_pages(session, url, headers, request_properties, page_cursor_id, get_item_paths(COLUMNS, columns + filter_columns, ITEM_PATHS))
+
+    # fetch the pages in a background thread so the next page is on its way
+    # while the current page is being transformed and written
+    if trace is not None:
+        pages = trace.track(pages)
+    pages = prefetch(pages, PAGE_PREFETCH_DEPTH)
+    if deadline is not None:
+        pages = until_deadline(pages, deadline)
+    for data, page_cursor_id in pages:
+
+        if trace is not None:
+            trace.start_page()
+
+        if incremental is True:
+            # rows read from the mirror are already built
+            rows = data
+        else:
+            owners = owners_future.result() if owners_future is not None else {}
+            stages = stages_future.result() if stages_future is not None else {}
+            portal_id = portal_future.result() if portal_future is not None else None
+
+            if portal_id is not None:
+                for item in data:
+                    item['portalId'] = portal_id
+
+            started = time.perf_counter() if trace is not None else None
+            rows = convert_dates([extract(item, owners, stages) for item in data], date_indexes)
+            if trace is not None:
+                trace.transformed(time.perf_counter() - started)
+
+        count = 0
+        for row in rows:
+            if predicate is not None and not predicate(row):
+                continue
+            if len(filter_columns) > 0:
+                row = row[:len(columns)]
+            count += 1
+            yield row
+
+        if trace is not None:
+            trace.emitted(count)
+        if checkpoint is not None:
+            checkpoint.save(page_cursor_id, count)
+
+def get_stages(session, headers, cache_key, refresh=False):
+
+    # pipelines rarely change, so the raw pipeline list is cached and the
+    # stage lookup is built from the cached copy
+    def fetch():
+        url = API_BASE_URL + '/crm-pipelines/v1/pipelines/deals'
+        url_query_params = {'includeInactive': 'INCLUDE_DELETED'}
+        url_query_str = urllib.parse.urlencode(url_query_params)
 
-    # STEP 2: get the stage info
-    headers = {
-        'Authorization': 'Bearer ' + auth_token,
-    }
-    url = 'https://api.hubapi.com/crm-pipelines/v1/pipelines/deals'
-    url_query_params = {'includeInactive': 'INCLUDE_DELETED'}
-    url_query_str = urllib.parse.urlencode(url_query_params)
+        page_url = url + '?' + url_query_str
+        response = session.get(page_url, headers=headers)
+        response.raise_for_status()
+        content = response.json()
+        return content.get('results',[])
 
-    page_url = url + '?' + url_query_str
-    response = requests_retry_session().get(page_url, headers=headers)
-    response.raise_for_status()
-    content = response.json()
-    data = content.get('results',[])
+    data = get_cached(cache_key, fetch, refresh)
 
     stages = {}
     for item in data:
         for s in item.get('stages',[]):
             stages[s.get('stageId')] = s
+    return stages
 
-    # STEP 3: get the deal info
-    headers = {
-        'Authorization': 'Bearer ' + auth_token,
-    }
-    url = 'https://api.hubapi.com/deals/v1/deal/paged'
-
-    request_properties = [
-        'dealname','hubspot_owner_id','dealstage','dealtype','amount','amount_in_home_currency',
-        'closed_lost_reason','closed_won_reason','forecast_close_date', # forecast_close_date is example of custom field
-        'closedate','description','pipeline','num_associated_contacts','num_notes',
-        'num_contacted_notes','notes_last_contacted','notes_next_activity_date','createdate',
-        'notes_last_updated'
-    ]
+def get_pages(session, url, headers, request_properties, page_cursor_id=None, paths=None):
 
-    page_size = 250
-    page_cursor_id = None
+    # yields each page along with the cursor for the page after it, or None
+    # after the last page, so a caller can pick up from where it left off;
+    # the size of each page is chosen by a PageSizer
+    sizer = PageSizer(PAGE_MAX_SIZE)
     while True:
 
-        url_query_params = {'limit': page_size}
+        url_query_params = {'limit': sizer.size}
         if page_cursor_id is not None:
             url_query_params['offset'] = page_cursor_id
         url_query_str = urllib.parse.urlencode(url_query_params)
-        url_request_properties = "&properties=" + "&properties=".join(request_properties)
+        url_request_properties = ''.join(["&properties=" + p for p in request_properties])
 
         page_url = url + '?' + url_query_str + url_request_properties
-        response = requests_retry_session().get(page_url, headers=headers)
-        response.raise_for_status()
-        content = response.json()
-        data = content.get('deals',[])
+        try:
+            content, data = get_page(session, page_url, headers, 'deals', paths, sizer)
+        except Exception as e:
+            if sizer.retry(e) is False:
+                raise
+            continue
 
         if len(data) == 0 :# sanity check in case there's an issue with cursor
             break
 
-        buffer = ''
-        for item in data:
-            item = get_item_info(item, owners, stages)
-            buffer = buffer + json.dumps(item, default=to_string) + "\n"
-        yield buffer
-
+        page_cursor_id = content.get('offset')
         has_more = content.get('hasMore', False)
         if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None:
+            break
+
+def get_recent_pages(session, url, headers, since, paths=None):
+
+    # see here for more info:
+    # https://developers.hubspot.com/docs/methods/deals/get_deals_modified
+    # note: deals are returned most recently modified first and only the
+    # first MIRROR_RECENT_LIMIT can be paged through; like get_pages(), each
+    # page is yielded with the cursor for the page after it, so a cursor
+    # other than None after the last page means some deals were left out
+
+    page_size = 100
+    page_cursor_id = None
+    while True:
+
+        url_query_params = {'count': page_size, 'since': since}
+        if page_cursor_id is not None:
+            url_query_params['offset'] = page_cursor_id
+        url_query_str = urllib.parse.urlencode(url_query_params)
+
+        page_url = url + '?' + url_query_str
+        content, data = get_page(session, page_url, headers, 'results', paths)
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
             break
 
         page_cursor_id = content.get('offset')
+        has_more = content.get('hasMore', False)
+        if has_more is False:
+            page_cursor_id = None
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None or page_cursor_id + page_size > MIRROR_RECENT_LIMIT:
+            break
 
-def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(429, 500, 502, 503, 504),
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
+def get_mirror_pages(session, headers, auth_token, columns, filters, rebuild=False, refresh=False):
+
+    # bring the mirror of the portal's deals up to date and then read the
+    # columns of the matching deals back from it a page of rows at a time
+    key = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+    mirror = Mirror(MIRROR_PATH, 'deals', list(COLUMNS.keys()), MIRROR_INDEXES)
+    sync_mirror(session, headers, mirror, key, auth_token, rebuild, refresh)
+    for rows in mirror.read(key, columns, filters):
+        yield rows, None
+
+def sync_mirror(session, headers, mirror, key, auth_token, rebuild=False, refresh=False):
+
+    # the sync state holds the high-water mark (the latest
+    # hs_lastmodifieddate in the mirror), the time of the last sync and,
+    # while a full sync is underway, the cursor (offset) of the next page so
+    # an interrupted full sync picks up where it stopped
+    now = time.time()
+    state = mirror.get_state(key) if rebuild is False else None
+    if state is not None and state['complete'] is True and now - state['synced_at'] < MIRROR_MAX_STALENESS:
+        return
+
+    # rows are built with all the columns, so all the lookups are needed;
+    # owner names and stage labels are those at the time a deal is synced
+    owners = get_owners(session, API_BASE_URL, headers, get_cache_key(auth_token, 'owners'), refresh)
+    stages = get_stages(session, headers, get_cache_key(auth_token, 'stages'), refresh)
+    extract = get_extractor(COLUMNS, EXTRACTOR_ARGS, list(COLUMNS.keys()))
+    paths = get_item_paths(COLUMNS, list(COLUMNS.keys()), ITEM_PATHS)
+    request_properties = get_request_properties(COLUMNS, list(COLUMNS.keys())) + ['hs_lastmodifieddate']
+    def get_rows(data):
+        return [(item.get('dealId'), get_modified(item), extract(item, owners, stages)) for item in data]
+
+    full_sync = (
+        state is None or
+        state['complete'] is False or
+        now - state['full_sync_started'] > MIRROR_MAX_AGE or
+        now - state['synced_at'] > MIRROR_RECENT_WINDOW
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-def to_date(ts):
-    if ts is None or ts == '':
-        return ''
-    return datetime.utcfromtimestamp(int(ts)/1000).strftime('%Y-%m-%dT%H:%M:%S')
-
-def to_integer(value):
-    try:
-        return int(value)
-    except:
-        return value
-
-def to_string(value):
-    if isinstance(value, (date, datetime)):
-        return value.isoformat()
-    if isinstance(value, (Decimal)):
-        return str(value)
-    return value
-
-def get_item_info(item, owners, stages):
-
-    info = OrderedDict()
-
-    info['portal_id'] = to_integer(item.get('portalId'))
-
-    owner_id = to_integer(item.get('properties',{}).get('hubspot_owner_id',{}).get('value'))
-    info['owner_id'] = owner_id
-    info['owner_first_name'] = owners.get(owner_id,{}).get('firstName')
-    info['owner_last_name'] = owners.get(owner_id,{}).get('lastName')
-
-    info['deal_id'] = to_integer(item.get('dealId'))
-    info['deal_name'] = item.get('properties',{}).get('dealname',{}).get('value','')
-
-    deal_stage_id =  item.get('properties',{}).get('dealstage',{}).get('value') # note: this id can contain strings (e.g. "closed")
-    info['deal_stage_id'] = deal_stage_id
-    info['deal_stage_label'] = stages.get(deal_stage_id,{}).get('label','')
-
-    info['deal_type'] = item.get('properties',{}).get('dealtype',{}).get('value','')
-    info['amount'] = to_integer(item.get('properties',{}).get('amount',{}).get('value',''))
-    info['amount_in_home_currency'] = to_integer(item.get('properties',{}).get('amount_in_home_currency',{}).get('value',''))
-    info['closed_lost_reason'] = item.get('properties',{}).get('closed_lost_reason',{}).get('value','')
-    info['closed_won_reason'] = item.get('properties',{}).get('closed_won_reason',{}).get('value','')
-    info['forecast_close_date'] = to_date(item.get('properties',{}).get('forecast_close_date',{}).get('value',None)) # example of custom field
-    info['close_date'] = to_date(item.get('properties',{}).get('closedate',{}).get('value',None))
-    info['description'] = item.get('properties',{}).get('description',{}).get('value','')
-    info['pipeline'] = item.get('properties',{}).get('pipeline',{}).get('value','')
-    info['num_notes'] = to_integer(item.get('properties',{}).get('num_notes',{}).get('value',''))
-    info['num_associated_contacts'] = to_integer(item.get('properties',{}).get('num_associated_contacts',{}).get('value',''))
-    info['num_contacted_notes'] = to_integer(item.get('properties',{}).get('num_contacted_notes',{}).get('value',''))
-    info['notes_last_contacted'] = to_date(item.get('properties',{}).get('notes_last_contacted',{}).get('value',None))
-    info['notes_last_updated'] = to_date(item.get('properties',{}).get('notes_last_updated',{}).get('value',None))
-    info['notes_next_activity_date'] = to_date(item.get('properties',{}).get('notes_next_activity_date',{}).get('value',None))
-    info['created_at'] = to_date(item.get('properties',{}).get('createdate',{}).get('value',None))
-
-    return info
 
+    if full_sync is False:
+        # recently modified deals are listed newest first, so the high-water
+        # mark is only moved once all the changes are saved
+        url = API_BASE_URL + '/deals/v1/deal/recent/modified'
+        since = state['high_water_mark'] - MIRROR_OVERLAP*1000
+        high_water_mark = state['high_water_mark']
+        page_cursor_id = None
+        for data, page_cursor_id in get_recent_pages(session, url, headers, since, paths):
+            high_water_mark = max([high_water_mark] + [get_modified(item) for item in data])
+            mirror.save(key, get_rows(data), state, now)
+        if page_cursor_id is None:
+            state['high_water_mark'] = high_water_mark
+            state['synced_at'] = now
+            mirror.save(key, [], state, now)
+            return
+        # more deals were modified than can be listed, so fall through to a
+        # full sync
+
+    if state is None or state['complete'] is True or now - state['full_sync_started'] > MIRROR_MAX_AGE:
+        state = {'complete': False, 'full_sync_started': now, 'synced_at': now, 'high_water_mark': 0, 'page_cursor_id': None}
+
+    # rows saved by this full sync are marked with the time it started; rows
+    # left from before then are deleted once it completes
+    url = API_BASE_URL + '/deals/v1/deal/paged'
+    for data, page_cursor_id in get_pages(session, url, headers, request_properties, state['page_cursor_id'], paths):
+        state['high_water_mark'] = max([state['high_water_mark']] + [get_modified(item) for item in data])
+        state['page_cursor_id'] = page_cursor_id
+        mirror.save(key, get_rows(data), state, state['full_sync_started'])
+    mirror.finish(key, state)
+
+def get_modified(item):
+    value = to_integer(item.get('properties',{}).get('hs_lastmodifieddate',{}).get('value'))
+    return value if isinstance(value, int) else 0
+
+def get_search_item(result):
+
+    # convert a search result into the shape of a deal from the v1 api so
+    # the same column functions apply; search returns dates as iso strings
+    # rather than epoch milliseconds and returns null for empty properties
+    properties = {}
+    for name, value in result.get('properties',{}).items():
+        if value is None:
+            continue
+        if name in DATE_PROPERTIES:
+            value = from_iso_date(value)
+        properties[name] = {'value': value}
+
+    return {'dealId': result.get('id'), 'properties': properties}
+
+# paths within each deal that are read outside of the columns, such as by
+# the mirror
+ITEM_PATHS = ['dealId', 'properties.hs_lastmodifieddate.value']
+
+# the output schema; each column is built by following its source path from
+# the extractor's arguments and converting the value, with the default used
+# when the last key in the path is missing; see parse_source() for the path
+# syntax
+EXTRACTOR_ARGS = ['item', 'owners', 'stages']
+COLUMNS = OrderedDict([
+    ('portal_id',                ('item.portalId', to_integer, None)),
+    ('owner_id',                 ('item.properties.hubspot_owner_id.value', to_integer, None)),
+    ('owner_first_name',         ('owners[owner_id].firstName', None, None)),
+    ('owner_last_name',          ('owners[owner_id].lastName', None, None)),
+    ('deal_id',                  ('item.dealId', to_integer, None)),
+    ('deal_name',                ('item.properties.dealname.value', None, '')),
+    ('deal_stage_id',            ('item.properties.dealstage.value', None, None)), # note: this id can contain strings (e.g. "closed")
+    ('deal_stage_label',         ('stages[deal_stage_id].label', None, '')),
+    ('deal_type',                ('item.properties.dealtype.value', None, '')),
+    ('amount',                   ('item.properties.amount.value', to_integer, '')),
+    ('amount_in_home_currency',  ('item.properties.amount_in_home_currency.value', to_integer, '')),
+    ('closed_lost_reason',       ('item.properties.closed_lost_reason.value', None, '')),
+    ('closed_won_reason',        ('item.properties.closed_won_reason.value', None, '')),
+    ('forecast_close_date',      ('item.properties.forecast_close_date.value', to_date, None)), # example of custom field
+    ('close_date',               ('item.properties.closedate.value', to_date, None)),
+    ('description',              ('item.properties.description.value', None, '')),
+    ('pipeline',                 ('item.properties.pipeline.value', None, '')),
+    ('num_notes',                ('item.properties.num_notes.value', to_integer, '')),
+    ('num_associated_contacts',  ('item.properties.num_associated_contacts.value', to_integer, '')),
+    ('num_contacted_notes',      ('item.properties.num_contacted_notes.value', to_integer, '')),
+    ('notes_last_contacted',     ('item.properties.notes_last_contacted.value', to_date, None)),
+    ('notes_last_updated',       ('item.properties.notes_last_updated.value', to_date, None)),
+    ('notes_next_activity_date', ('item.properties.notes_next_activity_date.value', to_date, None)),
+    ('created_at',               ('item.properties.createdate.value', to_date, None)),
+])
+
+# columns that map directly to a deal property that can be filtered with the
+# search api; other columns, such as labels from lookups and formatted dates,
+# are filtered locally
+SEARCH_PROPERTIES = {
+    'owner_id': 'hubspot_owner_id',
+    'deal_id': 'hs_object_id',
+    'deal_name': 'dealname',
+    'deal_stage_id': 'dealstage',
+    'deal_type': 'dealtype',
+    'amount': 'amount',
+    'amount_in_home_currency': 'amount_in_home_currency',
+    'closed_lost_reason': 'closed_lost_reason',
+    'closed_won_reason': 'closed_won_reason',
+    'description': 'description',
+    'pipeline': 'pipeline',
+    'num_notes': 'num_notes',
+    'num_associated_contacts': 'num_associated_contacts',
+    'num_contacted_notes': 'num_contacted_notes',
+}
+# deal properties that hold dates; the search api returns these as iso
+# strings rather than epoch milliseconds
+DATE_PROPERTIES = set([
+    'forecast_close_date','closedate','notes_last_contacted','notes_last_updated',
+    'notes_next_activity_date','createdate'
+])
+
+# compile the extractor for all the columns when the function is loaded
+get_extractor(COLUMNS, EXTRACTOR_ARGS, list(COLUMNS.keys()))
@@ -0,0 +1,2374 @@
+
+# ---
+# name: hubspot-core
+# deployed: false
+# title: HubSpot Core
+# description: The code shared by the HubSpot functions, which import it from the same directory; it's deployed with them but isn't a function itself
+# ---
+
+# the code shared by the hubspot functions: sessions, rate limiting, time
+# limits, paging, searches, mirrors, caching, checkpoints, traces, summaries,
+# reads of several portals, the output writers and the parsing of the
+# columns and filters; the functions import it from the same directory and
+# pass in their own COLUMNS, api base url and name where these differ
+#
+# requests (with urllib3), numpy, ijson and orjson are imported the first
+# time they're used rather than with this module, so a cold start doesn't
+# pay for an import before it's needed, or at all if it never is (e.g. for
+# a call that fails on its params or only reads a mirror); see
+# get_requests() and get_optional()
+
+import io
+import os
+import re
+import csv
+import sys
+import json
+import time
+import heapq
+import queue
+import hashlib
+import stat
+import sqlite3
+import tempfile
+import urllib.parse
+import importlib.util
+import threading
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# number of pooled keep-alive connections; a single session is shared by all
+# requests made during an invocation so the connection is reused across pages
+CONNECTION_POOL_SIZE = 10
+
+# a paged api is asked for at least PAGE_MIN_SIZE records a page; see
+# PageSizer for how the size of each page is chosen to take about
+# PAGE_TARGET_SECONDS and hold at most PAGE_MAX_BYTES
+PAGE_MIN_SIZE = 10
+PAGE_TARGET_SECONDS = 5.0
+PAGE_MAX_BYTES = 16*1048576
+PAGE_SIZE_RETRIES = 3
+
+# number of pages fetched ahead of the page being transformed; set to 0 to
+# fetch each page only after the previous one has been written
+PAGE_PREFETCH_DEPTH = 2
+
+# rows are encoded into a buffer that's written to the output once it holds
+# at least this many bytes; for the arrow and parquet formats, rows are
+# written in record batches of OUTPUT_BATCH_SIZE rows
+OUTPUT_BUFFER_SIZE = 65536
+OUTPUT_BATCH_SIZE = 10000
+
+# the rate limit state, caches, checkpoints and mirrors (which hold copies of
+# crm records, such as contact emails and deal amounts) are kept in
+# DATA_PATH, a directory that only the user running the functions can use;
+# it's created with mode 0700 and its files with mode 0600, and defaults to
+# a directory named for the user in the temp directory unless it's set by
+# the FLEXIO_HUBSPOT_DATA_PATH environment variable
+DATA_PATH = os.environ.get('FLEXIO_HUBSPOT_DATA_PATH') or os.path.join(tempfile.gettempdir(),
+    'flexio-hubspot-' + (str(os.getuid()) if hasattr(os, 'getuid') else 'data'))
+
+# requests are paced per token with a token bucket; RATE_LIMITS holds the
+# starting (requests, seconds) for each bucket until hubspot's rate limit
+# headers say otherwise; RATE_LIMIT_BACKEND is one of 'memory' (per process),
+# 'file' or 'sqlite' (shared by processes on the same machine); the buckets
+# are shared by all the functions, as hubspot's limits are
+RATE_LIMITS = {'default': (100, 10.0), 'search': (4, 1.0)}
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BACKEND = 'memory'
+RATE_LIMIT_PATH = os.path.join(DATA_PATH, 'ratelimit')
+
+# reference data, such as owners and deal stages, is cached between
+# invocations for CACHE_TTL seconds; CACHE_BACKEND is one of 'memory' (per
+# process), 'file' or 'sqlite' (shared by processes on the same machine)
+CACHE_BACKEND = 'memory'
+CACHE_TTL = 3600
+CACHE_MAX_ENTRIES = 256
+CACHE_PATH = os.path.join(DATA_PATH, 'cache')
+
+# with the run_id param, the cursor of each page returned is saved under the
+# run id, so calling again with the same id after a failure continues after
+# the last page returned rather than starting over; checkpoints are kept for
+# CHECKPOINT_TTL seconds
+CHECKPOINT_PATH = os.path.join(DATA_PATH, 'checkpoints.sqlite')
+CHECKPOINT_TTL = 7*86400
+
+# each request times out after REQUEST_TIMEOUT (connect, read) seconds or, with
+# the time_limit param, at the time limit less DEADLINE_MARGIN seconds, which
+# are left for writing the rows fetched before then
+REQUEST_TIMEOUT = (10, 60)
+DEADLINE_MARGIN = 2
+
+# with the partitions param, ranges of createdate are searched in parallel,
+# at most PARTITION_CONCURRENCY at a time (requests are still paced by the
+# rate limiter), each with at most PARTITION_QUEUE_SIZE fetched pages
+# waiting to be written; a range with more than SEARCH_RESULT_LIMIT records,
+# which is as many as a search can page through, is split in half; a search
+# allows at most SEARCH_FILTER_LIMIT filters in a group
+PARTITION_CONCURRENCY = 4
+PARTITION_QUEUE_SIZE = 4
+SEARCH_RESULT_LIMIT = 10000
+SEARCH_FILTER_LIMIT = 3
+
+# with the hubspot_connections param, the portals are read PORTAL_CONCURRENCY
+# at a time, each with its own session and rate limit budget; rows are passed
+# on from each portal's thread in batches of PORTAL_BATCH_SIZE rows, with at
+# most PORTAL_QUEUE_SIZE batches waiting to be written
+PORTAL_CONCURRENCY = 8
+PORTAL_BATCH_SIZE = 500
+PORTAL_QUEUE_SIZE = 16
+
+# rows are read back from a function's mirror MIRROR_PAGE_SIZE at a time
+MIRROR_PAGE_SIZE = 1000
+
+def make_private_directory(path):
+
+    # create a directory, and any missing directories above it, with mode
+    # 0700; an existing directory has to be a real directory (not a symlink)
+    # owned by the current user that no one else can use, so other local
+    # users can't read the files in it or swap them for symlinks
+    path = os.path.abspath(path)
+    if not os.path.lexists(path):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            make_private_directory(parent)
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise OSError("The data directory '" + path + "' isn't a directory.")
+    if hasattr(os, 'getuid') and (info.st_uid != os.getuid() or info.st_mode & 0o077 != 0):
+        raise OSError("The data directory '" + path + "' has to be owned by the current user and only usable by them (mode 0700).")
+    return path
+
+def make_private_file(path):
+
+    # create a file in a private directory with mode 0600 if it doesn't
+    # exist; sqlite gives the journal files of a database the database's
+    # mode, so they're private too
+    make_private_directory(os.path.dirname(os.path.abspath(path)))
+    os.close(open_private(path, os.O_WRONLY | os.O_CREAT))
+    return path
+
+def open_private(path, flags):
+
+    # an opener for open() that creates files with mode 0600 and doesn't
+    # follow a symlink
+    return os.open(path, flags | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+
+def get_requests():
+
+    # import requests the first time a session is made and define the
+    # retry and adapter classes, which subclass requests and urllib3 classes
+    global requests, DeadlineRetry, TimeoutAdapter, RateLimitedAdapter
+    with _import_lock:
+        if requests is not None:
+            return requests
+        import requests as module
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
+        class DeadlineRetry(Retry):
+
+            # a request that timed out at the deadline isn't retried, since
+            # the retry would run past it
+
+            def __init__(self, deadline=None, **kwargs):
+                self.deadline = deadline
+                super(DeadlineRetry, self).__init__(**kwargs)
+
+            def new(self, **kwargs):
+                retry = super(DeadlineRetry, self).new(**kwargs)
+                retry.deadline = self.deadline
+                return retry
+
+            def increment(self, *args, **kwargs):
+                if self.deadline is not None and self.deadline.remaining() <= 0:
+                    raise DeadlineExceeded('The time limit was reached')
+                return super(DeadlineRetry, self).increment(*args, **kwargs)
+
+        class TimeoutAdapter(HTTPAdapter):
+
+            # transport adapter that gives each request without its own
+            # timeout REQUEST_TIMEOUT, cut to the time left before the
+            # deadline, if any
+
+            def __init__(self, deadline=None, **kwargs):
+                self.deadline = deadline
+                super(TimeoutAdapter, self).__init__(**kwargs)
+
+            def send(self, request, **kwargs):
+                if kwargs.get('timeout') is None:
+                    kwargs['timeout'] = get_timeout(self.deadline)
+                return super(TimeoutAdapter, self).send(request, **kwargs)
+
+        class RateLimitedAdapter(TimeoutAdapter):
+
+            # transport adapter that takes a token from the rate limiter
+            # before each request and updates the limiter from each response;
+            # 429 responses are retried here rather than by urllib3 so the
+            # Retry-After is shared with every other request using the same
+            # bucket
+
+            def __init__(self, limiter, **kwargs):
+                self.limiter = limiter
+                super(RateLimitedAdapter, self).__init__(**kwargs)
+
+            def send(self, request, **kwargs):
+                bucket = 'search' if request.url.split('?')[0].endswith('/search') else 'default'
+                waited = 0.0
+                for attempt in range(RATE_LIMIT_RETRIES + 1):
+                    waited += self.limiter.acquire(bucket, self.deadline)
+                    started = time.time()
+                    response = super(RateLimitedAdapter, self).send(request, **kwargs)
+                    self.limiter.update(bucket, response.headers, response.status_code, time.time() - started)
+                    if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                        response.rate_limit_retries = attempt
+                        response.rate_limit_seconds = waited
+                        return response
+                    response.close()
+
+        requests = module
+        return requests
+
+def is_request_error(error):
+
+    # whether the error was raised by requests or, for a streamed response
+    # that's cut off while it's read, by urllib3
+    requests = get_requests()
+    from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+    return isinstance(error, (requests.exceptions.RequestException, ProtocolError, ReadTimeoutError))
+
+def get_optional(name, wait=True):
+
+    # import an optional dependency, such as numpy, ijson or orjson, the
+    # first time it's used; None if it isn't installed; without waiting, a
+    # dependency that isn't imported yet is imported in a background thread
+    # and None is returned until it has been, for callers that can do
+    # without it in the meantime
+    module = _optional.get(name, _missing)
+    if module is _missing and wait is False:
+        with _import_lock:
+            if name not in _importing:
+                _importing.add(name)
+                threading.Thread(target=get_optional, args=(name,), daemon=True).start()
+        return None
+    if module is _missing:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            module = None
+        _optional[name] = module
+    return module
+
+def has_optional(name):
+
+    # whether an optional dependency is installed, without importing it
+    installed = _installed.get(name)
+    if installed is None:
+        installed = _optional.get(name) is not None or importlib.util.find_spec(name) is not None
+        _installed[name] = installed
+    return installed
+
+requests = None
+DeadlineRetry = None
+TimeoutAdapter = None
+RateLimitedAdapter = None
+_import_lock = threading.Lock()
+_optional = {}
+_installed = {}
+_importing = set()
+_missing = object()
+
+def decode_json(response):
+
+    # orjson decodes a response several times faster than the json module
+    # when it's installed
+    orjson = get_optional('orjson')
+    return orjson.loads(response.content) if orjson is not None else response.json()
+
+def get_checkpoint(params, name, flush=None, deadline=None):
+
+    # the checkpoint for the run id given in the params, if any; a run is
+    # identified by the token and function as well as the id, and the
+    # checkpoint is only used for a call with the same properties and filter;
+    # a call with a deadline needs a run id, since the caller may not see
+    # anything but the rows, so it has to know the id to continue with
+    run_id = dict(params).get('run_id')
+    if (run_id is None or len(str(run_id).strip()) == 0) and deadline is not None:
+        raise ValueError("Invalid run_id ''. A call with a time_limit needs a run_id to call again with to return the rest of the rows.")
+    if run_id is None or len(str(run_id).strip()) == 0:
+        return None
+    if deadline is not None:
+        deadline.continuation = str(run_id).strip()
+    auth_token = dict(params).get('hubspot_connection',{}).get('access_token')
+    key = hashlib.sha256((auth_token + ':' + name + ':' + str(run_id).strip()).encode('utf-8')).hexdigest()
+    fingerprint = json.dumps([dict(params).get('properties'), dict(params).get('filter')], default=str)
+    return Checkpoint(CHECKPOINT_PATH, key, fingerprint, flush)
+
+class Checkpoint(object):
+
+    # the cursor of the last page returned by a run and the number of rows
+    # returned so far, saved in a local sqlite database after each page; the
+    # output is flushed before each checkpoint is saved so a checkpoint is
+    # never ahead of what's been written; the checkpoint is deleted once the
+    # last page is returned, so calling again with the run id of a run that
+    # completed starts a new run
+
+    def __init__(self, path, key, fingerprint, flush=None):
+        self.path = make_private_file(path)
+        self.key = key
+        self.flush = flush
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, state TEXT, updated REAL)')
+            row = db.execute('SELECT state FROM checkpoints WHERE key = ?', (key,)).fetchone()
+        self.state = json.loads(row[0]) if row is not None else None
+        if self.state is None or self.state.get('fingerprint') != fingerprint or self.state.get('complete') is True:
+            self.state = {'fingerprint': fingerprint, 'page_cursor_id': None, 'rows': 0, 'complete': False}
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def save(self, page_cursor_id, rows):
+        if self.flush is not None:
+            self.flush()
+        self.state['page_cursor_id'] = page_cursor_id
+        self.state['rows'] += rows
+        self.state['complete'] = page_cursor_id is None
+        now = time.time()
+        with self.connect() as db:
+            if self.state['complete'] is True:
+                db.execute('DELETE FROM checkpoints WHERE key = ?', (self.key,))
+            else:
+                db.execute('REPLACE INTO checkpoints (key, state, updated) VALUES (?, ?, ?)', (self.key, json.dumps(self.state), now))
+            db.execute('DELETE FROM checkpoints WHERE updated < ?', (now - CHECKPOINT_TTL,))
+
+def split_mirror_filters(filters, indexes):
+
+    # filters on indexed columns (a function's MIRROR_INDEXES) are applied by
+    # the mirror's query; the rest are checked on each row
+    mirror_filters, local_filters = OrderedDict(), OrderedDict()
+    for name, values in filters.items():
+        if name in indexes:
+            mirror_filters[name] = values
+        else:
+            local_filters[name] = values
+    return mirror_filters, local_filters
+
+class Mirror(object):
+
+    # the rows of each portal, built with the given columns (all of a
+    # function's columns, unless some of them are only built on request), in
+    # a local sqlite table along with the state of each portal's last sync;
+    # each row keeps the id and modified time of the record it was built
+    # from, the columns in indexes (a function's MIRROR_INDEXES) are indexed
+    # the way filters compare them, the columns in booleans are read back as
+    # booleans rather than the 1 and 0 sqlite stores, and the table is
+    # rebuilt when the columns change
+
+    def __init__(self, path, table, columns, indexes, booleans=None):
+        self.path = make_private_file(path)
+        self.table = table
+        self.booleans = booleans or []
+        fields = ['portal_key', 'item_id', 'modified', 'synced'] + list(columns)
+        with self.connect() as db:
+            existing = [r[1] for r in db.execute('PRAGMA table_info(' + table + ')')]
+            if len(existing) > 0 and existing != fields:
+                db.execute('DROP TABLE ' + table)
+                db.execute('DROP TABLE IF EXISTS sync_state')
+            db.execute('CREATE TABLE IF NOT EXISTS ' + table + ' (' + ', '.join(['"' + f + '"' for f in fields]) + ')')
+            db.execute('CREATE INDEX IF NOT EXISTS ' + table + '_item_id ON ' + table + ' (portal_key, item_id)')
+            for name in indexes:
+                db.execute('CREATE INDEX IF NOT EXISTS ' + table + '_' + name + ' ON ' + table + ' (portal_key, ' + self.match(name) + ')')
+            db.execute('CREATE TABLE IF NOT EXISTS sync_state (portal_key TEXT PRIMARY KEY, state TEXT)')
+        self.insert = 'INSERT INTO ' + table + ' (' + ', '.join(['"' + f + '"' for f in fields]) + ') VALUES (' + ', '.join(['?'] * len(fields)) + ')'
+
+    def match(self, name):
+        # the value of a column as it's compared by to_filter_value()
+        return 'lower(coalesce(CAST("' + name + '" AS TEXT), \'\'))'
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get_state(self, key):
+        with self.connect() as db:
+            row = db.execute('SELECT state FROM sync_state WHERE portal_key = ?', (key,)).fetchone()
+            return json.loads(row[0]) if row is not None else None
+
+    def save(self, key, rows, state, synced):
+
+        # rows are (item id, modified, row) tuples that replace the rows
+        # previously built from the same items; the rows and the sync state
+        # are saved in one transaction so the state always matches the rows
+        item_ids = set([r[0] for r in rows])
+        with self.connect() as db:
+            db.executemany('DELETE FROM ' + self.table + ' WHERE portal_key = ? AND item_id = ?', [(key, i) for i in item_ids])
+            db.executemany(self.insert, [(key, item_id, modified, synced) + row for item_id, modified, row in rows])
+            db.execute('REPLACE INTO sync_state (portal_key, state) VALUES (?, ?)', (key, json.dumps(state)))
+
+    def finish(self, key, state):
+
+        # complete a full sync by deleting the rows it didn't save, which are
+        # the records deleted since the previous full sync
+        state['complete'] = True
+        state['page_cursor_id'] = None
+        with self.connect() as db:
+            db.execute('DELETE FROM ' + self.table + ' WHERE portal_key = ? AND synced < ?', (key, state['full_sync_started']))
+            db.execute('REPLACE INTO sync_state (portal_key, state) VALUES (?, ?)', (key, json.dumps(state)))
+
+    def read(self, key, columns, filters):
+        where, args = 'portal_key = ?', [key]
+        for name, values in filters.items():
+            where += ' AND ' + self.match(name) + ' IN (' + ', '.join(['?'] * len(values)) + ')'
+            args += [to_filter_value(v) for v in values]
+        select = 'SELECT ' + ', '.join(['"' + c + '"' for c in columns]) + ' FROM ' + self.table + ' WHERE ' + where + ' ORDER BY item_id, rowid'
+        booleans = [i for i, c in enumerate(columns) if c in self.booleans]
+        with self.connect() as db:
+            cursor = db.execute(select, args)
+            while True:
+                rows = cursor.fetchmany(MIRROR_PAGE_SIZE)
+                if len(rows) == 0:
+                    break
+                if len(booleans) > 0:
+                    rows = [to_booleans(row, booleans) for row in rows]
+                yield rows
+
+def to_booleans(row, indexes):
+    row = list(row)
+    for i in indexes:
+        if row[i] in (0, 1) and not isinstance(row[i], bool):
+            row[i] = row[i] == 1
+    return tuple(row)
+
+def get_page(session, url, headers, key, paths=None, sizer=None):
+
+    # get a page and return the top-level values of the response along with
+    # the list of items under 'key'; with ijson, the response is decoded as
+    # it's streamed and only the parts of each item on the given paths are
+    # built, so neither the raw response nor the parts of the items that
+    # aren't needed (such as property version histories or email bodies)
+    # are held in memory; with a sizer, the page is passed to the sizer
+    # once it's decoded so it can size the next page
+    trace = getattr(session, 'trace', None)
+    page_size = sizer.size if sizer is not None else None
+    timed = trace is not None or sizer is not None
+    started = time.perf_counter() if timed else None
+    if paths is None or get_optional('ijson') is None:
+        response = session.get(url, headers=headers)
+        received = time.perf_counter() if timed else None
+        response.raise_for_status()
+        content = decode_json(response)
+        items = content.get(key,[])
+        if trace is not None:
+            trace.request(response, started, received, page_size)
+        if sizer is not None:
+            sizer.observe(response, len(items), time.perf_counter() - started)
+        return content, items
+
+    with session.get(url, headers=headers, stream=True) as response:
+        received = time.perf_counter() if timed else None
+        response.raise_for_status()
+        response.raw.decode_content = True
+        content, items = decode_page(response.raw, key, paths)
+        if trace is not None:
+            trace.request(response, started, received, page_size)
+        if sizer is not None:
+            sizer.observe(response, len(items), time.perf_counter() - started)
+        return content, items
+
+class PageSizer(object):
+
+    # chooses the number of records to ask for in each page of a paged api;
+    # starting at the maximum, each page is sized from the seconds and bytes
+    # per record of the pages before it (weighted toward recent pages) so a
+    # page takes about PAGE_TARGET_SECONDS, not counting rate limit waits,
+    # and is at most PAGE_MAX_BYTES; the size at most doubles from one page
+    # to the next, a page that needed retries halves it, and a page that
+    # fails with a timeout or server error is asked for again at half the
+    # size, up to PAGE_SIZE_RETRIES times in a row
+
+    def __init__(self, maximum, minimum=None):
+        self.maximum = maximum
+        self.minimum = min(maximum, minimum or PAGE_MIN_SIZE)
+        self.size = maximum
+        self.seconds_per_record = None
+        self.bytes_per_record = None
+        self.failures = 0
+
+    def observe(self, response, records, seconds):
+        self.failures = 0
+        retries = response.raw.retries
+        retries = len(retries.history) if retries is not None else 0
+        if records > 0:
+            seconds = max(0.0, seconds - getattr(response, 'rate_limit_seconds', 0.0))
+            self.seconds_per_record = self.average(self.seconds_per_record, seconds / records)
+            self.bytes_per_record = self.average(self.bytes_per_record, response.raw.tell() / float(records))
+        if retries > 0:
+            self.size = max(self.minimum, self.size // 2)
+            return
+        size = self.maximum
+        if self.seconds_per_record:
+            size = min(size, int(PAGE_TARGET_SECONDS / self.seconds_per_record))
+        if self.bytes_per_record:
+            size = min(size, int(PAGE_MAX_BYTES / self.bytes_per_record))
+        self.size = max(self.minimum, min(size, self.size * 2))
+
+    def average(self, average, value):
+        return value if average is None else (average + value) / 2.0
+
+    def retry(self, error):
+        # whether a page that failed with the error should be asked for
+        # again at a smaller size; errors that a smaller page won't fix,
+        # such as the time limit or a bad request, aren't retried
+        if isinstance(error, DeadlineExceeded) or not is_request_error(error):
+            return False
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None and error.response.status_code < 500:
+            return False
+        self.failures += 1
+        if self.failures > PAGE_SIZE_RETRIES or self.size <= self.minimum:
+            return False
+        self.size = max(self.minimum, self.size // 2)
+        return True
+
+def decode_page(stream, key, paths):
+
+    # build each item under 'key' from the parse events, skipping the value
+    # of any key whose path isn't on or along one of the paths; values
+    # directly under the top level, such as the cursor, are also kept
+    ijson = get_optional('ijson')
+    content, items = {}, []
+    item_prefix = key + '.item'
+    wanted = {}
+    builder, depth, skip, skip_value = None, 0, 0, False
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+
+        if builder is None:
+            if prefix == item_prefix and event == 'start_map':
+                builder, depth = ijson.ObjectBuilder(), 0
+            else:
+                if '.' not in prefix and len(prefix) > 0 and event not in ('start_map', 'start_array', 'end_map', 'end_array'):
+                    content[prefix] = value
+                continue
+
+        if skip > 0:
+            if event == 'start_map' or event == 'start_array':
+                skip += 1
+            elif event == 'end_map' or event == 'end_array':
+                skip -= 1
+            continue
+        if skip_value is True:
+            skip_value = False
+            if event == 'start_map' or event == 'start_array':
+                skip = 1
+            continue
+
+        if event == 'map_key':
+            path = prefix[len(item_prefix)+1:]
+            path = path + '.' + value if len(path) > 0 else value
+            keep = wanted.get(path)
+            if keep is None:
+                keep = any([p == path or p.startswith(path + '.') or path.startswith(p + '.') for p in paths])
+                wanted[path] = keep
+            if keep is False:
+                skip_value = True
+                continue
+
+        builder.event(event, value)
+        if event == 'start_map' or event == 'start_array':
+            depth += 1
+        elif event == 'end_map' or event == 'end_array':
+            depth -= 1
+            if depth == 0:
+                items.append(builder.value)
+                builder = None
+
+    return content, items
+
+def prefetch(iterable, depth):
+
+    # pull items from the iterable in a background thread; at most 'depth'
+    # items wait in the queue so memory stays bounded while the consumer
+    # works on the current item; a depth of 0 iterates in line
+    if depth <= 0:
+        return iter(iterable)
+
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    def consume():
+        try:
+            while True:
+                item, error = items.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    return
+                yield item
+        finally:
+            stopped.set()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return consume()
+
+def get_search_page(session, url, headers, request_properties, search_filters, page_cursor_id=None, sorts=None, page_size=100):
+
+    search = {
+        'filterGroups': [{'filters': search_filters}],
+        'properties': request_properties,
+        'sorts': sorts or [{'propertyName': 'hs_object_id', 'direction': 'ASCENDING'}],
+        'limit': page_size,
+    }
+    if page_cursor_id is not None:
+        search['after'] = page_cursor_id
+
+    trace = getattr(session, 'trace', None)
+    started = time.perf_counter() if trace is not None else None
+    response = session.post(url, headers=headers, json=search)
+    received = time.perf_counter() if trace is not None else None
+    response.raise_for_status()
+    content = response.json()
+    if trace is not None:
+        trace.request(response, started, received)
+    return content
+
+def is_over_search_limit(session, url, headers, search_filters):
+
+    # true if more records match the filters than a search can page through
+    # (SEARCH_RESULT_LIMIT); hubspot returns an error for a page past that
+    content = get_search_page(session, url, headers, ['hs_object_id'], search_filters, page_size=1)
+    return content.get('total', 0) > SEARCH_RESULT_LIMIT
+
+def get_search_pages(session, url, headers, request_properties, search_filters, get_item, page_cursor_id=None):
+
+    # see here for more info:
+    # https://developers.hubspot.com/docs/api/crm/search
+    # note: like a function's get_pages(), each page is yielded with the
+    # cursor for the page after it; get_item converts each result into the
+    # shape of a record from the function's paged api
+
+    while True:
+
+        content = get_search_page(session, url, headers, request_properties, search_filters, page_cursor_id)
+        data = [get_item(i) for i in content.get('results',[])]
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
+            break
+
+        page_cursor_id = content.get('paging',{}).get('next',{}).get('after')
+
+        yield data, page_cursor_id
+
+        if page_cursor_id is None:
+            break
+
+def get_partitions(params):
+
+    # the number of createdate ranges for the partitions param; 1 (a single
+    # search or paged read) if it isn't given
+    partitions = dict(params).get('partitions')
+    if partitions is None or len(str(partitions).strip()) == 0:
+        return 1
+    try:
+        count = int(str(partitions).strip())
+    except (TypeError, ValueError):
+        count = 0
+    if count < 1:
+        raise ValueError("Invalid partitions '" + str(partitions) + "'. The partitions must be a whole number greater than 0.")
+    return count
+
+def get_partition_pages(session, url, headers, request_properties, search_filters, get_item, partitions, ordered=False):
+
+    # split the records into ranges of createdate and search the ranges
+    # concurrently, at most PARTITION_CONCURRENCY at a time; a range with
+    # more records than a search can page through is split in half; pages
+    # are yielded as they're fetched or, when ordered, in order of
+    # createdate; each range holds at most PARTITION_QUEUE_SIZE pages that
+    # haven't been yielded and waits for them to be taken before fetching
+    # more, so a range that's ahead of the one being yielded doesn't pile up
+    # in memory; ranges are started in order of createdate, so the earliest
+    # range that isn't finished is always being fetched; records without a
+    # createdate aren't in any range
+    low, high = get_created_range(session, url, headers, search_filters, get_item)
+    if low is None:
+        return
+
+    events = queue.Queue()
+    stopped = threading.Event()
+
+    def run(partition):
+        try:
+            pages = get_partition(session, url, headers, request_properties, search_filters, get_item, partition['low'], partition['high'])
+            for kind, value in pages:
+                if kind == 'split':
+                    events.put((partition, kind, value))
+                    return
+                while not partition['slots'].acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                events.put((partition, kind, value))
+            events.put((partition, 'done', None))
+        except Exception as e:
+            events.put((partition, 'error', e))
+
+    def get_range(low, high):
+        return {'low': low, 'high': high, 'slots': threading.Semaphore(PARTITION_QUEUE_SIZE), 'pages': [], 'done': False, 'started': False}
+
+    ranges = [get_range(low, high) for low, high in get_ranges(low, high + 1, partitions)]
+    try:
+        while len(ranges) > 0:
+            for partition in ranges[:PARTITION_CONCURRENCY]:
+                if partition['started'] is False:
+                    partition['started'] = True
+                    threading.Thread(target=run, args=(partition,), daemon=True).start()
+
+            # when ordered, the pages of the earliest range are yielded and
+            # the pages of the ranges after it wait in their own lists
+            first = ranges[0]
+            if ordered is True and len(first['pages']) > 0:
+                data = first['pages'].pop(0)
+                first['slots'].release()
+                yield data, None
+                continue
+            if ordered is True and first['done'] is True:
+                ranges.pop(0)
+                continue
+
+            partition, kind, value = events.get()
+            if kind == 'error':
+                raise value
+            if kind == 'split':
+                i = ranges.index(partition)
+                ranges[i:i+1] = [get_range(low, high) for low, high in value]
+            elif kind == 'done':
+                partition['done'] = True
+                if ordered is False:
+                    ranges.remove(partition)
+            elif ordered is True:
+                partition['pages'].append(value)
+            else:
+                partition['slots'].release()
+                yield value, None
+    finally:
+        stopped.set()
+
+def get_partition(session, url, headers, request_properties, search_filters, get_item, low, high):
+
+    # search the records created in [low, high) and yield ('page', data) for
+    # each page of them, or yield ('split', ranges) with the two halves of
+    # the range if there are too many to page through
+    search_filters = search_filters + [
+        {'propertyName': 'createdate', 'operator': 'GTE', 'value': str(low)},
+        {'propertyName': 'createdate', 'operator': 'LT', 'value': str(high)},
+    ]
+    content = get_search_page(session, url, headers, request_properties, search_filters)
+    if content.get('total', 0) > SEARCH_RESULT_LIMIT and high - low > 1:
+        middle = (low + high) // 2
+        yield 'split', [(low, middle), (middle, high)]
+        return
+
+    data = [get_item(i) for i in content.get('results',[])]
+    page_cursor_id = content.get('paging',{}).get('next',{}).get('after')
+    if len(data) > 0:
+        yield 'page', data
+    if len(data) > 0 and page_cursor_id is not None:
+        for data, page_cursor_id in get_search_pages(session, url, headers, request_properties, search_filters, get_item, page_cursor_id):
+            yield 'page', data
+
+def get_created_range(session, url, headers, search_filters, get_item):
+
+    # the earliest and latest createdate of the records matching the filters
+    dates = []
+    for direction in ['ASCENDING', 'DESCENDING']:
+        sorts = [{'propertyName': 'createdate', 'direction': direction}]
+        content = get_search_page(session, url, headers, ['createdate'], search_filters + [{'propertyName': 'createdate', 'operator': 'HAS_PROPERTY'}], sorts=sorts, page_size=1)
+        results = content.get('results',[])
+        if len(results) == 0:
+            return None, None
+        dates.append(to_integer(get_item(results[0])['properties'].get('createdate',{}).get('value')))
+    return dates[0], dates[1]
+
+def get_ranges(low, high, count):
+    step = max(1, -(-(high - low) // count))
+    return [(start, min(start + step, high)) for start in range(low, high, step)]
+
+class NdjsonWriter(object):
+
+    # encode row tuples as newline-delimited json objects into a reusable
+    # byte buffer that's passed to write() whenever it holds at least
+    # buffer_size bytes; orjson is used for encoding when it's installed
+
+    def __init__(self, write, columns, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.output = write
+        self.columns = columns
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        orjson = get_optional('orjson')
+        if orjson is not None:
+            self.encode = lambda row: orjson.dumps(row, default=to_string, option=orjson.OPT_APPEND_NEWLINE)
+        else:
+            encoder = json.JSONEncoder(default=to_string)
+            self.encode = lambda row: (encoder.encode(row) + "\n").encode('utf-8')
+
+    def write(self, row):
+        self.buffer += self.encode(dict(zip(self.columns, row)))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.output(bytes(self.buffer))
+            del self.buffer[:]
+
+    def close(self):
+        self.flush()
+
+class CsvWriter(object):
+
+    # write row tuples as csv, with a header row of the column names, into a
+    # text buffer that's passed to write() whenever it holds at least
+    # buffer_size characters
+
+    def __init__(self, write, columns, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.output = write
+        self.buffer_size = buffer_size
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow([to_csv_value(v) for v in row])
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data = self.buffer.getvalue()
+        if len(data) > 0:
+            self.output(data.encode('utf-8'))
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+    def close(self):
+        self.flush()
+
+def to_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return to_string(value)
+
+class ArrowWriter(object):
+
+    # collect row tuples into record batches of batch_size rows that are
+    # written as an arrow ipc stream or as the row groups of a parquet file;
+    # the column types are a list or a function that returns them for the
+    # columns, such as a function's get_schema(), so the returns block of its
+    # header is only read for these formats
+
+    def __init__(self, write, columns, format, types, batch_size=OUTPUT_BATCH_SIZE):
+        pyarrow = get_pyarrow(format)
+        types = types(columns) if callable(types) else types
+        self.pyarrow = pyarrow
+        self.batch_size = batch_size
+        self.rows = []
+        self.converters = [ARROW_CONVERTERS.get(t, to_arrow_string) for t in types]
+        self.schema = pyarrow.schema([(c, ARROW_TYPES.get(t, 'string')) for c, t in zip(columns, types)])
+        self.sink = OutputFile(write)
+        if format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            values = list(zip(*self.rows))
+            arrays = [self.pyarrow.array([convert(v) for v in values[i]], type=self.schema.field(i).type) for i, convert in enumerate(self.converters)]
+            self.writer.write_batch(self.pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class OutputFile(object):
+
+    # a minimal writable file for pyarrow that passes what's written on to
+    # the output
+
+    def __init__(self, write):
+        self.output = write
+        self.closed = False
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.output(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def get_pyarrow(format):
+
+    # pyarrow is optional and slow to import, so it's only imported when an
+    # arrow or parquet format is requested
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        if format == 'parquet':
+            import pyarrow.parquet
+    except ImportError:
+        raise ValueError("The '" + format + "' format requires pyarrow to be installed")
+    return pyarrow
+
+def to_arrow_integer(value):
+
+    # values that aren't whole numbers, such as an empty default, are null;
+    # columns that can hold fractions, such as amounts, are typed as numbers
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        value = Decimal(str(value))
+    except Exception:
+        return None
+    return int(value) if value.is_finite() and value == int(value) else None
+
+def to_arrow_number(value):
+
+    # numbers and numeric strings (hubspot returns amounts as strings such as
+    # '1234.56') as floats; anything else, such as an empty default, is null
+    value = to_number(value)
+    return float(value) if value is not None else None
+
+def to_arrow_boolean(value):
+    return value if isinstance(value, bool) else None
+
+def to_arrow_string(value):
+    if value is None:
+        return None
+    return to_csv_value(value)
+
+# the arrow type of each type in the returns block of a function's header;
+# 'number' columns are float64, so an amount keeps its cents (to the
+# precision of a double) rather than being cut off or made null
+ARROW_TYPES = {'integer': 'int64', 'number': 'float64', 'boolean': 'bool', 'string': 'string'}
+ARROW_CONVERTERS = {'integer': to_arrow_integer, 'number': to_arrow_number, 'boolean': to_arrow_boolean, 'string': to_arrow_string}
+
+def get_writer(format, output, columns, types):
+
+    # the writer for the format param; json (the default) writes a json
+    # object per line, csv writes a header and a line per row, and arrow and
+    # parquet write record batches typed by 'types' (see ArrowWriter)
+    format = str(format or 'json').strip().lower()
+    if format == 'json':
+        output.content_type = 'application/x-ndjson'
+        return NdjsonWriter(output.write, columns)
+    if format == 'csv':
+        output.content_type = 'text/csv'
+        return CsvWriter(output.write, columns)
+    if format == 'arrow':
+        output.content_type = 'application/vnd.apache.arrow.stream'
+        return ArrowWriter(output.write, columns, format, types)
+    if format == 'parquet':
+        output.content_type = 'application/vnd.apache.parquet'
+        return ArrowWriter(output.write, columns, format, types)
+    raise ValueError("Invalid format '" + format + "'. The format must be one of 'json', 'csv', 'arrow' or 'parquet'.")
+
+def read_schema(path):
+    schema = {}
+    try:
+        with open(path) as f:
+            header = f.read().split('# ---')[1]
+    except Exception:
+        return schema
+    returns = header.split('# returns:')[-1]
+    for name, type in re.findall(r'#   - name: (\w+)\n#     type: (\w+)', returns):
+        schema[name] = type
+    return schema
+
+def get_schema(path, definitions):
+
+    # a function that returns the types of a list of columns from the
+    # returns block of the header of the function at path, which is read the
+    # first time it's needed; if the source isn't available, columns with an
+    # integer converter are typed as integers and the rest as strings
+    def get_types(columns):
+        schema = _schemas.get(path)
+        if schema is None:
+            schema = read_schema(path)
+            _schemas[path] = schema
+        types = []
+        for name in columns:
+            if name in schema:
+                types.append(schema[name])
+            else:
+                types.append('integer' if definitions[name][1] is to_integer else 'string')
+        return types
+    return get_types
+
+_schemas = {}
+
+def to_param_list(value):
+
+    # like properties, a list param can be passed as a list (possibly a
+    # nested list from a range of cells) or as a comma-delimited string
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    items = []
+    for v in value:
+        for item in (v if isinstance(v, list) else [v]):
+            item = str(item).strip().lower()
+            if len(item) > 0 and item not in items:
+                items.append(item)
+    return items
+
+def to_number(value):
+
+    # the numeric value of an integer column, which can hold decimal strings
+    # (e.g. an amount with cents); anything else isn't a number
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        value = Decimal(str(value).strip())
+    except Exception:
+        return None
+    if not value.is_finite():
+        return None
+    return int(value) if value == int(value) else float(value)
+
+def to_day(value):
+    return value[:10] if value else value
+
+def to_week(value):
+    # the monday the week of the date starts on
+    if not value:
+        return value
+    week = _weeks.get(value[:10])
+    if week is None:
+        day = datetime.strptime(value[:10], '%Y-%m-%d')
+        week = (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+        if len(_weeks) < DATE_CACHE_SIZE:
+            _weeks[value[:10]] = week
+    return week
+
+_weeks = {}
+
+def to_month(value):
+    return value[:7] if value else value
+
+def to_year(value):
+    return value[:4] if value else value
+
+DATE_BUCKETS = {'day': to_day, 'week': to_week, 'month': to_month, 'year': to_year}
+
+# the header types that are summed and ranked as numbers
+NUMERIC_TYPES = ['integer', 'number']
+
+def get_aggregation(params, columns, definitions, schema):
+
+    # with the group_by, aggregate or top params, the rows are summarized as
+    # they're read rather than returned; see Aggregation; schema returns the
+    # types of columns, as made by get_schema()
+    params = dict(params)
+    groups = [parse_group(definitions, g) for g in to_param_list(params.get('group_by'))]
+    aggregates = [parse_aggregate(definitions, schema, a) for a in to_param_list(params.get('aggregate'))]
+    top = params.get('top')
+    if len(groups) == 0 and len(aggregates) == 0 and top in (None, ''):
+        return None
+    if top not in (None, ''):
+        try:
+            top = int(top)
+        except (TypeError, ValueError):
+            top = -1
+        if top < 1:
+            raise ValueError("Invalid top '" + str(params.get('top')) + "'. The top must be a whole number greater than 0.")
+    else:
+        top = None
+    if len(groups) > 0 and len(aggregates) == 0:
+        aggregates = [('count', 'count', None)]
+    time_limit = params.get('time_limit')
+    if time_limit is not None and len(str(time_limit).strip()) > 0:
+        # a summary of the rows read before the time limit would look like
+        # the summary of all of them
+        raise ValueError("Invalid time_limit '" + str(time_limit) + "'. The time_limit can't be used with group_by, aggregate or top, since a summary isn't complete until all the rows are read.")
+    top_by = str(params.get('top_by') or '').strip().lower()
+    return Aggregation(definitions, schema, columns, groups, aggregates, top, top_by)
+
+def parse_group(definitions, value):
+
+    # a group is a column, optionally followed by a bucket for dates (e.g.
+    # 'close_date:month'); returns the output column name, the column and
+    # the bucket
+    name, _, bucket = value.partition(':')
+    name, bucket = name.strip(), bucket.strip()
+    if name not in definitions:
+        raise ValueError("Invalid group_by property '" + name + "'. See \"Returns\" for a listing of the available properties.")
+    if len(bucket) == 0:
+        return (name, name, None)
+    if bucket not in DATE_BUCKETS or definitions[name][1] is not to_date:
+        raise ValueError("Invalid group_by bucket '" + value + "'. The bucket must be one of 'day', 'week', 'month' or 'year' and can only be used with dates.")
+    return (name + '_' + bucket, name, bucket)
+
+def parse_aggregate(definitions, schema, value):
+
+    # an aggregate is 'count' or a function applied to a column (e.g.
+    # 'sum(amount)'); returns the output column name, the function and the
+    # column
+    match = re.match(r'^(count|sum|min|max)(?:\(\s*(\w+)\s*\))?$', value)
+    if match is None:
+        raise ValueError("Invalid aggregate '" + value + "'. The aggregate must be one of 'count', 'count(property)', 'sum(property)', 'min(property)' or 'max(property)'.")
+    function, name = match.group(1), match.group(2)
+    if name is None:
+        if function != 'count':
+            raise ValueError("Invalid aggregate '" + value + "'. The '" + function + "' aggregate needs a property, such as '" + function + "(property)'.")
+        return (function, function, None)
+    if name not in definitions:
+        raise ValueError("Invalid aggregate property '" + name + "'. See \"Returns\" for a listing of the available properties.")
+    if function == 'sum' and schema([name])[0] not in NUMERIC_TYPES:
+        raise ValueError("Invalid aggregate '" + value + "'. Only numeric properties can be summed.")
+    return (function + '_' + name, function, name)
+
+class Aggregation(object):
+
+    # summarizes rows in a single pass, holding one set of totals per group
+    # rather than the rows; with group_by, a row is returned for each group
+    # with its group values and aggregates; with only aggregates, a single
+    # row of totals is returned; top keeps the top rows (or groups) ranked by
+    # top_by, largest first unless top_by starts with '-', using a heap of
+    # top entries; the rows read are the input_columns, which include the
+    # grouped, aggregated and ranked columns
+
+    def __init__(self, definitions, schema, columns, groups, aggregates, top=None, top_by=''):
+        self.schema = schema
+        self.groups = groups
+        self.aggregates = aggregates
+        self.top = top
+        self.summarize = len(groups) > 0 or len(aggregates) > 0
+        self.descending = not top_by.startswith('-')
+        top_by = top_by.lstrip('-')
+
+        if self.summarize is True:
+            self.columns = [g[0] for g in groups] + [a[0] for a in aggregates]
+            self.input_columns = []
+            for name in [g[1] for g in groups] + [a[2] for a in aggregates if a[2] is not None]:
+                if name not in self.input_columns:
+                    self.input_columns.append(name)
+            self.types = [schema([g[1]])[0] if g[2] is None else 'string' for g in groups]
+            self.types += ['integer' if a[1] == 'count' else schema([a[2]])[0] for a in aggregates]
+            if len(top_by) == 0:
+                top_by = aggregates[0][0]
+            if top_by not in self.columns:
+                raise ValueError("Invalid top_by '" + top_by + "'. The top_by must be one of the group_by properties or aggregates: " + ', '.join(["'" + c + "'" for c in self.columns]) + ".")
+        else:
+            self.columns = list(columns)
+            self.types = schema(self.columns)
+            if len(top_by) == 0:
+                raise ValueError("Invalid top_by ''. The top param needs a top_by property to rank the rows by.")
+            if top_by not in definitions:
+                raise ValueError("Invalid top_by property '" + top_by + "'. See \"Returns\" for a listing of the available properties.")
+            self.input_columns = self.columns + ([top_by] if top_by not in self.columns else [])
+
+        self.top_index = (self.columns if self.summarize else self.input_columns).index(top_by)
+        ranked_types = self.types if self.summarize else schema(self.input_columns)
+        self.top_numeric = ranked_types[self.top_index] in NUMERIC_TYPES
+
+    def apply(self, rows):
+        rows = self.summarize_rows(rows) if self.summarize is True else rows
+        if self.top is not None:
+            rows = self.get_top(rows)
+        if self.summarize is False and len(self.input_columns) > len(self.columns):
+            rows = (row[:len(self.columns)] for row in rows)
+        return rows
+
+    def summarize_rows(self, rows):
+
+        # the totals of each group are kept in a list that's updated in place
+        # for each row; sums and counts start at 0 and mins and maxes at None
+        indexes = [self.input_columns.index(g[1]) for g in self.groups]
+        buckets = [DATE_BUCKETS[g[2]] if g[2] is not None else None for g in self.groups]
+        updates = []
+        for name, function, column in self.aggregates:
+            index = self.input_columns.index(column) if column is not None else None
+            numeric = column is not None and self.schema([column])[0] in NUMERIC_TYPES
+            updates.append((function, index, numeric))
+        initial = [0 if function in ('count', 'sum') else None for function, index, numeric in updates]
+
+        totals = OrderedDict()
+        for row in rows:
+            key = tuple([row[i] if bucket is None else bucket(row[i]) for i, bucket in zip(indexes, buckets)])
+            values = totals.get(key)
+            if values is None:
+                values = list(initial)
+                totals[key] = values
+            for i, (function, index, numeric) in enumerate(updates):
+                if index is None:
+                    values[i] += 1
+                    continue
+                value = row[index]
+                if value is None or value == '':
+                    continue
+                if numeric is True:
+                    value = to_number(value)
+                    if value is None:
+                        continue
+                if function == 'count':
+                    values[i] += 1
+                elif function == 'sum':
+                    values[i] += value
+                elif function == 'min':
+                    if values[i] is None or value < values[i]:
+                        values[i] = value
+                elif values[i] is None or value > values[i]:
+                    values[i] = value
+
+        if len(self.groups) == 0 and len(totals) == 0:
+            totals[()] = list(initial) # the totals of no rows
+        for key, values in totals.items():
+            yield key + tuple(values)
+
+    def get_top(self, rows):
+
+        # rows without a value to rank by are left out
+        index, numeric = self.top_index, self.top_numeric
+        def get_ranked():
+            for row in rows:
+                value = row[index]
+                if numeric is True:
+                    value = to_number(value)
+                if value is None or value == '':
+                    continue
+                yield (value, row)
+        ranked = get_ranked()
+        if self.descending is True:
+            top = heapq.nlargest(self.top, ranked, key=lambda r: r[0])
+        else:
+            top = heapq.nsmallest(self.top, ranked, key=lambda r: r[0])
+        return [row for value, row in top]
+
+def get_deadline(params):
+
+    # with the time_limit param, the call stops fetching pages
+    # DEADLINE_MARGIN seconds before the time limit so the rows fetched so far
+    # can be written
+    time_limit = dict(params).get('time_limit')
+    if time_limit is None or len(str(time_limit).strip()) == 0:
+        return None
+    try:
+        seconds = float(time_limit)
+    except (TypeError, ValueError):
+        seconds = -1
+    if not seconds > 0 or seconds == float('inf'):
+        raise ValueError("Invalid time_limit '" + str(time_limit) + "'. The time_limit must be a number of seconds greater than 0.")
+    return Deadline(time.time() + seconds - DEADLINE_MARGIN)
+
+class Deadline(object):
+
+    # the time by which a call stops fetching pages; once it's passed,
+    # 'expired' is set and 'continuation' is the run id to call again with
+    # to return the rest, or None if the call can't be continued
+
+    def __init__(self, at):
+        self.at = at
+        self.expired = False
+        self.continuation = None
+
+    def remaining(self):
+        return self.at - time.time()
+
+class DeadlineExceeded(TimeoutError):
+
+    # a TimeoutError rather than a requests Timeout so it can be defined
+    # without importing requests; like a requests Timeout, it's an OSError
+    pass
+
+def until_deadline(pages, deadline):
+
+    # stop iterating, rather than failing, once the deadline has passed; a
+    # page is kept if it arrives in time, and a page whose request was cut
+    # short by the deadline is dropped
+    pages = iter(pages)
+    try:
+        while True:
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except Exception:
+                if deadline.remaining() > 0:
+                    raise
+                deadline.expired = True
+                return
+            yield page
+            if deadline.remaining() <= 0:
+                deadline.expired = True
+                return
+    finally:
+        close = getattr(pages, 'close', None)
+        if close is not None:
+            close()
+
+def get_timeout(deadline):
+
+    # the (connect, read) timeout for a request, cut to the time left before
+    # the deadline, if any
+    connect, read = REQUEST_TIMEOUT
+    if deadline is None:
+        return (connect, read)
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded('The time limit was reached')
+    return (min(connect, remaining), min(read, remaining))
+
+def requests_retry_session(
+    retries=3,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    pool_connections=CONNECTION_POOL_SIZE,
+    pool_maxsize=CONNECTION_POOL_SIZE,
+    limiter=None,
+    deadline=None,
+    session=None,
+):
+    requests = get_requests()
+    session = session or requests.Session()
+    if limiter is not None:
+        # 429s are retried by the rate limited adapter so they aren't
+        # retried by urllib3, even when they have a Retry-After header
+        status_forcelist = tuple([s for s in status_forcelist if s != 429])
+    retry = DeadlineRetry(
+        deadline=deadline,
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        respect_retry_after_header=limiter is None,
+    )
+    if limiter is not None:
+        adapter = RateLimitedAdapter(
+            limiter,
+            deadline=deadline,
+            max_retries=retry,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+        )
+    else:
+        adapter = TimeoutAdapter(
+            deadline=deadline,
+            max_retries=retry,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+        )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_connection_stats(session):
+
+    # the urllib3 pools count every request made and every new connection
+    # opened; the difference is the number of requests that reused a
+    # kept-alive connection
+    stats = {'requests': 0, 'connections': 0, 'reused': 0}
+    adapters = {id(a): a for a in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            stats['requests'] += pools[key].num_requests
+            stats['connections'] += pools[key].num_connections
+    stats['reused'] = stats['requests'] - stats['connections']
+    return stats
+
+def get_trace(params, name):
+
+    # with the trace param, the time spent on each page is recorded and
+    # written to stderr after the output; 'summary' writes a line with the
+    # totals and 'json' writes a json object with the totals and each page
+    format = str(dict(params).get('trace') or 'false').strip().lower()
+    if format == 'false':
+        return None
+    if format == 'true':
+        format = 'summary'
+    if format not in ('summary', 'json'):
+        raise ValueError("Invalid trace '" + format + "'. The trace must be one of 'summary' or 'json'.")
+    return Trace(name, format)
+
+class Trace(object):
+
+    # records, for each page, the requests made for it (the time until the
+    # response arrived, including rate limit waits and retries, the bytes
+    # received, the retries and the time spent decoding the response) and
+    # the time spent transforming its items and writing its rows; page
+    # requests are counted against the next page yielded after they're made;
+    # each page is passed to the hooks once its rows are written; nothing is
+    # recorded unless a trace is passed to get_data()
+
+    def __init__(self, name, format=None, hooks=None):
+        self.name = name
+        self.format = format
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.requests = []
+        self.fetched = deque()
+        self.pages = []
+        self.page = None
+        self.session = None
+        self.started = time.perf_counter()
+
+    def request(self, response, started, received, page_size=None):
+        # called once a response has been decoded; 'received' is when the
+        # response was returned, which for a streamed response is as soon
+        # as the headers arrive, so the body is read while it's decoded;
+        # page_size is the number of records asked for by a paged request
+        retries = response.raw.retries
+        retries = len(retries.history) if retries is not None else 0
+        request = {
+            'request_seconds': received - started,
+            'bytes': response.raw.tell(),
+            'retries': retries + getattr(response, 'rate_limit_retries', 0),
+            'decode_seconds': time.perf_counter() - received,
+            'page_size': page_size,
+        }
+        with self.lock:
+            self.requests.append(request)
+
+    def track(self, pages):
+        # iterated in the prefetch thread; hands the requests made since
+        # the last page to the page being yielded
+        for page in pages:
+            with self.lock:
+                requests, self.requests = self.requests, []
+            self.fetched.append(requests)
+            yield page
+
+    def start_page(self):
+        self.finish_page()
+        requests = self.fetched.popleft() if len(self.fetched) > 0 else []
+        page_sizes = [r['page_size'] for r in requests if r['page_size'] is not None]
+        self.page = {
+            'page': len(self.pages) + 1,
+            'requests': len(requests),
+            'retries': sum([r['retries'] for r in requests]),
+            'bytes': sum([r['bytes'] for r in requests]),
+            'request_seconds': sum([r['request_seconds'] for r in requests]),
+            'decode_seconds': sum([r['decode_seconds'] for r in requests]),
+            'page_size': page_sizes[-1] if len(page_sizes) > 0 else None,
+            'transform_seconds': 0.0,
+            'rows': 0,
+            'write_seconds': 0.0,
+        }
+
+    def finish_page(self):
+        if self.page is None:
+            return
+        page, self.page = self.page, None
+        self.pages.append(page)
+        for hook in self.hooks:
+            hook(page)
+
+    def transformed(self, elapsed):
+        self.page['transform_seconds'] += elapsed
+
+    def emitted(self, rows):
+        self.page['rows'] += rows
+
+    def write(self, elapsed):
+        if self.page is not None:
+            self.page['write_seconds'] += elapsed
+
+    def get_summary(self):
+        summary = {'name': self.name, 'seconds': round(time.perf_counter() - self.started, 3), 'pages': len(self.pages)}
+        for key in ['rows', 'requests', 'retries', 'bytes']:
+            summary[key] = sum([p[key] for p in self.pages])
+        for key in ['request_seconds', 'decode_seconds', 'transform_seconds', 'write_seconds']:
+            summary[key] = round(sum([p[key] for p in self.pages]), 3)
+        page_sizes = [p['page_size'] for p in self.pages if p['page_size'] is not None]
+        if len(page_sizes) > 0:
+            summary['page_size'] = {'first': page_sizes[0], 'last': page_sizes[-1], 'min': min(page_sizes), 'max': max(page_sizes)}
+        if self.session is not None:
+            summary['connections'] = get_connection_stats(self.session)
+            summary['rate_limit'] = get_rate_limit_stats(self.session)
+        return summary
+
+    def close(self):
+        self.finish_page()
+        if self.format is None:
+            return
+        summary = self.get_summary()
+        if self.format == 'json':
+            pages = [{k: round(v, 6) if isinstance(v, float) else v for k, v in p.items()} for p in self.pages]
+            print(json.dumps({'summary': summary, 'pages': pages}), file=sys.stderr)
+            return
+        line = '%s: %d rows, %d pages in %.3fs; %d requests, %d retries, %d bytes; request %.3fs, decode %.3fs, transform %.3fs, write %.3fs' % (
+            summary['name'], summary['rows'], summary['pages'], summary['seconds'],
+            summary['requests'], summary['retries'], summary['bytes'],
+            summary['request_seconds'], summary['decode_seconds'], summary['transform_seconds'], summary['write_seconds'])
+        if summary.get('rate_limit') is not None:
+            line = line + '; throttled %.3fs' % summary['rate_limit']['throttled_seconds']
+        if summary.get('page_size') is not None:
+            line = line + '; page size %d to %d' % (summary['page_size']['min'], summary['page_size']['max'])
+        print(line, file=sys.stderr)
+
+def get_connections(params):
+
+    # the hubspot_connections param is a list of connections (each like the
+    # hubspot_connection param, or just its access token), possibly nested
+    # from a range of cells
+    value = dict(params).get('hubspot_connections')
+    if value is None or value == '':
+        return []
+    if isinstance(value, (str, dict)):
+        value = [value]
+    connections = []
+    for v in value:
+        for connection in (v if isinstance(v, list) else [v]):
+            if isinstance(connection, str):
+                if len(connection.strip()) == 0:
+                    continue
+                connection = {'access_token': connection.strip()}
+            if not isinstance(connection, dict) or not connection.get('access_token'):
+                raise ValueError("Invalid connection at position " + str(len(connections) + 1) + ". Each connection must have an access_token.")
+            connections.append(connection)
+    return connections
+
+def get_portal_data(params, connections, definitions, get_data, deadline=None, report=None):
+
+    # run a function's get_data() for each connection in a pool of PORTAL_CONCURRENCY
+    # threads and yield the rows of all the portals as they're read; each
+    # portal has its own session and so its own rate limit budget, and a
+    # portal that fails is reported without stopping the others (the rows
+    # already passed on from it are kept); a dict for each portal with its
+    # status ('complete', 'failed' or 'stopped' at the time limit), portal
+    # id, row count and times is appended to report in the order the
+    # portals finish
+    columns = get_columns(definitions, dict(params).get('properties'))
+    read_columns = columns if 'portal_id' in columns else columns + ['portal_id']
+    portal_index = read_columns.index('portal_id')
+    batches = queue.Queue(maxsize=PORTAL_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                batches.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(position, connection):
+        result = OrderedDict([
+            ('connection', position), ('portal_id', None), ('status', 'complete'), ('rows', 0),
+            ('seconds', 0.0), ('first_row_seconds', None), ('error', None)])
+        started = time.perf_counter()
+        try:
+            if stopped.is_set():
+                return
+            if deadline is not None and deadline.remaining() <= 0:
+                deadline.expired = True
+                result['status'] = 'stopped'
+                return
+            portal_params = dict(params, hubspot_connection=connection, properties=read_columns)
+            batch = []
+            for row in get_data(portal_params, deadline=deadline):
+                if result['first_row_seconds'] is None:
+                    result['first_row_seconds'] = time.perf_counter() - started
+                    result['portal_id'] = row[portal_index]
+                batch.append(row if len(read_columns) == len(columns) else row[:len(columns)])
+                if len(batch) >= PORTAL_BATCH_SIZE:
+                    if not put(batch):
+                        return
+                    result['rows'] += len(batch)
+                    batch = []
+            if len(batch) > 0 and put(batch):
+                result['rows'] += len(batch)
+            if deadline is not None and deadline.expired is True:
+                result['status'] = 'stopped'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e) or type(e).__name__
+        finally:
+            result['seconds'] = time.perf_counter() - started
+            put(result)
+
+    executor = ThreadPoolExecutor(max_workers=PORTAL_CONCURRENCY)
+    try:
+        for position, connection in enumerate(connections):
+            executor.submit(run, position + 1, connection)
+        remaining = len(connections)
+        while remaining > 0:
+            entry = batches.get()
+            if isinstance(entry, list):
+                for row in entry:
+                    yield row
+                continue
+            remaining -= 1
+            if report is not None:
+                report.append(entry)
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
+
+def print_portal_report(name, report):
+
+    # a line for each portal on stderr, in the order they finished
+    for result in report:
+        line = '%s: portal %s (connection %d): %s, %d rows in %.3fs' % (
+            name, result['portal_id'] if result['portal_id'] is not None else '-', result['connection'],
+            result['status'], result['rows'], result['seconds'])
+        if result['error'] is not None:
+            line = line + '; ' + result['error']
+        print(line, file=sys.stderr)
+
+def print_deadline_report(name, deadline):
+
+    # say how to return the rest of the rows of a call stopped by the time
+    # limit
+    if deadline is None or deadline.expired is not True:
+        return
+    if deadline.continuation is not None:
+        print(name + ": stopped at the time limit; call again with the run_id '" + deadline.continuation + "' to return the rest", file=sys.stderr)
+    else:
+        print(name + ': stopped at the time limit; this call can\'t be continued, so call again with a longer time limit', file=sys.stderr)
+
+def get_rate_limiter(auth_token):
+
+    # each invocation gets its own limiter, which keeps its own counters,
+    # but the bucket state is shared by everything using the same token
+    key = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+    return RateLimiter(key, get_rate_limit_store())
+
+def get_rate_limit_store():
+
+    global _rate_limit_store
+    with _rate_limit_lock:
+        if _rate_limit_store is None:
+            if RATE_LIMIT_BACKEND == 'file':
+                _rate_limit_store = FileRateLimitStore(RATE_LIMIT_PATH)
+            elif RATE_LIMIT_BACKEND == 'sqlite':
+                _rate_limit_store = SqliteRateLimitStore(RATE_LIMIT_PATH + '.sqlite')
+            else:
+                _rate_limit_store = MemoryRateLimitStore()
+        return _rate_limit_store
+
+def get_rate_limit_stats(session):
+
+    # time spent waiting for the rate limit compared with time spent on
+    # requests for a session created with a rate limiter
+    limiter = getattr(session.get_adapter('https://'), 'limiter', None)
+    if limiter is None:
+        return None
+    return limiter.get_stats()
+
+_rate_limit_store = None
+_rate_limit_lock = threading.Lock()
+
+class RateLimiter(object):
+
+    # token bucket that paces requests for a portal; buckets start from
+    # RATE_LIMITS and are then kept in sync with the rate limit headers
+    # hubspot returns, and a 429 blocks every request using the bucket
+    # until its Retry-After has passed
+
+    def __init__(self, key, store):
+        self.key = key
+        self.store = store
+        self.lock = threading.Lock()
+        self.throttled = 0.0
+        self.working = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+
+    def acquire(self, bucket, deadline=None):
+        # returns the seconds spent waiting for a token
+        capacity, interval = RATE_LIMITS[bucket]
+        waited = 0.0
+        while True:
+            wait = self.store.update(self.key + ':' + bucket, lambda state: take_token(state, capacity, interval))
+            if wait <= 0:
+                return waited
+            if deadline is not None and wait >= deadline.remaining():
+                raise DeadlineExceeded('The time limit was reached')
+            with self.lock:
+                self.throttled += wait
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, bucket, headers, status_code, elapsed):
+        capacity, interval = RATE_LIMITS[bucket]
+        if bucket != 'default':
+            # the rate limit headers describe the default limit, not the
+            # separate limits for endpoints such as search
+            headers = {'Retry-After': headers.get('Retry-After')}
+        self.store.update(self.key + ':' + bucket, lambda state: sync_bucket(state, capacity, interval, headers, status_code))
+        with self.lock:
+            self.working += elapsed
+            self.requests += 1
+            if status_code == 429:
+                self.rate_limited += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'rate_limited': self.rate_limited,
+                'throttled_seconds': round(self.throttled, 3),
+                'working_seconds': round(self.working, 3),
+            }
+
+def refill_bucket(state, capacity, interval):
+    now = time.time()
+    capacity = state.get('capacity', capacity)
+    interval = state.get('interval', interval)
+    tokens = state.get('tokens', capacity)
+    updated = state.get('updated', now)
+    state['tokens'] = min(capacity, tokens + (now - updated) * capacity / interval)
+    state['updated'] = now
+    return now, capacity, interval
+
+def take_token(state, capacity, interval):
+
+    # take a token if one is available and return 0, otherwise return how
+    # long to wait before trying again
+    now, capacity, interval = refill_bucket(state, capacity, interval)
+    blocked = state.get('blocked_until', 0) - now
+    if blocked > 0:
+        return blocked
+    if state['tokens'] >= 1:
+        state['tokens'] -= 1
+        return 0
+    return (1 - state['tokens']) * interval / capacity
+
+def sync_bucket(state, capacity, interval, headers, status_code):
+
+    # see here for more info:
+    # https://developers.hubspot.com/docs/api/usage-details
+    now, capacity, interval = refill_bucket(state, capacity, interval)
+    if headers.get('X-HubSpot-RateLimit-Max') is not None:
+        state['capacity'] = int(headers.get('X-HubSpot-RateLimit-Max'))
+    if headers.get('X-HubSpot-RateLimit-Interval-Milliseconds') is not None:
+        state['interval'] = int(headers.get('X-HubSpot-RateLimit-Interval-Milliseconds')) / 1000
+    if headers.get('X-HubSpot-RateLimit-Remaining') is not None:
+        state['tokens'] = min(state['tokens'], int(headers.get('X-HubSpot-RateLimit-Remaining')))
+    if headers.get('X-HubSpot-RateLimit-Secondly-Remaining') == '0':
+        state['blocked_until'] = max(state.get('blocked_until', 0), now + 1)
+    if status_code == 429:
+        try:
+            retry_after = float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            retry_after = state.get('interval', interval) / state.get('capacity', capacity)
+        state['blocked_until'] = max(state.get('blocked_until', 0), now + retry_after)
+        state['tokens'] = 0
+
+class MemoryRateLimitStore(object):
+
+    # bucket state shared by the threads of this process
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, fn):
+        with self.lock:
+            state = self.states.setdefault(key, {})
+            return fn(state)
+
+class FileRateLimitStore(object):
+
+    # bucket state in a json file per bucket, locked while it's updated so
+    # it can be shared by concurrent processes on the same machine; fcntl is
+    # imported here rather than with the module since it only exists on
+    # posix hosts, where this store is the only thing that needs it
+
+    def __init__(self, path):
+        self.path = make_private_directory(path)
+
+    def update(self, key, fn):
+        import fcntl
+        filename = os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+        with open(filename, 'a+', opener=open_private) as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            state = json.loads(data) if len(data) > 0 else {}
+            result = fn(state)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+            return result
+
+class SqliteRateLimitStore(object):
+
+    # bucket state in a local sqlite database, updated in an immediate
+    # transaction so it can be shared by concurrent processes on the same
+    # machine
+
+    def __init__(self, path):
+        self.path = make_private_file(path)
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS ratelimit (key TEXT PRIMARY KEY, state TEXT)')
+        finally:
+            db.close()
+
+    def update(self, key, fn):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT state FROM ratelimit WHERE key = ?', (key,)).fetchone()
+            state = json.loads(row[0]) if row is not None else {}
+            try:
+                result = fn(state)
+                db.execute('REPLACE INTO ratelimit (key, state) VALUES (?, ?)', (key, json.dumps(state)))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            return result
+        finally:
+            db.close()
+
+def get_cache_key(auth_token, name):
+
+    # cached entries are keyed by a hash of the token so different portals
+    # never share entries and the token itself isn't written to disk
+    digest = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+    return digest + ':' + name
+
+def get_cached(key, fetch, refresh=False):
+
+    # return the cached value for the key, calling fetch() and caching its
+    # result if there's no fresh entry; refresh drops the cached entry first
+    cache = get_cache()
+    if refresh is True:
+        cache.delete(key)
+    value = cache.get(key)
+    if value is None:
+        value = fetch()
+        cache.set(key, value, CACHE_TTL)
+    return value
+
+def get_owners(session, base_url, headers, cache_key, refresh=False):
+
+    # the owner list rarely changes, so the raw list is cached and the
+    # lookup is built from the cached copy
+    def fetch():
+        url = base_url + '/owners/v2/owners'
+        url_query_params = {'includeInactive': True}
+        url_query_str = urllib.parse.urlencode(url_query_params)
+
+        page_url = url + '?' + url_query_str
+        response = session.get(page_url, headers=headers)
+        response.raise_for_status()
+        content = response.json()
+        return content
+
+    data = get_cached(cache_key, fetch, refresh)
+
+    owners = {}
+    for item in data:
+        owners[item.get('ownerId')] = item
+    return owners
+
+def get_portal_id(session, base_url, headers, cache_key, refresh=False):
+
+    # the id of the token's portal, which search results don't include
+
+    def fetch():
+        url = base_url + '/account-info/v3/details'
+        response = session.get(url, headers=headers)
+        response.raise_for_status()
+        content = response.json()
+        return content.get('portalId')
+
+    return get_cached(cache_key, fetch, refresh)
+
+def get_cache():
+
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if CACHE_BACKEND == 'file':
+                _cache = FileCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+            elif CACHE_BACKEND == 'sqlite':
+                _cache = SqliteCache(CACHE_PATH + '.sqlite', CACHE_MAX_ENTRIES)
+            else:
+                _cache = MemoryCache(CACHE_MAX_ENTRIES)
+        return _cache
+
+_cache = None
+_cache_lock = threading.Lock()
+
+class MemoryCache(object):
+
+    # in-process cache; entries survive between invocations as long as the
+    # process stays warm and the least recently used entries are evicted
+    # once there are more than max_entries
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class FileCache(object):
+
+    # one json file per entry in a local directory; the least recently
+    # written files are removed once there are more than max_entries
+
+    def __init__(self, path, max_entries):
+        self.path = make_private_directory(path)
+        self.max_entries = max_entries
+
+    def get_filename(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.get_filename(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires', 0) < time.time():
+            self.delete(key)
+            return None
+        return entry.get('value')
+
+    def set(self, key, value, ttl):
+        filename = self.get_filename(key)
+        tmp_filename = filename + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_filename, 'w', opener=open_private) as f:
+            json.dump({'expires': time.time() + ttl, 'value': value}, f)
+        os.replace(tmp_filename, filename) # atomic so readers never see a partial file
+        self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_filename(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        filenames = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith('.json')]
+        if len(filenames) <= self.max_entries:
+            return
+        filenames.sort(key=lambda f: os.path.getmtime(f))
+        for filename in filenames[:len(filenames) - self.max_entries]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+class SqliteCache(object):
+
+    # entries in a local sqlite database so the cache can be shared by
+    # concurrent processes; the least recently read entries are removed
+    # once there are more than max_entries
+
+    def __init__(self, path, max_entries):
+        self.path = make_private_file(path)
+        self.max_entries = max_entries
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)')
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, key):
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.connect() as db:
+            db.execute('REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)', (key, json.dumps(value), now + ttl, now))
+            db.execute('DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT ?)', (self.max_entries,))
+
+    def delete(self, key):
+        with self.connect() as db:
+            db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+def to_date(ts):
+
+    # convert epoch milliseconds to a utc 'YYYY-MM-DDTHH:MM:SS' string using
+    # integer math; the date part is memoized by day since most timestamps
+    # in a page fall on a handful of days
+    if ts is None or ts == '':
+        return ''
+    days, ms = divmod(int(ts), 86400000)
+    day = _days.get(days)
+    if day is None:
+        day = (EPOCH + timedelta(days=days)).strftime('%Y-%m-%dT')
+        if len(_days) < DATE_CACHE_SIZE:
+            _days[days] = day
+    seconds = ms // 1000
+    return day + '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def to_dates(values):
+
+    # convert a column of epoch milliseconds at once; numpy is used when it's
+    # installed and there are enough values to make it worthwhile, otherwise
+    # (or for values outside the years numpy formats the same way) each value
+    # is converted with to_date(); numpy takes longer to import than a few
+    # pages take to convert without it, so it's imported in the background
+    # and used once it's there
+    numpy = get_optional('numpy', wait=False) if len(values) >= NUMPY_MIN_VALUES else None
+    if numpy is None:
+        return [to_date(v) for v in values]
+
+    result = [''] * len(values)
+    indexes, timestamps = [], []
+    for i, v in enumerate(values):
+        if v is None or v == '':
+            continue
+        v = int(v)
+        if v < MIN_NUMPY_DATE or v >= MAX_NUMPY_DATE:
+            result[i] = to_date(v)
+            continue
+        indexes.append(i)
+        timestamps.append(v)
+
+    seconds = numpy.floor_divide(numpy.array(timestamps, dtype='int64'), 1000)
+    strings = numpy.datetime_as_string(seconds.astype('datetime64[s]'), unit='s')
+    for i, s in zip(indexes, strings.tolist()):
+        result[i] = s
+    return result
+
+def convert_dates(rows, indexes):
+
+    # convert the date columns of a page of rows a column at a time
+    if len(rows) == 0 or len(indexes) == 0:
+        return rows
+    values = list(zip(*rows))
+    for i in indexes:
+        values[i] = to_dates(values[i])
+    return list(zip(*values))
+
+EPOCH = datetime(1970, 1, 1)
+DATE_CACHE_SIZE = 100000
+NUMPY_MIN_VALUES = 32
+MIN_NUMPY_DATE = -30610224000000 # 1000-01-01; numpy zero-pads earlier years
+MAX_NUMPY_DATE = 253402300800000 # 10000-01-01
+_days = {}
+
+def from_iso_date(value):
+    try:
+        d = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return value
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return str((d - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(milliseconds=1))
+
+def to_integer(value):
+    try:
+        return int(value)
+    except:
+        return value
+
+def to_string(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (Decimal)):
+        return str(value)
+    return value
+
+def get_columns(definitions, properties, optional=None):
+
+    # the columns of a function's COLUMNS named by the properties param;
+    # properties can be passed as a list (possibly a nested list from a range
+    # of cells) or as a comma-delimited string; '*' or an empty value returns
+    # all columns except those in optional, which are only returned when
+    # they're named
+    optional = optional or []
+    if properties is None:
+        properties = []
+    if isinstance(properties, str):
+        properties = properties.split(',')
+
+    columns = []
+    for p in properties:
+        for name in (p if isinstance(p, list) else [p]):
+            name = str(name).strip().lower()
+            if name == '*':
+                return [c for c in definitions.keys() if c not in optional]
+            if len(name) == 0 or name in columns:
+                continue
+            if name not in definitions:
+                raise ValueError("Invalid property '" + name + "'. See \"Returns\" for a listing of the available properties.")
+            columns.append(name)
+
+    if len(columns) == 0:
+        return [c for c in definitions.keys() if c not in optional]
+    return columns
+
+def get_request_properties(definitions, columns):
+
+    # the record properties read by the columns
+    request_properties = []
+    for source in get_sources(definitions, columns).values():
+        root, join, keys = parse_source(source)
+        if root == 'item' and len(keys) > 1 and keys[0] == 'properties' and keys[1] not in request_properties:
+            request_properties.append(keys[1])
+    return request_properties
+
+def get_lookups(definitions, columns):
+
+    # the lookups joined by the columns
+    lookups = set()
+    for source in get_sources(definitions, columns).values():
+        root, join, keys = parse_source(source)
+        if join is not None:
+            lookups.add(root)
+    return lookups
+
+def get_filters(definitions, filter):
+
+    # the filter is a url query string where the keys are the columns to
+    # filter and the values are the values to match; a column given more
+    # than once matches any of its values
+    filters = OrderedDict()
+    if filter is None or len(str(filter).strip()) == 0:
+        return filters
+
+    for name, value in urllib.parse.parse_qsl(str(filter).strip().lstrip('?'), keep_blank_values=True):
+        name = name.strip().lower()
+        if name not in definitions:
+            raise ValueError("Invalid filter property '" + name + "'. See \"Returns\" for a listing of the available properties.")
+        filters.setdefault(name, []).append(value.strip())
+    return filters
+
+def split_filters(filters, search_properties, limit=None):
+
+    # columns that are a plain record property (those in a function's
+    # SEARCH_PROPERTIES) can be filtered by the search api; the search api allows a limited number of filters in a group, so
+    # any past the limit are filtered locally along with everything else
+    if limit is None:
+        limit = SEARCH_FILTER_LIMIT
+    search_filters, local_filters = [], OrderedDict()
+    for name, values in filters.items():
+        search_property = search_properties.get(name)
+        if search_property is None or '' in values or len(search_filters) >= limit:
+            local_filters[name] = values
+        elif len(values) == 1:
+            search_filters.append({'propertyName': search_property, 'operator': 'EQ', 'value': values[0]})
+        else:
+            # the search api expects lowercase values with the IN operator
+            search_filters.append({'propertyName': search_property, 'operator': 'IN', 'values': [v.lower() for v in values]})
+    return search_filters, local_filters
+
+def get_item_paths(definitions, columns, item_paths):
+
+    # the paths within each item that are read by the columns, along with
+    # the paths that are always read (a function's ITEM_PATHS)
+    paths = list(item_paths)
+    for source in get_sources(definitions, columns).values():
+        root, join, keys = parse_source(source)
+        if root == 'item' and len(keys) > 0 and '.'.join(keys) not in paths:
+            paths.append('.'.join(keys))
+    return paths
+
+def get_predicate(filters, columns):
+
+    # compile the filters into a single function that's true when a row
+    # matches all of them; values are compared as case-insensitive strings
+    if len(filters) == 0:
+        return None
+
+    tests = [(columns.index(name), set([to_filter_value(v) for v in values])) for name, values in filters.items()]
+    def predicate(row):
+        for index, values in tests:
+            if to_filter_value(row[index]) not in values:
+                return False
+        return True
+    return predicate
+
+def to_filter_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).lower()
+
+def get_sources(definitions, columns):
+
+    # return the source path of each column along with the paths of any
+    # columns they join on, in the order they need to be built; the columns
+    # are defined by a function's COLUMNS
+    sources = OrderedDict()
+    def add(name):
+        if name in sources:
+            return
+        root, join, keys = parse_source(definitions[name][0])
+        if join is not None:
+            add(join)
+        sources[name] = definitions[name][0]
+    for name in columns:
+        add(name)
+    return sources
+
+def parse_source(source):
+
+    # a source path is a root (one of the extractor's arguments), an optional
+    # column to join on in brackets for lookups, and the keys to follow
+    # (e.g. 'item.properties.name.value' or 'owners[owner_id].firstName')
+    match = re.match(r'^(\w+)(?:\[(\w+)\])?((?:\.[\w-]+)*)$', source)
+    if match is None:
+        raise ValueError("Invalid column source '" + source + "'")
+    keys = [k for k in match.group(3).split('.') if len(k) > 0]
+    return match.group(1), match.group(2), keys
+
+def get_extractor(definitions, args, columns, vectorized=False):
+
+    # extractors are compiled once for each function's set of columns and
+    # reused; the definitions are kept with each extractor so a cache entry
+    # is only used for the same definitions
+    key = (id(definitions), tuple(columns), vectorized)
+    entry = _extractors.get(key)
+    if entry is None or entry[0] is not definitions:
+        entry = (definitions, compile_extractor(definitions, args, columns, vectorized))
+        _extractors[key] = entry
+    return entry[1]
+
+_extractors = {}
+
+def compile_extractor(definitions, args, columns, vectorized=False):
+
+    # generate a single function of the args (a function's EXTRACTOR_ARGS)
+    # that builds a row tuple for the columns; each object along a source
+    # path (e.g. the properties of an item) is looked up once per record and
+    # shared by all the columns that use it; when vectorized, date columns
+    # are left as epoch milliseconds so they can be converted a page at a
+    # time with convert_dates()
+    namespace = {'EMPTY': EMPTY}
+    lines = []
+    assigned = {}
+
+    def assign(expression):
+        if expression not in assigned:
+            assigned[expression] = '_' + str(len(assigned))
+            lines.append('    ' + assigned[expression] + ' = ' + expression)
+        return assigned[expression]
+
+    built = {}
+    for name, source in get_sources(definitions, columns).items():
+        root, join, keys = parse_source(source)
+        converter, default = definitions[name][1], definitions[name][2]
+        if vectorized is True and converter is to_date:
+            converter = None
+
+        value = root
+        if join is not None:
+            value = assign(root + '.get(' + built[join] + ') or EMPTY')
+        for k in keys[:-1]:
+            value = assign(value + '.get(' + repr(k) + ') or EMPTY')
+        if len(keys) > 0:
+            value = value + '.get(' + repr(keys[-1]) + ', ' + repr(default) + ')'
+        if converter is not None:
+            namespace[converter.__name__] = converter
+            value = converter.__name__ + '(' + value + ')'
+        built[name] = assign(value)
+
+    code = 'def extract(' + ', '.join(args) + '):\n'
+    code += '\n'.join(lines) + '\n'
+    code += '    return (' + ''.join([built[name] + ', ' for name in columns]) + ')\n'
+    exec(code, namespace)
+    return namespace['extract']
+
+def get_date_indexes(definitions, columns):
+    return [i for i, name in enumerate(columns) if definitions[name][1] is to_date]
+
+EMPTY = {}
+
@@ -0,0 +1,59 @@
+# fixtures for the tests that run the functions against the local mock
+# server in benchmarks/mock_hubspot.py; each test gets its own server and
+# its own private data directory for the rate limit state, caches,
+# checkpoints and mirrors
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import hubspot_core
+import mock_hubspot
+
+TOKEN = 'test-token'
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+
+    # the shared cache and rate limit store are made again, in the test's
+    # directory, the first time they're used
+    path = str(tmp_path / 'data')
+    monkeypatch.setattr(hubspot_core, 'DATA_PATH', path)
+    monkeypatch.setattr(hubspot_core, 'RATE_LIMIT_PATH', os.path.join(path, 'ratelimit'))
+    monkeypatch.setattr(hubspot_core, 'CACHE_PATH', os.path.join(path, 'cache'))
+    monkeypatch.setattr(hubspot_core, 'CHECKPOINT_PATH', os.path.join(path, 'checkpoints.sqlite'))
+    monkeypatch.setattr(hubspot_core, '_cache', None)
+    monkeypatch.setattr(hubspot_core, '_rate_limit_store', None)
+    return path
+
+@pytest.fixture
+def server():
+    server = mock_hubspot.start({'deals': 600, 'contacts': 300, 'companies': 50, 'engagements': 300, 'owners': 5, 'body_size': 100})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def load(server, data_path, monkeypatch):
+
+    # returns a function that loads a function's module pointed at the mock
+    # server, with its mirror in the data directory; the rate limits are
+    # lifted so the tests aren't paced
+    monkeypatch.setattr(hubspot_core, 'RATE_LIMITS', {k: (1000000, 1.0) for k in hubspot_core.RATE_LIMITS.keys()})
+    def load(filename):
+        spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], os.path.join(ROOT, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.API_BASE_URL = 'http://127.0.0.1:' + str(server.server_port)
+        if hasattr(module, 'MIRROR_PATH'):
+            module.MIRROR_PATH = os.path.join(data_path, os.path.basename(module.MIRROR_PATH))
+        return module
+    return load
+
+def get_params(**params):
+    return dict({'hubspot_connection': {'access_token': TOKEN}}, **params)
@@ -0,0 +1,120 @@
+# the group_by, aggregate and top params of deals and activity, run against
+# the mock server and checked against summaries of all the rows
+
+import json
+from collections import OrderedDict
+
+import pytest
+
+from hubspot_core import get_aggregation, get_schema
+from conftest import get_params
+
+class Output(object):
+
+    def __init__(self):
+        self.content_type = None
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+class Flex(object):
+
+    def __init__(self, params):
+        self.vars = params
+        self.output = Output()
+
+def run(m, **params):
+    flex = Flex(get_params(**params))
+    m.flexio_handler(flex)
+    return [json.loads(line) for line in b''.join(flex.output.chunks).decode('utf-8').splitlines()]
+
+def get_rows(m, columns):
+    return [dict(zip(columns, row)) for row in m.get_data(get_params(properties=','.join(columns)))]
+
+@pytest.fixture
+def deals(load):
+    return load('hubspot-deals.py')
+
+def test_group_by(deals):
+    rows = get_rows(deals, ['deal_stage_label', 'amount', 'close_date'])
+    expected = OrderedDict()
+    for row in rows:
+        totals = expected.setdefault(row['deal_stage_label'], [0, 0, None, None])
+        totals[0] += 1
+        totals[1] += row['amount']
+        totals[2] = row['close_date'] if totals[2] is None else min(totals[2], row['close_date'])
+        totals[3] = row['amount'] if totals[3] is None else max(totals[3], row['amount'])
+
+    result = run(deals, group_by='deal_stage_label', aggregate='count,sum(amount),min(close_date),max(amount)')
+    assert result == [
+        {'deal_stage_label': k, 'count': v[0], 'sum_amount': v[1], 'min_close_date': v[2], 'max_amount': v[3]}
+        for k, v in expected.items()
+    ]
+
+def test_group_by_date_bucket(deals):
+    rows = get_rows(deals, ['close_date'])
+    expected = OrderedDict()
+    for row in rows:
+        expected[row['close_date'][:10]] = expected.get(row['close_date'][:10], 0) + 1
+    result = run(deals, group_by='close_date:day')
+    assert result == [{'close_date_day': k, 'count': v} for k, v in expected.items()]
+    assert len(result) > 1
+
+def test_aggregate_without_group_by(deals):
+    rows = get_rows(deals, ['amount'])
+    assert run(deals, aggregate='count,sum(amount)') == [{'count': len(rows), 'sum_amount': sum([r['amount'] for r in rows])}]
+
+    # the totals of no rows are still returned
+    assert run(deals, aggregate='count,sum(amount),max(amount)', filter='deal_stage_label=missing') == [{'count': 0, 'sum_amount': 0, 'max_amount': None}]
+
+def test_top_rows(deals):
+    rows = get_rows(deals, ['deal_id', 'amount'])
+    largest = sorted(rows, key=lambda r: r['amount'], reverse=True)[:5]
+    assert run(deals, properties='deal_id', top=5, top_by='amount') == [{'deal_id': r['deal_id']} for r in largest]
+    smallest = sorted(rows, key=lambda r: r['amount'])[:3]
+    assert run(deals, properties='deal_id,amount', top=3, top_by='-amount') == smallest
+
+def test_top_groups(deals):
+    rows = get_rows(deals, ['owner_id', 'amount'])
+    totals = {}
+    for row in rows:
+        totals[row['owner_id']] = totals.get(row['owner_id'], 0) + row['amount']
+    expected = sorted(totals.items(), key=lambda t: t[1], reverse=True)[:2]
+    result = run(deals, group_by='owner_id', aggregate='sum(amount),count', top=2)
+    assert [(r['owner_id'], r['sum_amount']) for r in result] == expected
+
+def test_activity(load):
+    m = load('hubspot-activity.py')
+    rows = get_rows(m, ['type', 'activity_date'])
+    expected = OrderedDict()
+    for row in rows:
+        totals = expected.setdefault(row['type'], [0, None])
+        totals[0] += 1
+        totals[1] = row['activity_date'] if totals[1] is None else max(totals[1], row['activity_date'])
+    result = run(m, group_by='type', aggregate='count,max(activity_date)')
+    assert result == [{'type': k, 'count': v[0], 'max_activity_date': v[1]} for k, v in expected.items()]
+
+def test_only_needed_columns_are_read(deals):
+    schema = get_schema(deals.__file__, deals.COLUMNS)
+    aggregation = get_aggregation({'group_by': 'owner_id', 'aggregate': 'sum(amount),max(amount)'}, [], deals.COLUMNS, schema)
+    assert aggregation.input_columns == ['owner_id', 'amount']
+    assert aggregation.columns == ['owner_id', 'sum_amount', 'max_amount']
+    assert aggregation.types == ['integer', 'number', 'number']
+    assert get_aggregation({}, [], deals.COLUMNS, schema) is None
+
+@pytest.mark.parametrize('params, message', [
+    ({'group_by': 'missing'}, "Invalid group_by property 'missing'"),
+    ({'group_by': 'deal_name:month'}, "Invalid group_by bucket 'deal_name:month'"),
+    ({'aggregate': 'avg(amount)'}, "Invalid aggregate 'avg(amount)'"),
+    ({'aggregate': 'sum'}, "Invalid aggregate 'sum'"),
+    ({'aggregate': 'sum(deal_name)'}, "Only numeric properties can be summed"),
+    ({'top': '0', 'top_by': 'amount'}, "Invalid top '0'"),
+    ({'top': '5'}, "Invalid top_by ''"),
+    ({'group_by': 'owner_id', 'top': '5', 'top_by': 'amount'}, "Invalid top_by 'amount'"),
+    ({'group_by': 'owner_id', 'time_limit': '30'}, "Invalid time_limit '30'"),
+])
+def test_invalid_params(deals, params, message):
+    schema = get_schema(deals.__file__, deals.COLUMNS)
+    with pytest.raises(ValueError, match=message.replace('(', r'\(').replace(')', r'\)')):
+        get_aggregation(params, ['deal_id'], deals.COLUMNS, schema)
@@ -0,0 +1,116 @@
+# checkpoints saved under a run id, and calls that pick up where an earlier
+# call with the same run id stopped, run against the mock server
+
+import os
+
+import pytest
+
+import hubspot_core
+from hubspot_core import get_checkpoint, Checkpoint
+from conftest import get_params
+
+def get_name(m):
+    return m.__name__.replace('_', '-')
+
+def read_until_failure(m, params, pages):
+
+    # read rows until the given number of pages have been checkpointed and
+    # then fail, as a call that stopped partway would
+    checkpoint = get_checkpoint(params, get_name(m))
+    save, saves = checkpoint.save, []
+    def fail(page_cursor_id, rows):
+        save(page_cursor_id, rows)
+        saves.append(page_cursor_id)
+        if len(saves) == pages:
+            raise RuntimeError('failed')
+    checkpoint.save = fail
+    rows = []
+    with pytest.raises(RuntimeError, match='failed'):
+        for row in m.get_data(params, checkpoint=checkpoint):
+            rows.append(row)
+    return rows
+
+def read(m, params):
+    return list(m.get_data(params, checkpoint=get_checkpoint(params, get_name(m))))
+
+@pytest.mark.parametrize('filename', ['hubspot-deals.py', 'hubspot-contacts.py', 'hubspot-companies.py', 'hubspot-activity.py'])
+def test_resume(filename, load):
+
+    # a call with the same run id returns the rows after the last page that
+    # was checkpointed, so the two calls return every row once
+    m = load(filename)
+    m.PAGE_MAX_SIZE = 20
+    expected = list(m.get_data(get_params()))
+    params = get_params(run_id='run-1')
+    first = read_until_failure(m, params, 1)
+    assert 0 < len(first) < len(expected)
+    assert first + read(m, params) == expected
+
+    # the run is complete, so the run id starts over
+    assert read(m, params) == expected
+
+def test_resume_more_than_once(load):
+    m = load('hubspot-deals.py')
+    m.PAGE_MAX_SIZE = 100
+    expected = list(m.get_data(get_params(properties='deal_id')))
+    params = get_params(properties='deal_id', run_id='run-1')
+    first = read_until_failure(m, params, 1)
+    second = read_until_failure(m, params, 2)
+    rest = read(m, params)
+    assert len(first) > 0 and len(second) > 0
+    assert first + second + rest == expected
+
+def test_fingerprint_mismatch(load):
+
+    # the checkpoint is only used by calls with the same properties and
+    # filter; a call with others starts from the first page, and replaces the
+    # checkpoint
+    m = load('hubspot-deals.py')
+    params = get_params(properties='deal_id,deal_name', run_id='run-1')
+    first = read_until_failure(m, params, 1)
+    assert len(first) > 0
+
+    other = get_params(properties='deal_id', run_id='run-1')
+    checkpoint = get_checkpoint(other, get_name(m))
+    assert checkpoint.state['page_cursor_id'] is None
+    assert checkpoint.state['rows'] == 0
+    assert read(m, other) == list(m.get_data(get_params(properties='deal_id')))
+
+    # once the other call completes, the first one starts over as well
+    assert read(m, params) == list(m.get_data(get_params(properties='deal_id,deal_name')))
+
+def test_runs_are_separate(load):
+
+    # checkpoints are kept per run id, function and token
+    m = load('hubspot-deals.py')
+    params = get_params(properties='deal_id', run_id='run-1')
+    read_until_failure(m, params, 1)
+    assert get_checkpoint(params, get_name(m)).state['page_cursor_id'] is not None
+    assert get_checkpoint(get_params(properties='deal_id', run_id='run-2'), get_name(m)).state['page_cursor_id'] is None
+    assert get_checkpoint(params, 'hubspot-contacts').state['page_cursor_id'] is None
+    other = dict(params, hubspot_connection={'access_token': 'other-token'})
+    assert get_checkpoint(other, get_name(m)).state['page_cursor_id'] is None
+
+def test_no_run_id(data_path):
+    assert get_checkpoint(get_params(), 'hubspot-deals') is None
+    assert get_checkpoint(get_params(run_id=' '), 'hubspot-deals') is None
+    with pytest.raises(ValueError, match="Invalid run_id ''"):
+        get_checkpoint(get_params(), 'hubspot-deals', deadline=hubspot_core.Deadline(0))
+
+def test_flush_before_save(data_path):
+
+    # the output is flushed before each checkpoint is saved, so a checkpoint
+    # is never ahead of the rows written
+    events = []
+    checkpoint = Checkpoint(hubspot_core.CHECKPOINT_PATH, 'key', 'fingerprint', lambda: events.append('flush'))
+    checkpoint.save(100, 10)
+    events.append('saved')
+    assert events == ['flush', 'saved']
+    assert Checkpoint(hubspot_core.CHECKPOINT_PATH, 'key', 'fingerprint').state == {'fingerprint': 'fingerprint', 'page_cursor_id': 100, 'rows': 10, 'complete': False}
+    assert os.stat(hubspot_core.CHECKPOINT_PATH).st_mode & 0o777 == 0o600
+
+def test_expired_checkpoints(data_path, monkeypatch):
+    Checkpoint(hubspot_core.CHECKPOINT_PATH, 'old', 'fingerprint').save(100, 10)
+    monkeypatch.setattr(hubspot_core, 'CHECKPOINT_TTL', -1)
+    Checkpoint(hubspot_core.CHECKPOINT_PATH, 'new', 'fingerprint').save(100, 10)
+    assert Checkpoint(hubspot_core.CHECKPOINT_PATH, 'old', 'fingerprint').state['page_cursor_id'] is None
@@ -0,0 +1,122 @@
+# pins the output of to_date(), to_dates() and convert_dates() to that of
+# the conversion they replaced, with and without numpy
+
+import os
+import sys
+import random
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hubspot_core
+from hubspot_core import to_date, to_dates, convert_dates
+
+def old_to_date(ts):
+
+    # the original conversion, datetime.utcfromtimestamp(int(ts)/1000), with
+    # the non-deprecated equivalent of utcfromtimestamp()
+    if ts is None or ts == '':
+        return ''
+    return datetime.fromtimestamp(int(ts)/1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+DAY = 86400000
+
+VALUES = [
+    0, 1, 999, 1000, 1001, 59999, 60000, 3599999, 3600000,
+    DAY - 1, DAY, DAY + 1, -1, -999, -1000, -1001, -DAY + 1, -DAY, -DAY - 1,
+    1546300800000, 1546300800001, 1546300799999, 1546300800500,
+    951782400000, 951868799999, 1582934400000, 1583020799999, # 2000-02-29 and 2020-02-29
+    -2208988800000, -2208988800001, # 1900-01-01
+    hubspot_core.MIN_NUMPY_DATE, hubspot_core.MIN_NUMPY_DATE - 1, hubspot_core.MIN_NUMPY_DATE + 1,
+    -30000000000000, -50000000000000, -62135596800000, -62135596799999, # years 1019, 385 and 1
+    hubspot_core.MAX_NUMPY_DATE - 1, hubspot_core.MAX_NUMPY_DATE - DAY, # the end of 9999
+    253370764800000, 32503680000000, # 9999-01-01 and 3000-01-01
+    '1546300800000', '-1', '0',
+]
+
+# past the years datetime supports, so the original conversion couldn't
+# convert these either
+OUT_OF_RANGE = [hubspot_core.MAX_NUMPY_DATE, hubspot_core.MAX_NUMPY_DATE + DAY, -62135596800001, -70000000000000]
+
+def get_random_values(count):
+    r = random.Random(9)
+    return [r.randrange(-62135596800000, hubspot_core.MAX_NUMPY_DATE) for i in range(count)]
+
+@pytest.fixture(params=['numpy', 'fallback'])
+def path(request, monkeypatch):
+
+    # to_dates() with numpy for any number of values, or without numpy
+    if request.param == 'numpy':
+        numpy = pytest.importorskip('numpy')
+        monkeypatch.setitem(hubspot_core._optional, 'numpy', numpy)
+        monkeypatch.setattr(hubspot_core, 'NUMPY_MIN_VALUES', 1)
+    else:
+        monkeypatch.setitem(hubspot_core._optional, 'numpy', None)
+    return request.param
+
+@pytest.mark.parametrize('ts', VALUES)
+def test_to_date(ts):
+    assert to_date(ts) == old_to_date(ts)
+
+@pytest.mark.parametrize('ts', [None, ''])
+def test_to_date_empty(ts):
+    assert to_date(ts) == ''
+
+def test_to_date_memoized_day(monkeypatch):
+    monkeypatch.setattr(hubspot_core, '_days', {})
+    assert to_date(1546300800000) == '2019-01-01T00:00:00'
+    assert to_date(1546387199999) == '2019-01-01T23:59:59'
+    assert list(hubspot_core._days.keys()) == [1546300800000 // DAY]
+
+def test_to_date_full_memo(monkeypatch):
+    monkeypatch.setattr(hubspot_core, '_days', {})
+    monkeypatch.setattr(hubspot_core, 'DATE_CACHE_SIZE', 1)
+    assert [to_date(ts) for ts in VALUES] == [old_to_date(ts) for ts in VALUES]
+    assert len(hubspot_core._days) == 1
+
+def test_to_date_random():
+    values = get_random_values(5000)
+    assert [to_date(ts) for ts in values] == [old_to_date(ts) for ts in values]
+
+@pytest.mark.parametrize('ts', OUT_OF_RANGE)
+def test_to_date_out_of_range(ts):
+    with pytest.raises((ValueError, OverflowError)):
+        old_to_date(ts)
+    with pytest.raises((ValueError, OverflowError)):
+        to_date(ts)
+
+def test_to_dates(path):
+    values = VALUES + [None, ''] + list(reversed(VALUES))
+    assert to_dates(values) == [old_to_date(ts) for ts in values]
+
+def test_to_dates_random(path):
+    values = get_random_values(5000)
+    assert to_dates(values) == [old_to_date(ts) for ts in values]
+
+def test_to_dates_empty(path):
+    assert to_dates([]) == []
+    assert to_dates([None, '', None]) == ['', '', '']
+
+def test_to_dates_out_of_range(path):
+    for ts in OUT_OF_RANGE:
+        with pytest.raises((ValueError, OverflowError)):
+            to_dates([0, ts])
+
+def test_to_dates_few_values(monkeypatch):
+
+    # fewer than NUMPY_MIN_VALUES values are converted without numpy
+    monkeypatch.setitem(hubspot_core._optional, 'numpy', object())
+    values = VALUES[:hubspot_core.NUMPY_MIN_VALUES - 1]
+    assert to_dates(values) == [old_to_date(ts) for ts in values]
+
+def test_convert_dates(path):
+    rows = [(i, ts, 'x', ts) for i, ts in enumerate(VALUES + [None, ''])]
+    converted = convert_dates(rows, [1, 3])
+    assert converted == [(i, old_to_date(ts), 'x', old_to_date(ts)) for i, ts, x, y in rows]
+    assert all(isinstance(row, tuple) for row in converted)
+
+def test_convert_dates_nothing_to_convert(path):
+    rows = [(1, 1546300800000)]
+    assert convert_dates([], [1]) == []
+    assert convert_dates(rows, []) is rows
@@ -0,0 +1,160 @@
+# the mirrors of deals, contacts and activity, synced from the mock server
+# and read back with the incremental param, and the filters applied to them
+
+import json
+import sqlite3
+
+import pytest
+
+from hubspot_core import get_filters, get_predicate, split_mirror_filters
+from conftest import get_params
+
+# for each function, its file, the mock server's records it mirrors and the
+# endpoints that a full and an incremental sync page through
+FUNCTIONS = {
+    'deals': ('hubspot-deals.py', 'deals', '/deals/v1/deal/paged', '/deals/v1/deal/recent/modified'),
+    'contacts': ('hubspot-contacts.py', 'contacts', '/contacts/v1/lists/all/contacts/all', '/contacts/v1/lists/recently_updated/contacts/recent'),
+    'activity': ('hubspot-activity.py', 'engagements', '/engagements/v1/engagements/paged', '/engagements/v1/engagements/recent/modified'),
+}
+
+def get_modified(name, record):
+    if name == 'activity':
+        return record['engagement']['lastUpdated']
+    return int(record['properties']['lastmodifieddate' if name == 'contacts' else 'hs_lastmodifieddate']['value'])
+
+def change(name, record, modified):
+    if name == 'activity':
+        record['metadata']['subject'] = 'Changed'
+        record['engagement']['lastUpdated'] = modified
+    elif name == 'contacts':
+        record['properties']['firstname']['value'] = 'Changed'
+        record['properties']['lastmodifieddate']['value'] = str(modified)
+    else:
+        record['properties']['dealname']['value'] = 'Changed'
+        record['properties']['hs_lastmodifieddate']['value'] = str(modified)
+    return record
+
+def get_state(m):
+    with sqlite3.connect(m.MIRROR_PATH) as db:
+        return json.loads(db.execute('SELECT state FROM sync_state').fetchone()[0])
+
+def get_rows(m, **params):
+    return sorted(m.get_data(get_params(**params)), key=repr)
+
+@pytest.fixture(params=list(FUNCTIONS.keys()))
+def function(request, load, server):
+    filename, records, paged, recent = FUNCTIONS[request.param]
+    m = load(filename)
+    return request.param, m, getattr(server, records), paged, recent
+
+def test_full_sync(function, server):
+
+    # the first incremental call mirrors every record and returns the same
+    # rows as a call that reads them from the api
+    name, m, records, paged, recent = function
+    expected = get_rows(m)
+    server.reset()
+    assert get_rows(m, incremental=True) == expected
+    endpoints = server.get_stats()['endpoints']
+    assert endpoints.get(paged, 0) > 0
+    assert endpoints.get(recent, 0) == 0
+
+    state = get_state(m)
+    assert state['complete'] is True
+    assert state['high_water_mark'] == max([get_modified(name, r) for r in records.get(0, records.count)])
+
+def test_fresh_mirror_is_read(function, server):
+
+    # a mirror synced within MIRROR_MAX_STALENESS seconds is read as it is
+    name, m, records, paged, recent = function
+    expected = get_rows(m, incremental=True)
+    records.set(2, change(name, records.get(2, 3)[0], get_state(m)['high_water_mark'] + 1000))
+    server.reset()
+    assert get_rows(m, incremental=True) == expected
+    endpoints = server.get_stats()['endpoints']
+    assert endpoints.get(paged, 0) == 0
+    assert endpoints.get(recent, 0) == 0
+
+def test_high_water_mark_sync(function, server):
+
+    # once the mirror is stale, only the records modified since the
+    # high-water mark are fetched, and the mark moves up to the latest one
+    name, m, records, paged, recent = function
+    m.MIRROR_MAX_STALENESS = 0
+    get_rows(m, incremental=True)
+    high_water_mark = get_state(m)['high_water_mark']
+    records.set(2, change(name, records.get(2, 3)[0], high_water_mark + 1000))
+    records.set(7, change(name, records.get(7, 8)[0], high_water_mark + 2000))
+
+    server.reset()
+    rows = get_rows(m, incremental=True)
+    endpoints = server.get_stats()['endpoints']
+    assert endpoints.get(paged, 0) == 0
+    assert endpoints.get(recent, 0) > 0
+    assert get_state(m)['high_water_mark'] == high_water_mark + 2000
+    assert len([r for r in rows if 'Changed' in r]) >= 2
+    assert rows == get_rows(m)
+
+    # with nothing else changed, the mark stays where it is
+    server.reset()
+    assert get_rows(m, incremental=True) == rows
+    assert server.get_stats()['endpoints'].get(paged, 0) == 0
+    assert get_state(m)['high_water_mark'] == high_water_mark + 2000
+
+def test_rebuild_drops_deleted_records(function, server):
+
+    # records deleted since the last full sync are dropped by the next one
+    name, m, records, paged, recent = function
+    rows = get_rows(m, incremental=True)
+    records.set(4, None)
+    expected = get_rows(m)
+    assert len(expected) < len(rows)
+    server.reset()
+    assert get_rows(m, rebuild=True) == expected
+    assert server.get_stats()['endpoints'].get(paged, 0) > 0
+
+def test_mirror_filters(load):
+
+    # filters on the indexed columns are applied by the mirror's query and
+    # the rest by the predicate; either way, they match the same rows as
+    # filtering all the rows, ignoring case
+    m = load('hubspot-deals.py')
+    columns = ['deal_id', 'owner_id', 'deal_stage_id', 'deal_stage_label', 'num_notes']
+    rows = list(m.get_data(get_params(properties=','.join(columns))))
+    filter = 'owner_id=4&owner_id=5&deal_stage_label=CLOSEDWON&num_notes=1&num_notes=4'
+    mirror_filters, local_filters = split_mirror_filters(get_filters(m.COLUMNS, filter), m.MIRROR_INDEXES)
+    assert list(mirror_filters.keys()) == ['owner_id']
+    assert list(local_filters.keys()) == ['deal_stage_label', 'num_notes']
+
+    expected = [r for r in rows if r[1] in (4, 5) and r[3] == 'Closedwon' and r[4] in (1, 4)]
+    assert len(expected) > 0
+    assert list(m.get_data(get_params(properties=','.join(columns), filter=filter, incremental=True))) == expected
+
+    # columns that are only filtered aren't returned
+    filtered = list(m.get_data(get_params(properties='deal_id', filter=filter, incremental=True)))
+    assert filtered == [r[:1] for r in expected]
+
+def test_predicate():
+    columns = ['id', 'name', 'active', 'owner']
+    predicate = get_predicate({'name': ['Acme', 'Globex'], 'active': ['TRUE']}, columns)
+    assert predicate((1, 'acme', True, None)) is True
+    assert predicate((2, 'GLOBEX', True, None)) is True
+    assert predicate((3, 'Initech', True, None)) is False
+    assert predicate((4, 'Acme', False, None)) is False
+
+    # an empty value matches a missing one, and numbers match as strings
+    predicate = get_predicate({'owner': [''], 'id': ['5']}, columns)
+    assert predicate((5, 'Acme', True, None)) is True
+    assert predicate((5, 'Acme', True, '')) is True
+    assert predicate((5, 'Acme', True, 7)) is False
+    assert predicate(('5', 'Acme', True, None)) is True
+    assert predicate((6, 'Acme', True, None)) is False
+
+    assert get_predicate({}, columns) is None
+
+def test_filter_param():
+    definitions = {'id': None, 'name': None}
+    assert get_filters(definitions, None) == {}
+    assert get_filters(definitions, '?Name=Acme&name=%20Globex%20&id=') == {'name': ['Acme', 'Globex'], 'id': ['']}
+    with pytest.raises(ValueError, match="Invalid filter property 'missing'"):
+        get_filters(definitions, 'missing=1')
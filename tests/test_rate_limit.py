@@ -0,0 +1,154 @@
+# the rate limit stores, the token bucket kept in them and the rate limited
+# session, run against the mock server
+
+import os
+import time
+import threading
+
+import pytest
+
+import hubspot_core
+from hubspot_core import (
+    MemoryRateLimitStore, FileRateLimitStore, SqliteRateLimitStore,
+    RateLimiter, take_token, sync_bucket
+)
+from conftest import TOKEN, get_params
+
+def make_store(kind, data_path):
+    if kind == 'file':
+        return FileRateLimitStore(os.path.join(data_path, 'ratelimit'))
+    if kind == 'sqlite':
+        return SqliteRateLimitStore(os.path.join(data_path, 'ratelimit.sqlite'))
+    return MemoryRateLimitStore()
+
+@pytest.fixture(params=['memory', 'file', 'sqlite'])
+def kind(request):
+    return request.param
+
+def test_take_token(kind, data_path):
+
+    # a bucket starts full, and once it's empty the wait is the time until
+    # the next token
+    store = make_store(kind, data_path)
+    waits = [store.update('key', lambda state: take_token(state, 3, 30.0)) for i in range(4)]
+    assert waits[:3] == [0, 0, 0]
+    assert 9.0 < waits[3] <= 10.0
+
+def test_keys_are_separate(kind, data_path):
+    store = make_store(kind, data_path)
+    assert store.update('a', lambda state: take_token(state, 1, 30.0)) == 0
+    assert store.update('b', lambda state: take_token(state, 1, 30.0)) == 0
+    assert store.update('a', lambda state: take_token(state, 1, 30.0)) > 0
+
+@pytest.mark.parametrize('kind', ['file', 'sqlite'])
+def test_shared_by_stores(kind, data_path):
+
+    # the file and sqlite stores keep the buckets where other processes on
+    # the same machine see them
+    assert make_store(kind, data_path).update('key', lambda state: take_token(state, 1, 30.0)) == 0
+    assert make_store(kind, data_path).update('key', lambda state: take_token(state, 1, 30.0)) > 0
+
+@pytest.mark.parametrize('kind', ['file', 'sqlite'])
+def test_concurrent_updates(kind, data_path):
+
+    # each thread uses its own store, as each process would, and only as many
+    # tokens as the bucket holds are taken
+    make_store(kind, data_path)
+    waits = []
+    def take():
+        store = make_store(kind, data_path)
+        for i in range(5):
+            waits.append(store.update('key', lambda state: take_token(state, 10, 1000.0)))
+    threads = [threading.Thread(target=take) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(waits) == 40
+    assert len([w for w in waits if w == 0]) == 10
+
+def test_failed_update_is_not_saved(data_path):
+    store = make_store('sqlite', data_path)
+    def fail(state):
+        state['tokens'] = 0
+        raise RuntimeError('failed')
+    with pytest.raises(RuntimeError):
+        store.update('key', fail)
+    assert store.update('key', lambda state: dict(state)) == {}
+
+def test_private_files(kind, data_path):
+    store = make_store(kind, data_path)
+    store.update('key', lambda state: take_token(state, 1, 30.0))
+    if kind == 'memory':
+        return
+    path = store.path
+    assert os.stat(data_path).st_mode & 0o777 == 0o700
+    files = [os.path.join(path, f) for f in os.listdir(path)] if os.path.isdir(path) else [path]
+    assert len(files) > 0
+    assert all(os.stat(f).st_mode & 0o777 == 0o600 for f in files)
+
+def test_sync_bucket_headers():
+
+    # hubspot's rate limit headers replace the starting limits
+    state = {}
+    sync_bucket(state, 100, 10.0, {
+        'X-HubSpot-RateLimit-Max': '10',
+        'X-HubSpot-RateLimit-Interval-Milliseconds': '1000',
+        'X-HubSpot-RateLimit-Remaining': '1',
+    }, 200)
+    assert state['capacity'] == 10
+    assert state['interval'] == 1.0
+    assert 1 <= state['tokens'] < 1.1
+    assert take_token(state, 100, 10.0) == 0
+    assert 0 < take_token(state, 100, 10.0) <= 0.1
+
+def test_sync_bucket_retry_after():
+
+    # a 429 empties the bucket and blocks it until its Retry-After has passed
+    state = {}
+    sync_bucket(state, 100, 10.0, {'Retry-After': '5'}, 429)
+    assert state['tokens'] == 0
+    assert 4.9 < take_token(state, 100, 10.0) <= 5.0
+
+def test_secondly_limit():
+    state = {}
+    sync_bucket(state, 100, 10.0, {'X-HubSpot-RateLimit-Secondly-Remaining': '0'}, 200)
+    assert 0.9 < take_token(state, 100, 10.0) <= 1.0
+
+def test_limiter_paces_requests(monkeypatch):
+    monkeypatch.setattr(hubspot_core, 'RATE_LIMITS', {'default': (2, 0.2), 'search': (4, 1.0)})
+    limiter = RateLimiter('key', MemoryRateLimitStore())
+    started = time.time()
+    waited = sum([limiter.acquire('default') for i in range(4)])
+    assert waited >= 0.15
+    assert time.time() - started >= 0.15
+    assert limiter.get_stats()['throttled_seconds'] >= 0.15
+
+def test_limiter_deadline(monkeypatch):
+
+    # a wait that would run past the deadline stops the call instead
+    monkeypatch.setattr(hubspot_core, 'RATE_LIMITS', {'default': (1, 60.0), 'search': (4, 1.0)})
+    limiter = RateLimiter('key', MemoryRateLimitStore())
+    deadline = hubspot_core.Deadline(time.time() + 5)
+    limiter.acquire('default', deadline)
+    with pytest.raises(hubspot_core.DeadlineExceeded):
+        limiter.acquire('default', deadline)
+
+@pytest.mark.parametrize('backend', ['memory', 'file', 'sqlite'])
+def test_session_retries_429s(backend, load, server, monkeypatch):
+
+    # 429s from the server are retried after their Retry-After, so every deal
+    # is returned, and they're counted by the limiter
+    monkeypatch.setattr(hubspot_core, 'RATE_LIMIT_BACKEND', backend)
+    server.config['fail_every'] = 3
+    server.config['retry_after'] = 0
+    m = load('hubspot-deals.py')
+    session = hubspot_core.requests_retry_session(limiter=hubspot_core.get_rate_limiter(TOKEN))
+    rows = list(m.get_data(get_params(properties='deal_id'), session=session))
+    assert [r[0] for r in rows] == list(range(1, 601))
+    stats = hubspot_core.get_rate_limit_stats(session)
+    assert server.get_stats()['rate_limited'] > 0
+    assert stats['rate_limited'] == server.get_stats()['rate_limited']
+    assert stats['requests'] == server.get_stats()['requests']
+    store = hubspot_core.get_rate_limit_store()
+    assert type(store).__name__ == {'memory': 'MemoryRateLimitStore', 'file': 'FileRateLimitStore', 'sqlite': 'SqliteRateLimitStore'}[backend]